@@ -1,47 +1,300 @@
 #!/usr/bin/python
-import sys
+"""Run the Meteor unit tests, echo their output, and summarize the results.
+
+Usage:
+
+  input-filter.py [--log FILE] [--summary FILE] [--timeout SECONDS] -- meteor --test ...
+
+This starts the command in its own process group. It echoes the
+command's output, and any lines appended to --log (the Jasmine server
+integration log, which is where the specs' own output goes). It parses
+the lines as they arrive.
+
+The specs print one JSON line per finished spec; see
+sandcats/tests/jasmine/server/integration/helpers/structuredReporter.js.
+Once the run is done, we stop the process group we started and nothing
+else. We write a JSON summary of every failure and every spec's
+duration to --summary, and exit 0 only if every spec passed.
+
+We keep going after a failure, so one run reports every failing spec.
+
+For compatibility, if no command is given we read stdin instead, and
+exit once the run is done.
+"""
+
+import argparse
+import json
 import os
+import select
+import signal
+import subprocess
+import sys
+import time
+
+SPEC_RESULT_MARKER = 'SANDCATS_SPEC_RESULT '
+SPECS_DONE_MARKER = 'SANDCATS_SPECS_DONE '
+
+# Older output that still tells us something.
+LEGACY_FAILURE_MARKER = 'FAIL'
+LEGACY_DONE_MARKER = 'time to exit'
+
+READ_SIZE = 64 * 1024
+# Lines longer than this are cut short, so one runaway line can't use
+# unbounded memory.
+MAX_LINE_LENGTH = 64 * 1024
+# Failure messages and stacks in the summary are cut to this length.
+MAX_MESSAGE_LENGTH = 4 * 1024
+LOG_POLL_SECONDS = 0.1
+# After the legacy "time to exit" line, wait this long for the
+# structured results to catch up, since they come via the log file.
+LEGACY_DONE_GRACE_SECONDS = 2
+
+
+class LineSplitter(object):
+    '''Turns chunks of bytes into complete lines, holding at most one
+    partial line in memory.'''
+
+    def __init__(self):
+        self.partial = ''
+
+    def feed(self, chunk):
+        data = self.partial + chunk
+        lines = data.split('\n')
+        self.partial = lines.pop()
+        if len(self.partial) > MAX_LINE_LENGTH:
+            lines.append(self.partial[:MAX_LINE_LENGTH])
+            self.partial = ''
+        return [line[:MAX_LINE_LENGTH] for line in lines]
+
+    def flush(self):
+        lines = [self.partial] if self.partial else []
+        self.partial = ''
+        return lines
+
+
+class LogFollower(object):
+    '''Like "tail -c 0 --retry -f FILE": yields lines appended to a file
+    after we started, coping with the file not existing yet or being
+    replaced.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.inode = None
+        self.splitter = LineSplitter()
+        self._open(seek_to_end=True)
+
+    def _open(self, seek_to_end):
+        try:
+            self.file = open(self.path, 'rb')
+        except IOError:
+            self.file = None
+            return
+        self.inode = os.fstat(self.file.fileno()).st_ino
+        if seek_to_end:
+            self.file.seek(0, os.SEEK_END)
+
+    def read_lines(self):
+        if self.file is None:
+            # It didn't exist when we started, so all of it is new.
+            self._open(seek_to_end=False)
+            if self.file is None:
+                return []
 
-from twisted.internet import stdio, reactor
-from twisted.protocols import basic
+        lines = []
+        while True:
+            chunk = self.file.read(READ_SIZE)
+            if not chunk:
+                break
+            lines.extend(self.splitter.feed(chunk))
 
-class Echo(basic.LineReceiver):
-    from os import linesep as delimiter
+        # If the file was replaced or truncated, start over on the new one.
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return lines
+        if stat.st_ino != self.inode or stat.st_size < self.file.tell():
+            self.file.close()
+            self._open(seek_to_end=False)
+        return lines
 
-    def exitWithStatusCode(self):
-        print 'trying to exit'
-        if self.all_good:
-            os._exit(0)
+
+class ResultCollector(object):
+    '''Parses output lines as they arrive, keeping only the results.'''
+
+    def __init__(self):
+        self.specs = []
+        self.failures = []
+        self.legacy_failure_lines = []
+        self.done = False
+        self.done_info = None
+        self.legacy_done_time = None
+
+    def handle_line(self, line):
+        if SPEC_RESULT_MARKER in line:
+            self._handle_spec_result(line.split(SPEC_RESULT_MARKER, 1)[1])
+        elif SPECS_DONE_MARKER in line:
+            self.done = True
+            try:
+                self.done_info = json.loads(line.split(SPECS_DONE_MARKER, 1)[1])
+            except ValueError:
+                pass
+        elif LEGACY_DONE_MARKER in line:
+            if self.legacy_done_time is None:
+                self.legacy_done_time = time.time()
+        elif LEGACY_FAILURE_MARKER in line:
+            self.legacy_failure_lines.append(line[:MAX_MESSAGE_LENGTH])
+
+    def _handle_spec_result(self, data):
+        try:
+            result = json.loads(data)
+        except ValueError:
+            self.legacy_failure_lines.append('Unparseable spec result: ' + data[:MAX_MESSAGE_LENGTH])
+            return
+        self.specs.append({
+            'fullName': result.get('fullName'),
+            'status': result.get('status'),
+            'durationMilliseconds': result.get('durationMilliseconds'),
+        })
+        if result.get('status') == 'failed':
+            self.failures.append({
+                'fullName': result.get('fullName'),
+                'failedExpectations': [
+                    {'message': (e.get('message') or '')[:MAX_MESSAGE_LENGTH],
+                     'stack': (e.get('stack') or '')[:MAX_MESSAGE_LENGTH]}
+                    for e in result.get('failedExpectations') or []],
+            })
+
+    def finished(self):
+        if self.done:
+            return True
+        return (self.legacy_done_time is not None and
+                time.time() - self.legacy_done_time > LEGACY_DONE_GRACE_SECONDS)
+
+    def all_good(self):
+        return (self.finished() and not self.failures and not self.legacy_failure_lines)
+
+    def summary(self, exit_reason):
+        return {
+            'allPassed': self.all_good(),
+            'finished': self.finished(),
+            'exitReason': exit_reason,
+            'specCount': len(self.specs),
+            'failureCount': len(self.failures),
+            'failures': self.failures,
+            'legacyFailureLines': self.legacy_failure_lines,
+            'specs': self.specs,
+        }
+
+
+def echo(line):
+    sys.stdout.write(line + '\n')
+    sys.stdout.flush()
+
+
+def stop_process_group(process):
+    '''Stop the process we started, and its children, but nothing else.'''
+    if process.poll() is not None:
+        return
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except OSError:
+        return
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        if process.poll() is not None:
+            return
+        time.sleep(0.05)
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+    process.wait()
+
+
+def run(args):
+    collector = ResultCollector()
+    follower = LogFollower(args.log) if args.log else None
+
+    process = None
+    if args.command:
+        process = subprocess.Popen(args.command, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+        stream = process.stdout
+    else:
+        stream = sys.stdin
+
+    splitter = LineSplitter()
+    deadline = (time.time() + args.timeout) if args.timeout else None
+    exit_reason = None
+    stream_open = True
+
+    while True:
+        if stream_open:
+            readable, _, _ = select.select([stream], [], [], LOG_POLL_SECONDS)
+            lines = []
+            if readable:
+                chunk = os.read(stream.fileno(), READ_SIZE)
+                if chunk:
+                    lines = splitter.feed(chunk)
+                else:
+                    lines = splitter.flush()
+                    stream_open = False
         else:
-            os._exit(1)
+            time.sleep(LOG_POLL_SECONDS)
+            lines = []
 
-    def _done(self):
-        print 'in _done'
-        os.system('killall -9 node')
-        reactor.removeAll()
-        reactor.stop()
+        if follower:
+            lines.extend(follower.read_lines())
 
-    def connectionMade(self):
-        self.all_good = True
+        for line in lines:
+            echo(line)
+            collector.handle_line(line)
 
-    def lineReceived(self, line):
-        self.sendLine(line)
+        if collector.finished():
+            exit_reason = 'finished'
+            break
+        if not stream_open and (process is None or process.poll() is not None):
+            exit_reason = 'command exited'
+            break
+        if deadline and time.time() > deadline:
+            exit_reason = 'timeout'
+            break
 
-        if 'FAIL' in line:
-            self.all_good = False
-            self.sendLine("NOTICED A FAILURE!")
-            reactor.callLater(0.1, self._done)
-            print 'called later'
+    if process is not None:
+        stop_process_group(process)
+
+    summary = collector.summary(exit_reason)
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+
+    echo('%d specs, %d failed (%s).' % (
+        summary['specCount'], summary['failureCount'], exit_reason))
+    for failure in collector.failures:
+        echo('FAILED: %s' % (failure['fullName'],))
+        for expectation in failure['failedExpectations']:
+            echo('    ' + expectation['message'])
+
+    return 0 if collector.all_good() else 1
 
-        if 'time to exit' in line:
-            reactor.callLater(0.1, self._done)
 
 def main():
-    e = Echo()
-    stdio.StandardIO(e)
-    from twisted.internet import reactor
-    reactor.run()
-    e.exitWithStatusCode()
+    argv = sys.argv[1:]
+    command = []
+    if '--' in argv:
+        command = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+
+    parser = argparse.ArgumentParser(description='Run and summarize the Meteor unit tests.')
+    parser.add_argument('--log', help='Also follow this log file.')
+    parser.add_argument('--summary', help='Write a JSON summary here.')
+    parser.add_argument('--timeout', type=float,
+                        help='Give up after this many seconds.')
+    args = parser.parse_args(argv)
+    args.command = command
+
+    sys.exit(run(args))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,332 @@
+"""Load test for the sandcats HTTP API.
+
+This reuses _make_api_call() from integration_tests.py, so every
+request looks exactly like the ones the integration tests send: the
+X-Sand: cats header, a client certificate from test-data/, and so
+on. The difference is volume: many client threads, each with its own
+pooled HTTPS session, sending a configurable mix of endpoints for a
+fixed amount of time.
+
+At the end, it prints throughput, latency percentiles, and HTTP status
+codes per endpoint, so that we can see how nginx, Meteor, and MySQL
+behave when many clients call /update at once.
+
+Before the load starts, we register one hostname per client
+certificate (loadtest-1, loadtest-2, ...), so that /update has
+something to update. Run this against a freshly reset sandcats (make
+action-reset-app-state), or some of those registrations will fail
+because the certificate is already in use.
+
+With --cert-manifest, we instead use the hostnames and client
+certificates that generate_scale_dataset.py registered, so that the
+load runs against a production-sized dataset.
+
+What each endpoint does during the load:
+
+- update: updates one of the loadtest-N hostnames. With --ip-churn
+  (the default), it alternates between 127.0.0.1 and the external IP
+  address, so that every /update really writes to DNS.
+
+- register: tries to register a fresh hostname with an
+  already-registered key, which exercises validation and MongoDB but
+  fails with HTTP 400.
+
+- reserve: reserves a fresh hostname.
+
+- recover: asks to recover a loadtest-N hostname with a bogus but
+  well-formed (40-character) recovery token, so that it gets as far as
+  checking the token against MongoDB, and fails with HTTP 400.
+
+Example:
+
+    python api_load_test.py --mix update=80,register=10,reserve=5,recover=5 \\
+        --clients 32 --duration 60
+"""
+
+import argparse
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+
+import requests
+import requests.adapters
+
+import integration_tests
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Load test the sandcats HTTP API.')
+    parser.add_argument('--mix', default='update=80,register=10,reserve=5,recover=5',
+                        help='Comma-separated endpoint=weight pairs.')
+    parser.add_argument('--clients', type=int, default=16,
+                        help='How many concurrent client threads to run.')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='How many seconds to send requests for.')
+    parser.add_argument('--keys', type=int, default=5,
+                        help='How many of the test-data/client-cert-N certificates to use.')
+    parser.add_argument('--cert-manifest',
+                        help='The manifest.json from generate_scale_dataset.py; use its '
+                        'hostnames and certificates instead of registering loadtest-N.')
+    parser.add_argument('--no-ip-churn', dest='ip_churn', action='store_false',
+                        help='Always /update from the same IP address.')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the results as JSON.')
+    return parser.parse_args(argv)
+
+
+def parse_mix(mix):
+    '''Turn "update=80,register=20" into [('update', 80), ('register', 20)].'''
+    weights = []
+    for item in mix.split(','):
+        endpoint, weight = item.split('=')
+        endpoint = endpoint.strip()
+        if endpoint not in ENDPOINTS:
+            raise ValueError('Unknown endpoint %r; pick from %s' % (
+                endpoint, ', '.join(sorted(ENDPOINTS))))
+        weights.append((endpoint, float(weight)))
+    return weights
+
+
+def choose_endpoint(weights):
+    total = sum(weight for _, weight in weights)
+    point = random.uniform(0, total)
+    for endpoint, weight in weights:
+        point -= weight
+        if point <= 0:
+            return endpoint
+    return weights[-1][0]
+
+
+def make_session():
+    '''Return a requests.Session that keeps its HTTPS connections alive.
+
+    It pools one connection per host, and --ip-churn alternates between
+    two hosts (127.0.0.1 and the external IP address).
+
+    Each client thread gets its own session, since Session objects are
+    not meant to be shared between threads.'''
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=1)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def loadtest_hostname(key_number):
+    return 'loadtest-%d' % (key_number,)
+
+
+# A unique suffix for hostnames created during this run, so that
+# /register and /reserve calls don't collide with each other.
+_fresh_hostname_counter = itertools.count()
+_fresh_hostname_prefix = 'lt%x' % (int(time.time()) % 0xfffff,)
+
+
+def fresh_hostname():
+    return '%s-%d' % (_fresh_hostname_prefix, next(_fresh_hostname_counter))
+
+
+class Client(object):
+    '''One simulated Sandstorm server, pinned to one client certificate.'''
+
+    def __init__(self, key_number, hostname, ip_churn):
+        self.key_number = key_number
+        self.hostname = hostname
+        self.ip_churn = ip_churn
+        self.session = make_session()
+        self.external_ip = False
+
+    def update(self):
+        if self.ip_churn:
+            self.external_ip = not self.external_ip
+        return integration_tests._make_api_call(
+            path='update',
+            rawHostname=self.hostname,
+            key_number=self.key_number,
+            external_ip=self.external_ip,
+            session=self.session)
+
+    def register(self):
+        return integration_tests._make_api_call(
+            path='register',
+            rawHostname=fresh_hostname(),
+            key_number=self.key_number,
+            session=self.session)
+
+    def reserve(self):
+        return integration_tests._make_api_call(
+            path='reserve',
+            provide_x_sandcats=False,
+            rawHostname=fresh_hostname(),
+            key_number=None,
+            session=self.session)
+
+    def recover(self):
+        return integration_tests._make_api_call(
+            path='recover',
+            rawHostname=self.hostname,
+            key_number=self.key_number,
+            recoveryToken=BOGUS_RECOVERY_TOKEN,
+            session=self.session)
+
+
+ENDPOINTS = ('update', 'register', 'reserve', 'recover')
+
+# 40 characters, like a real one, or validation would reject it before
+# recoveryIsAuthorized ever looks it up.
+BOGUS_RECOVERY_TOKEN = 'abcdefghij' * 4
+
+
+class EndpointStats(object):
+    def __init__(self):
+        self.latencies = []
+        self.status_codes = {}
+        self.errors = 0
+
+    def record(self, milliseconds, status_code):
+        self.latencies.append(milliseconds)
+        self.status_codes[status_code] = self.status_codes.get(status_code, 0) + 1
+
+    def merge(self, other):
+        self.latencies.extend(other.latencies)
+        for status_code, count in other.status_codes.items():
+            self.status_codes[status_code] = self.status_codes.get(status_code, 0) + count
+        self.errors += other.errors
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = int(round((pct / 100.0) * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def register_loadtest_hostnames(key_count):
+    '''Register loadtest-N for each key. Return a dict from each key
+    that worked to its hostname.'''
+    hostnames = {}
+    for key_number in range(1, key_count + 1):
+        response = integration_tests._make_api_call(
+            rawHostname=loadtest_hostname(key_number),
+            key_number=key_number)
+        if response.status_code == 200:
+            hostnames[key_number] = loadtest_hostname(key_number)
+        else:
+            print 'Could not register %s: %s' % (
+                loadtest_hostname(key_number), response.content.strip())
+    return hostnames
+
+
+def load_manifest_hostnames(path):
+    '''Point integration_tests at the certificate pool in a
+    generate_scale_dataset.py manifest, and return a dict from key
+    number to the hostname registered with it.'''
+    with open(path) as f:
+        manifest = json.load(f)
+    integration_tests.use_namespace('', manifest['cert_dir'])
+    return dict((entry['key_number'], entry['hostname'])
+                for entry in manifest['hostnames'])
+
+
+def run_client(client, weights, deadline, stats_by_endpoint):
+    while time.time() < deadline:
+        endpoint = choose_endpoint(weights)
+        stats = stats_by_endpoint[endpoint]
+        start = time.time()
+        try:
+            response = getattr(client, endpoint)()
+        except requests.exceptions.RequestException:
+            stats.errors += 1
+            continue
+        stats.record((time.time() - start) * 1000, response.status_code)
+
+
+def run_load_test(args):
+    weights = parse_mix(args.mix)
+
+    if args.cert_manifest:
+        hostnames = load_manifest_hostnames(args.cert_manifest)
+    else:
+        hostnames = register_loadtest_hostnames(args.keys)
+    if not hostnames:
+        raise RuntimeError('No loadtest hostnames could be registered. '
+                           'Try make action-reset-app-state first.')
+    keys = sorted(hostnames)
+
+    # Each thread collects its own stats, so that we don't need locks
+    # in the hot path; we merge them at the end.
+    per_thread_stats = []
+    threads = []
+    start = time.time()
+    deadline = start + args.duration
+    for i in range(args.clients):
+        key_number = keys[i % len(keys)]
+        client = Client(key_number, hostnames[key_number], args.ip_churn)
+        stats_by_endpoint = dict((endpoint, EndpointStats()) for endpoint in ENDPOINTS)
+        per_thread_stats.append(stats_by_endpoint)
+        thread = threading.Thread(target=run_client,
+                                  args=(client, weights, deadline, stats_by_endpoint))
+        thread.daemon = True
+        threads.append(thread)
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    results = {}
+    for endpoint, _ in weights:
+        merged = EndpointStats()
+        for stats_by_endpoint in per_thread_stats:
+            merged.merge(stats_by_endpoint[endpoint])
+        merged.latencies.sort()
+        results[endpoint] = {
+            'requests': len(merged.latencies),
+            'errors': merged.errors,
+            'requests_per_second': len(merged.latencies) / elapsed,
+            'status_codes': merged.status_codes,
+            'p50_ms': percentile(merged.latencies, 50),
+            'p90_ms': percentile(merged.latencies, 90),
+            'p99_ms': percentile(merged.latencies, 99),
+            'max_ms': merged.latencies[-1] if merged.latencies else None,
+        }
+    return {
+        'clients': args.clients,
+        'keys': keys,
+        'elapsed_seconds': elapsed,
+        'endpoints': results,
+    }
+
+
+def print_results(results):
+    print 'Ran %d clients over %d keys for %.1f seconds.' % (
+        results['clients'], len(results['keys']), results['elapsed_seconds'])
+    print '%-10s %9s %8s %9s %9s %9s %9s  %s' % (
+        'endpoint', 'requests', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'status codes')
+    for endpoint in sorted(results['endpoints']):
+        r = results['endpoints'][endpoint]
+        if not r['requests']:
+            print '%-10s %9d (%d connection errors)' % (endpoint, 0, r['errors'])
+            continue
+        codes = ' '.join('%s:%d' % item for item in sorted(r['status_codes'].items()))
+        if r['errors']:
+            codes += ' errors:%d' % (r['errors'],)
+        print '%-10s %9d %8.1f %9.1f %9.1f %9.1f %9.1f  %s' % (
+            endpoint, r['requests'], r['requests_per_second'],
+            r['p50_ms'], r['p90_ms'], r['p99_ms'], r['max_ms'], codes)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    # We use verify=False against the local snakeoil certificate, so
+    # don't warn about it on every request.
+    if hasattr(requests.packages.urllib3, 'disable_warnings'):
+        requests.packages.urllib3.disable_warnings()
+    results = run_load_test(args)
+    if args.json:
+        print json.dumps(results, indent=2, sort_keys=True)
+    else:
+        print_results(results)
@@ -0,0 +1,450 @@
+"""Generate a production-sized sandcats dataset for scale testing.
+
+The integration tests work with a handful of hostnames and the five
+client certificates in test-data/. That is too little data to tell
+whether an index, a report, or the UDP and /update hot paths hold up
+in production, where there are millions of documents. This script
+makes that much data, realistic enough to benchmark against:
+
+- UserRegistrations with made-up hostnames, IP addresses (some shared,
+  as behind NAT), keys, and email addresses. Most have had the same
+  IP address for months, and their ipAddressChangedAt and dnsTtl
+  match what server/dnsttl.js would have published. A few have
+  pending recovery tokens.
+
+- DomainReservations for other hostnames.
+
+- CertificateRequests: weekly renewals for some of the hostnames,
+  mostly successful, some failed, mostly prod.
+
+- The PowerDNS A and wildcard A records for every registration.
+
+- A pool of real client certificates, and registrations that use
+  them, so that api_load_test.py can call /update on large-dataset
+  hostnames. The pool is cached in --cert-dir: certificates that are
+  already there are reused, since generating RSA keys is slow.
+
+Everything is written to --output-dir as files for bulk loading:
+mongoimport JSON for each collection, and multi-row INSERTs for
+MySQL. With --load, we also load them into the local sandcats_mongo
+and sandcats_pdns databases. Load into a freshly reset sandcats (make
+action-reset-app-state), since the hostnames are only unique within
+one run. Then restart sandcats, so that it creates the indexes, and
+rebuilds the daily certificate counts that --load empties.
+
+The output directory also gets:
+
+- hostnames.txt, every registered hostname except the certificate
+  pool's, for udp_ping_benchmark.py --hostnames-file. None of them
+  are registered to a local address, so every ping should get a
+  reply.
+
+- manifest.json, the hostnames that use the certificate pool, for
+  api_load_test.py --cert-manifest.
+
+Example:
+
+    python generate_scale_dataset.py --registrations 1000000 --load
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import os
+import random
+import string
+import subprocess
+import sys
+import time
+
+import integration_tests
+
+DAY_SECONDS = 24 * 60 * 60
+
+# The same words people tend to pick, give or take.
+HOSTNAME_WORDS = [
+    'home', 'sandstorm', 'server', 'cloud', 'box', 'lab', 'nas', 'office',
+    'family', 'club', 'team', 'studio', 'garage', 'attic', 'den', 'pi',
+    'files', 'notes', 'wiki', 'chat', 'projects', 'school', 'shop', 'work',
+]
+
+# Meteor's Random.id() alphabet, so that the _ids look like the app's.
+METEOR_ID_ALPHABET = '23456789ABCDEFGHJKLMNPQRSTWXYZabcdefghijkmnopqrstuvwxyz'
+METEOR_ID_LENGTH = 17
+
+RECOVERY_TOKEN_ALPHABET = string.ascii_letters + string.digits
+
+# Keep in sync with DNS_TTL_TIERS in server/dnsttl.js: after an IP
+# address has been stable for that many days, we publish that TTL.
+DNS_TTL_TIERS = [(0, 60), (1, 5 * 60), (7, 15 * 60), (30, 60 * 60)]
+
+# How long ago hostnames last changed IP address, as (fraction of
+# hostnames, fewest days, most days). Most Sandstorm servers stay put.
+IP_ADDRESS_AGE_DISTRIBUTION = [
+    (0.05, 0, 1),
+    (0.10, 1, 7),
+    (0.15, 7, 30),
+    (0.70, 30, 700),
+]
+
+# Same as DUMMY_MONTHS_VALUE in lib/globalsign.js.
+GLOBALSIGN_DUMMY_MONTHS = 6
+CERTIFICATE_DAYS = 9
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Generate a large sandcats dataset for scale testing.')
+    parser.add_argument('--registrations', type=int, default=1000000,
+                        help='How many UserRegistrations to create.')
+    parser.add_argument('--reservations', type=int, default=None,
+                        help='How many DomainReservations to create. '
+                        'Defaults to 5%% of --registrations.')
+    parser.add_argument('--certificate-hosts', type=float, default=0.3,
+                        help='Fraction of hostnames that have requested certificates.')
+    parser.add_argument('--certificate-history-days', type=int, default=120,
+                        help='Renew certificates weekly, for up to this many days back.')
+    parser.add_argument('--cert-pool', type=int, default=100,
+                        help='How many real client certificates to register hostnames for.')
+    parser.add_argument('--cert-dir', default='/tmp/sandcats-scale-certs',
+                        help='Where to cache the client certificate pool.')
+    parser.add_argument('--pool-ip-address', default='127.0.0.1',
+                        help='IP address to register the certificate pool hostnames to.')
+    parser.add_argument('--output-dir', default='/tmp/sandcats-scale-data',
+                        help='Where to write the dataset files.')
+    parser.add_argument('--base-domain', default=integration_tests.BASE_DOMAIN,
+                        help='The BASE_DOMAIN of the sandcats to load into.')
+    parser.add_argument('--rows-per-insert', type=int, default=1000,
+                        help='How many rows to put in each MySQL INSERT.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed, so runs can be repeated.')
+    parser.add_argument('--load', action='store_true',
+                        help='Load the dataset into the local MongoDB and MySQL.')
+    parser.add_argument('--mongo-db', default='sandcats_mongo')
+    parser.add_argument('--mysql-db', default='sandcats_pdns')
+    args = parser.parse_args(argv)
+    if args.reservations is None:
+        args.reservations = args.registrations // 20
+    if args.cert_pool > args.registrations:
+        parser.error('--cert-pool can not be more than --registrations.')
+    return args
+
+
+def base36(number):
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    result = ''
+    while True:
+        number, remainder = divmod(number, 36)
+        result = digits[remainder] + result
+        if number == 0:
+            return result
+
+
+def make_hostname(rng, number):
+    '''Return a unique, valid hostname for number, like "nas-2n9c".
+
+    The words have no hyphens, so the base 36 suffix keeps hostnames
+    unique; and they stay within the 20 characters sandcats allows.'''
+    return rng.choice(HOSTNAME_WORDS) + '-' + base36(number)
+
+
+def meteor_id(rng):
+    return ''.join(rng.choice(METEOR_ID_ALPHABET) for _ in range(METEOR_ID_LENGTH))
+
+
+def mongo_date(seconds):
+    '''Return seconds since the epoch as mongoimport's extended JSON.'''
+    return {'$date': int(seconds * 1000)}
+
+
+def iso_date(seconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(seconds))
+
+
+def random_public_ip_address(rng):
+    while True:
+        first_octet = rng.randint(1, 223)
+        if first_octet not in (10, 127, 169, 172, 192):
+            return '%d.%d.%d.%d' % (first_octet, rng.randint(0, 255),
+                                    rng.randint(0, 255), rng.randint(1, 254))
+
+
+def random_ip_address_age_days(rng):
+    point = rng.random()
+    for fraction, fewest_days, most_days in IP_ADDRESS_AGE_DISTRIBUTION:
+        point -= fraction
+        if point <= 0:
+            break
+    return rng.uniform(fewest_days, most_days)
+
+
+def dns_ttl_for_age(age_days):
+    ttl = DNS_TTL_TIERS[0][1]
+    for stable_days, tier_ttl in DNS_TTL_TIERS:
+        if age_days >= stable_days:
+            ttl = tier_ttl
+    return ttl
+
+
+def make_recovery_data(rng, now):
+    return {
+        'recoveryToken': ''.join(rng.choice(RECOVERY_TOKEN_ALPHABET) for _ in range(40)),
+        'timestamp': mongo_date(now - rng.uniform(0, 14 * DAY_SECONDS)),
+    }
+
+
+def certificate_fingerprint(crt_path):
+    '''Return the SHA-1 fingerprint of a PEM certificate, the way nginx's
+    $ssl_client_fingerprint, and so sandcats' publicKeyId, has it.'''
+    with open(crt_path) as f:
+        pem = f.read()
+    body = pem.split('-----BEGIN CERTIFICATE-----')[1].split('-----END CERTIFICATE-----')[0]
+    return hashlib.sha1(base64.b64decode(''.join(body.split()))).hexdigest()
+
+
+def ensure_cert_pool(cert_dir, count):
+    '''Make sure cert_dir has client-cert-1 through client-cert-count,
+    like integration_test_runner.py makes them, and return their
+    fingerprints in order.'''
+    if not os.path.isdir(cert_dir):
+        os.makedirs(cert_dir)
+    fingerprints = []
+    created = 0
+    with open(os.devnull, 'w') as devnull:
+        for n in range(1, count + 1):
+            keyfile = os.path.join(cert_dir, 'client-cert-%d.key' % (n,))
+            crtfile = os.path.join(cert_dir, 'client-cert-%d.crt' % (n,))
+            if not (os.path.exists(keyfile) and os.path.exists(crtfile)):
+                subprocess.check_call([
+                    'openssl', 'req', '-new',
+                    '-subj', '/C=AU/ST=Some-State/O=Internet Widgits Pty Ltd',
+                    '-newkey', 'rsa:2048', '-days', '365', '-nodes', '-x509',
+                    '-keyout', keyfile, '-out', crtfile,
+                ], stdout=devnull, stderr=devnull)
+                created += 1
+            fingerprints.append(certificate_fingerprint(crtfile))
+    print 'Certificate pool: %d certificates in %s (%d new).' % (count, cert_dir, created)
+    return fingerprints
+
+
+def sql_string(value):
+    return "'" + value.replace('\\', '\\\\').replace("'", "\\'") + "'"
+
+
+class RecordsWriter(object):
+    '''Writes PowerDNS records as multi-row INSERTs, in one transaction.'''
+
+    def __init__(self, path, base_domain, rows_per_insert):
+        self.f = open(path, 'w')
+        self.base_domain = base_domain
+        self.rows_per_insert = rows_per_insert
+        self.rows = []
+        self.f.write('SET autocommit = 0;\n')
+        self.f.write('SET @domain_id = (SELECT id FROM domains WHERE name = %s);\n' % (
+            sql_string(base_domain),))
+
+    def add_registration(self, hostname, ip_address, ttl):
+        host = hostname + '.' + self.base_domain
+        for name in (host, '*.' + host):
+            self.rows.append('(@domain_id, %s, \'A\', %s, %d)' % (
+                sql_string(name), sql_string(ip_address), ttl))
+        if len(self.rows) >= self.rows_per_insert:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.f.write('INSERT INTO records (domain_id, name, type, content, ttl) VALUES\n')
+            self.f.write(',\n'.join(self.rows))
+            self.f.write(';\n')
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        # Bump the SOA serial, the way bumpSoaRecord() in lib/dns.js does.
+        self.f.write(
+            "UPDATE records SET content = CONCAT_WS(' ', SUBSTRING_INDEX(content, ' ', 2), "
+            "CAST(SUBSTRING_INDEX(SUBSTRING_INDEX(content, ' ', 3), ' ', -1) AS UNSIGNED) + 1, "
+            "SUBSTRING_INDEX(content, ' ', -4)) "
+            "WHERE domain_id = @domain_id AND type = 'SOA' AND name = %s;\n" % (
+                sql_string(self.base_domain),))
+        self.f.write('COMMIT;\n')
+        self.f.close()
+
+
+def write_json_line(f, document):
+    f.write(json.dumps(document, separators=(',', ':')))
+    f.write('\n')
+
+
+def write_certificate_requests(f, rng, args, hostname, now):
+    '''Write a history of weekly certificate renewals for hostname.
+    Returns how many requests we wrote.'''
+    common_name = '*.' + hostname + '.' + args.base_domain
+    dev_or_prod = 'prod' if rng.random() < 0.95 else 'dev'
+    requested_at = now - rng.uniform(0, args.certificate_history_days) * DAY_SECONDS
+    count = 0
+    while requested_at < now:
+        end = requested_at + CERTIFICATE_DAYS * DAY_SECONDS
+        document = {
+            '_id': meteor_id(rng),
+            'requestCreationDate': mongo_date(requested_at),
+            'devOrProd': dev_or_prod,
+            'hostname': hostname,
+            'intendedUseDurationDays': 7,
+            'globalsignValidityPeriod': {
+                'Months': GLOBALSIGN_DUMMY_MONTHS,
+                'NotBefore': None,
+                'NotAfter': iso_date(end),
+            },
+        }
+        if rng.random() < 0.97:
+            document['globalsignCertificateInfo'] = {
+                'CertificateStatus': 4,
+                'StartDate': iso_date(requested_at),
+                'EndDate': iso_date(end),
+                'CommonName': common_name,
+                'SerialNumber': '%032x' % (rng.getrandbits(128),),
+                'SubjectName': 'CN=' + common_name,
+            }
+            document['receivedCertificateDate'] = mongo_date(requested_at + rng.uniform(1, 10))
+            document['certificateStartDate'] = mongo_date(requested_at)
+            document['certificateEndDate'] = mongo_date(end)
+        else:
+            document['globalsignErrors'] = {
+                'ErrorCode': '-3003',
+                'ErrorField': 'ValidityPeriod.NotAfter',
+                'ErrorMessage': 'Invalid parameter error.',
+            }
+        write_json_line(f, document)
+        count += 1
+        # Renew a week later, give or take a day.
+        requested_at += rng.uniform(6, 8) * DAY_SECONDS
+    return count
+
+
+def generate(args):
+    rng = random.Random(args.seed)
+    now = time.time()
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    def output_path(name):
+        return os.path.join(args.output_dir, name)
+
+    pool_fingerprints = ensure_cert_pool(args.cert_dir, args.cert_pool)
+
+    # Some servers share an IP address, e.g. behind carrier-grade NAT.
+    shared_ip_addresses = [random_public_ip_address(rng) for _ in range(1000)]
+
+    counts = {'registrations': 0, 'reservations': 0, 'certificate_requests': 0, 'records': 0}
+    pool_hostnames = []
+    start = time.time()
+
+    records = RecordsWriter(output_path('records.sql'), args.base_domain, args.rows_per_insert)
+    with open(output_path('userRegistrations.json'), 'w') as registrations_file, \
+            open(output_path('certificateRequests.json'), 'w') as certificates_file, \
+            open(output_path('hostnames.txt'), 'w') as hostnames_file:
+        for number in range(args.registrations):
+            hostname = make_hostname(rng, number)
+            age_days = random_ip_address_age_days(rng)
+            ttl = dns_ttl_for_age(age_days)
+            if number < args.cert_pool:
+                # api_load_test.py churns these between two addresses,
+                # so start them with a short TTL.
+                ip_address = args.pool_ip_address
+                public_key_id = pool_fingerprints[number]
+                age_days = 0
+                ttl = DNS_TTL_TIERS[0][1]
+                pool_hostnames.append({'hostname': hostname, 'key_number': number + 1,
+                                       'ip_address': ip_address})
+            else:
+                if rng.random() < 0.1:
+                    ip_address = rng.choice(shared_ip_addresses)
+                else:
+                    ip_address = random_public_ip_address(rng)
+                public_key_id = '%040x' % (rng.getrandbits(160),)
+
+            document = {
+                '_id': meteor_id(rng),
+                'hostname': hostname,
+                'ipAddress': ip_address,
+                'publicKeyId': public_key_id,
+                'emailAddress': 'user%d@example.com' % (number,),
+                'ipAddressChangedAt': mongo_date(now - age_days * DAY_SECONDS),
+                'dnsTtl': ttl,
+            }
+            if rng.random() < 0.01:
+                document['recoveryData'] = make_recovery_data(rng, now)
+            write_json_line(registrations_file, document)
+            if number >= args.cert_pool:
+                hostnames_file.write(hostname + '\n')
+            records.add_registration(hostname, ip_address, ttl)
+            counts['registrations'] += 1
+            counts['records'] += 2
+
+            if rng.random() < args.certificate_hosts:
+                counts['certificate_requests'] += write_certificate_requests(
+                    certificates_file, rng, args, hostname, now)
+
+            if number and number % 100000 == 0:
+                print '%d registrations so far.' % (number,)
+    records.close()
+
+    with open(output_path('domainReservations.json'), 'w') as reservations_file:
+        for i in range(args.reservations):
+            # Number these after the registrations, so the hostnames
+            # don't collide.
+            write_json_line(reservations_file, {
+                '_id': meteor_id(rng),
+                'hostname': make_hostname(rng, args.registrations + i),
+                'emailAddress': 'reserved%d@example.com' % (i,),
+                'recoveryData': make_recovery_data(rng, now),
+            })
+            counts['reservations'] += 1
+
+    with open(output_path('manifest.json'), 'w') as f:
+        json.dump({
+            'cert_dir': os.path.abspath(args.cert_dir),
+            'base_domain': args.base_domain,
+            'hostnames': pool_hostnames,
+            'counts': counts,
+            'seed': args.seed,
+        }, f, indent=2, sort_keys=True)
+
+    print 'Wrote %(registrations)d registrations, %(reservations)d reservations, ' \
+        '%(certificate_requests)d certificate requests and %(records)d DNS records' % counts,
+    print 'to %s in %.1f seconds.' % (args.output_dir, time.time() - start)
+    return counts
+
+
+def load(args):
+    '''Bulk-load the files from generate() into MongoDB and MySQL.'''
+    def output_path(name):
+        return os.path.join(args.output_dir, name)
+
+    for collection in ('userRegistrations', 'domainReservations', 'certificateRequests'):
+        start = time.time()
+        subprocess.check_call([
+            'mongoimport', '--db', args.mongo_db, '--collection', collection,
+            '--file', output_path(collection + '.json')])
+        print 'Loaded %s in %.1f seconds.' % (collection, time.time() - start)
+
+    # Empty the daily certificate counts, so that sandcats rebuilds
+    # them, including the new certificates, when it next starts.
+    subprocess.check_call([
+        'mongo', args.mongo_db, '--quiet', '--eval', 'db.certificateDailyCounts.remove({})'])
+
+    start = time.time()
+    with open(output_path('records.sql')) as f:
+        subprocess.check_call(['mysql', '-uroot', args.mysql_db], stdin=f)
+    print 'Loaded DNS records in %.1f seconds.' % (time.time() - start,)
+    print 'Now restart sandcats, so that it creates its indexes and rebuilds its ' \
+        'daily certificate counts.'
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    generate(args)
+    if args.load:
+        load(args)
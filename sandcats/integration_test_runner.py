@@ -0,0 +1,181 @@
+"""Run the integration tests in parallel.
+
+integration_tests.py runs its tests one after another, and most of the
+wall-clock time goes to waiting for DNS changes to show up. This
+runner splits the tests into groups that don't depend on each other,
+and runs each group in its own process. Each group gets its own
+namespace: a hostname prefix (so "benb" becomes e.g. "rega1b2-benb")
+and a freshly generated set of client certificates. That way the
+groups can't see each other's registrations or keys.
+
+Groups that depend on state created by another group's tests get a
+setup step that creates just that state.
+
+At the end, we print how long each test took, how long DNS changes
+took to propagate, and exit non-zero if any failed. Usage:
+
+    python integration_test_runner.py [--reset-app-state [--fast-reset]] [--processes N]
+"""
+
+import argparse
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+import uuid
+
+import integration_tests
+
+NUM_CLIENT_CERTS = 5
+
+
+def generate_client_certs(cert_dir):
+    '''Create client-cert-N.{crt,key} like test-data/generate-client-certs.sh does.'''
+    with open(os.devnull, 'w') as devnull:
+        for n in range(1, NUM_CLIENT_CERTS + 1):
+            subprocess.check_call([
+                'openssl', 'req', '-new',
+                '-subj', '/C=AU/ST=Some-State/O=Internet Widgits Pty Ltd',
+                '-newkey', 'rsa:2048', '-days', '365', '-nodes', '-x509',
+                '-keyout', os.path.join(cert_dir, 'client-cert-%d.key' % (n,)),
+                '-out', os.path.join(cert_dir, 'client-cert-%d.crt' % (n,)),
+            ], stdout=devnull, stderr=devnull)
+
+
+def register_or_fail(rawHostname, key_number):
+    response = integration_tests._make_api_call(
+        rawHostname=integration_tests.host(rawHostname),
+        key_number=key_number)
+    assert response.status_code == 200, response.content
+
+
+def setup_recovery():
+    # test_recovery() expects test_register() to have registered
+    # benb with key 1 and benb3 with key 3.
+    register_or_fail('benb', 1)
+    register_or_fail('benb3', 3)
+
+
+def setup_reserve_domain():
+    # test_reserve_domain() expects benb3 to be in use.
+    register_or_fail('benb3', 3)
+
+
+# Each group is (name, setup function or None, list of test names).
+# Tests within a group run in order.
+TEST_GROUPS = [
+    ('reg', None, ['test_register', 'test_update', 'test_udp_protocol',
+                   'test_udp_protocol_v2', 'test_reconcile_dns']),
+    ('rcv', setup_recovery, ['test_recovery']),
+    ('rsv', setup_reserve_domain, ['test_reserve_domain']),
+]
+
+
+def timed(name, function):
+    '''Run function, and return a dict describing how it went.'''
+    start = time.time()
+    first_dns_wait = len(integration_tests.PROPAGATION_TIMINGS)
+    result = {'name': name, 'passed': True, 'error': None}
+    try:
+        function()
+    except Exception:
+        result['passed'] = False
+        result['error'] = traceback.format_exc()
+    result['seconds'] = time.time() - start
+    result['dns_waits'] = integration_tests.PROPAGATION_TIMINGS[first_dns_wait:]
+    return result
+
+
+def run_group(group):
+    '''Run one group of tests in this process. Returns a list of timings.'''
+    group_name, setup, test_names = group
+    # A short random suffix keeps each run's hostnames distinct, even
+    # if the app state was not reset in between.
+    namespace = group_name + uuid.uuid4().hex[:4]
+    cert_dir = tempfile.mkdtemp(prefix='sandcats-test-certs-%s-' % (namespace,))
+
+    results = []
+    try:
+        generate_client_certs(cert_dir)
+        integration_tests.use_namespace(namespace, cert_dir)
+
+        if setup is not None:
+            results.append(timed('%s:setup' % (group_name,), setup))
+            if not results[-1]['passed']:
+                return results
+
+        for test_name in test_names:
+            results.append(timed('%s:%s' % (group_name, test_name),
+                                 getattr(integration_tests, test_name)))
+            # Later tests in a group rely on earlier ones, so stop at
+            # the first failure.
+            if not results[-1]['passed']:
+                break
+    finally:
+        shutil.rmtree(cert_dir, ignore_errors=True)
+    return results
+
+
+def print_results(all_results, wall_seconds):
+    print
+    print '%-36s %8s  %s' % ('test', 'seconds', 'result')
+    for result in all_results:
+        print '%-36s %8.2f  %s' % (result['name'], result['seconds'],
+                                   'ok' if result['passed'] else 'FAILED')
+    total = sum(result['seconds'] for result in all_results)
+    print 'Wall time %.2f seconds; %.2f seconds of tests ran in parallel.' % (
+        wall_seconds, total)
+
+    dns_waits = [wait for result in all_results for wait in result['dns_waits']]
+    if dns_waits:
+        seconds = sorted(wait['seconds'] for wait in dns_waits)
+        print 'DNS propagation: %d waits, median %.3f s, max %.3f s, %.2f s in total.' % (
+            len(seconds), seconds[len(seconds) // 2], seconds[-1], sum(seconds))
+
+    for result in all_results:
+        if not result['passed']:
+            print
+            print '%s failed:' % (result['name'],)
+            print result['error']
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Run the integration tests in parallel.')
+    parser.add_argument('--reset-app-state', action='store_true',
+                        help='Reset sandcats before running the tests.')
+    parser.add_argument('--fast-reset', action='store_true',
+                        help='With --reset-app-state, reset in place instead of '
+                        'restarting services. Needs ALLOW_RESET_FOR_TESTING.')
+    parser.add_argument('--processes', type=int, default=len(TEST_GROUPS),
+                        help='How many groups to run at once.')
+    args = parser.parse_args(argv)
+
+    if args.reset_app_state:
+        if args.fast_reset:
+            integration_tests.reset_app_state_fast()
+        else:
+            integration_tests.reset_app_state()
+
+    # Start the one SMTP capture server that every group shares.
+    integration_tests.ensure_smtp_capture_server()
+
+    start = time.time()
+    pool = multiprocessing.Pool(args.processes)
+    try:
+        group_results = pool.map(run_group, TEST_GROUPS)
+    finally:
+        pool.close()
+        pool.join()
+    wall_seconds = time.time() - start
+
+    all_results = [result for results in group_results for result in results]
+    print_results(all_results, wall_seconds)
+    return 0 if all(result['passed'] for result in all_results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,11 +1,12 @@
-import contextlib
 import requests
 import netifaces
 import os
 import dns.resolver
+import hashlib
 import StringIO
 import time
 import socket
+import struct
 import subprocess
 import sys
 
@@ -22,59 +23,110 @@ if 'DEBUG' in os.environ:
 
 interface_cache = {}
 
+# The tests below refer to hostnames like "benb" through host(), and
+# to client certificates through CERT_DIR. By default, these are the
+# plain hostnames and test-data/. integration_test_runner.py calls
+# use_namespace() so that several groups of tests can run at once
+# against one sandcats without stepping on each other's hostnames or
+# keys.
+NAMESPACE = ''
+CERT_DIR = 'test-data'
+BASE_DOMAIN = 'sandcatz.io'
 
-# Now give the JS backend about 10 seconds to send the mail. Snag
-# its output.
-def get_recoveryToken_from_subprocess(p):
-    stdout, _ = p.communicate()
 
-    # Make sure it didn't blow up.
-    assert p.returncode == 0
+def use_namespace(namespace, cert_dir):
+    global NAMESPACE, CERT_DIR
+    NAMESPACE = namespace
+    CERT_DIR = cert_dir
 
-    for line in stdout.split('\n'):
-        if 'recoveryToken' in line:
-            recoveryToken = line.split('recoveryToken: ')[1].strip()
-            return recoveryToken
 
+def host(name):
+    '''Return the hostname the current test namespace uses for name.'''
+    if NAMESPACE:
+        return NAMESPACE + '-' + name
+    return name
 
-@contextlib.contextmanager
-def testing_smtpd():
-    # Create an SMTPd that listens on port 2500. This uses Python's
-    # multiprocessing library to shell out to Twisted+tac, and then
-    # parse its output, but it was the greatest combination of
-    # "quickest" and "most reasonable" thing I could do, given the
-    # rest of this code, so there you go.
 
-    # Start the process.
-    p = subprocess.Popen(
-        ['twistd', '-ny' 'testing_smtpd.py'],
-        stdout=subprocess.PIPE)
+def fqdn(name):
+    return host(name) + '.' + BASE_DOMAIN
 
-    # Add a busy-loop waiting at most 5 seconds for port 2500 to be
-    # available.
-    RESOLUTION=0.01
-    port_2500_was_opened = False
-    for i in range(int(5 * (1/RESOLUTION))):
-        try:
-            sock = socket.socket()
-            sock.connect(('127.0.0.1', 2500))
-            port_2500_was_opened = True
-            sock.close()
-        except socket.error:
-            time.sleep(RESOLUTION)
 
-    assert port_2500_was_opened
+# The tests read sandcats' outgoing email from smtp_capture_server.py,
+# which Meteor reaches at MAIL_URL=smtp://localhost:2500, and which we
+# query over HTTP.
+SMTP_CAPTURE_URL = 'http://127.0.0.1:2501'
+RECOVERY_TOKEN_EMAIL_SUBJECT = 'Recovering your domain name'
 
-    # Run whatever code we are context-managing, allowing that code to control the 'p'rocess.
-    yield p
 
-    # Finally, if the process is still around, teminate it so that we can start it again later if
-    # needed.
+def _smtp_capture_server_is_up():
     try:
-        p.terminate()
-    except OSError as e:
-        if e.errno != 3:
-            raise
+        requests.get(SMTP_CAPTURE_URL + '/health', timeout=1)
+        return True
+    except requests.exceptions.RequestException:
+        return False
+
+
+def ensure_smtp_capture_server():
+    '''Start smtp_capture_server.py, unless it is already running.
+
+    The server outlives the tests, so later runs (and other test
+    processes) reuse it rather than starting their own.'''
+    if _smtp_capture_server_is_up():
+        return
+    with open(os.devnull, 'w') as devnull:
+        subprocess.Popen([sys.executable, 'smtp_capture_server.py'],
+                         stdout=devnull, stderr=devnull,
+                         preexec_fn=os.setsid)
+    delay = 0.01
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        if _smtp_capture_server_is_up():
+            return
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
+    raise RuntimeError('smtp_capture_server.py did not start.')
+
+
+def last_captured_email_id():
+    '''Return the id of the newest captured email, for use as "after".'''
+    return requests.get(SMTP_CAPTURE_URL + '/health', timeout=5).json()['lastId']
+
+
+def wait_for_captured_email(after, timeout=10, **filters):
+    '''Return the first captured email newer than after that matches
+    filters (recipient, hostname, subject, recoveryToken), waiting up to
+    timeout seconds for it. Returns None if none arrives.'''
+    params = dict(filters, after=after, wait=timeout)
+    response = requests.get(SMTP_CAPTURE_URL + '/messages', params=params,
+                            timeout=timeout + 5)
+    messages = response.json()['messages']
+    if messages:
+        return messages[0]
+    return None
+
+
+def send_recovery_token(rawHostname):
+    '''Ask sandcats to email a recovery token for rawHostname, and
+    return the token from the captured email, or None if sandcats
+    declined to send one.'''
+    ensure_smtp_capture_server()
+    after = last_captured_email_id()
+    sandcats_response = _make_api_call(
+        path='sendrecoverytoken',
+        rawHostname=rawHostname,
+        key_number=None
+    )
+    # When rate-limited, sandcats still answers 200, but sends nothing,
+    # so don't sit through wait_for_captured_email()'s timeout.
+    if (sandcats_response.status_code != 200 or
+            'Sent a recovery token' not in sandcats_response.content):
+        return None
+    message = wait_for_captured_email(after, hostname=rawHostname.lower(),
+                                      subject=RECOVERY_TOKEN_EMAIL_SUBJECT)
+    if message is None:
+        return None
+    return message['recoveryToken']
+
 
 def make_url(path, external_ip=False):
     BASE_URL = ''
@@ -138,16 +190,20 @@ def _add_real_client_cert(n, requests_kwargs):
     requests_kwargs['verify'] = False  # Sad but useful for local testing.
     if n is None:
         return
-    requests_kwargs['cert'] = ('test-data/client-cert-%d.crt' % (n,),
-                               'test-data/client-cert-%d.key' % (n,))
+    requests_kwargs['cert'] = (os.path.join(CERT_DIR, 'client-cert-%d.crt' % (n,)),
+                               os.path.join(CERT_DIR, 'client-cert-%d.key' % (n,)))
 
 def _make_api_call(rawHostname, key_number, path='register',
                    provide_x_sandcats=True, external_ip=False,
                    http_method='post', accept_mime_type=None,
                    domainReservationToken=None,
                    email='benb@benb.org', recoveryToken=None,
-                   x_forwarded_for=None):
-    '''This internal helper function allows code-reuse within the tests.'''
+                   x_forwarded_for=None, session=None):
+    '''This internal helper function allows code-reuse within the tests.
+
+    If session is a requests.Session, the request goes through it, so
+    that repeated calls can reuse pooled HTTPS connections; see
+    api_load_test.py.'''
     submitted_form_data = {}
     if rawHostname is not None:
         submitted_form_data['rawHostname'] = rawHostname
@@ -183,26 +239,26 @@ def _make_api_call(rawHostname, key_number, path='register',
     add_key(key_number, requests_kwargs)
 
     if http_method in ('get', 'post'):
-        action = getattr(requests, http_method)
+        action = getattr(session or requests, http_method)
 
     return action(**requests_kwargs)
 
 def register_benb():
     return _make_api_call(
-        rawHostname='benb',
+        rawHostname=host('benb'),
         key_number=1)
 
 
 def register_benb2_missing_fingerprint():
     return _make_api_call(
-        rawHostname='ben-b2',
+        rawHostname=host('ben-b2'),
         key_number=None)
 
 
 def register_benb1_with_benb2_key():
     return _make_api_call(
         external_ip=True,
-        rawHostname='benb',
+        rawHostname=host('benb'),
         accept_mime_type='text/plain',
         key_number=2)
 
@@ -241,34 +297,34 @@ def register_two_hyphens_with_benb2_key():
 
 def register_benb2_successfully_text_plain():
     return _make_api_call(
-        rawHostname='ben-b2',
+        rawHostname=host('ben-b2'),
         accept_mime_type='text/plain',
         key_number=2)
 
 
 def register_benb2_reuse_benb_key():
     return _make_api_call(
-        rawHostname='ben-b2',
+        rawHostname=host('ben-b2'),
         key_number=1)
 
 
 def register_benb2_invalid_email():
     return _make_api_call(
-        rawHostname='ben-b2',
+        rawHostname=host('ben-b2'),
         email='benb@benb',
         key_number=2)
 
 
 def register_benb2_wrong_http_method():
     return _make_api_call(
-        rawHostname='ben-b2',
+        rawHostname=host('ben-b2'),
         http_method='get',
         key_number=2)
 
 
 def register_benb2_missing_sand_cats_header():
     return _make_api_call(
-        rawHostname='ben-b2',
+        rawHostname=host('ben-b2'),
         key_number=2,
         provide_x_sandcats=False)
 
@@ -279,7 +335,7 @@ def register_benb3_x_forwarded_for():
     #
     # FIXME: This doesn't pass, but for now, I'm not *that* worried.
     return _make_api_call(
-        rawHostname='benb3',
+        rawHostname=host('benb3'),
         key_number=3,
         x_forwarded_for='128.151.2.1')
 
@@ -288,7 +344,7 @@ def update_benb_good():
     return _make_api_call(
         path='update',
         external_ip=True,
-        rawHostname='benb',
+        rawHostname=host('benb'),
         key_number=1)
 
 
@@ -296,7 +352,7 @@ def update_benb2_with_benb1_key():
     return _make_api_call(
         path='update',
         external_ip=True,
-        rawHostname='ben-b2',
+        rawHostname=host('ben-b2'),
         key_number=1)
 
 
@@ -304,7 +360,7 @@ def update_benb2_caps_basically_good():
     return _make_api_call(
         path='update',
         external_ip=True,
-        rawHostname='BEN-B2',
+        rawHostname=host('BEN-B2'),
         x_forwarded_for='128.151.2.1',
         key_number=2)
 
@@ -317,15 +373,9 @@ def send_recovery_token_to_benb3():
     # provide to the "/recover" method.
     #
     # This function returns the recovery token so that later tests can
-    # use the token. To achieve that, we get the help of testing_smtpd()
-    # to listen on port 2500 and intercept the mail.
-    with testing_smtpd() as p:
-        sandcats_response = _make_api_call(
-            path='sendrecoverytoken',
-            rawHostname='benb3',
-            key_number=None
-        )
-        return get_recoveryToken_from_subprocess(p)
+    # use the token. To achieve that, we read the email back from
+    # smtp_capture_server.py.
+    return send_recovery_token(host('benb3'))
 
 
 def send_recovery_token_to_nonexistent():
@@ -334,7 +384,7 @@ def send_recovery_token_to_nonexistent():
     # registered.
     sandcats_response = _make_api_call(
         path='sendrecoverytoken',
-        rawHostname='nonexistent',
+        rawHostname=host('nonexistent'),
         accept_mime_type='text/plain',
         key_number=None
     )
@@ -344,13 +394,7 @@ def send_recovery_token_to_nonexistent():
 def send_recovery_token_to_benb():
     # This exists to support testing how many recoveryTokens can be
     # sent to one person in a short period of time.
-    with testing_smtpd() as p:
-        sandcats_response = _make_api_call(
-            path='sendrecoverytoken',
-            rawHostname='benb',
-            key_number=None
-        )
-        return get_recoveryToken_from_subprocess(p)
+    return send_recovery_token(host('benb'))
 
 
 def recover_benb3_with_fake_recovery_token_and_fresh_cert():
@@ -360,35 +404,29 @@ def recover_benb3_with_fake_recovery_token_and_fresh_cert():
         # passes the input validation, but is not a working recovery
         # token.
         recoveryToken='abcdefghijabcdefghijabcdefghijabcdefghij',
-        rawHostname='benb3',
+        rawHostname=host('benb3'),
         external_ip=True,
         key_number=4,
         accept_mime_type='text/plain')
 
 
 def recover_benb3_via_recovery_token_and_fresh_cert(recoveryToken, key_number=4):
-    with testing_smtpd() as p:
-        sandcats_response = _make_api_call(
-            path='recover',
-            recoveryToken=recoveryToken,
-            rawHostname='benb3',
-            external_ip=True,
-            key_number=key_number,
-            accept_mime_type='text/plain')
-
-        stdout, _ = p.communicate()
-
-        # Make sure the testing SMTPd didn't get upset.
-        assert p.returncode == 0
-
-        # In that case, provide the HTTP response.
-        return sandcats_response
+    # A successful recovery sends a confirmation email, so make sure
+    # something is listening for it.
+    ensure_smtp_capture_server()
+    return _make_api_call(
+        path='recover',
+        recoveryToken=recoveryToken,
+        rawHostname=host('benb3'),
+        external_ip=True,
+        key_number=key_number,
+        accept_mime_type='text/plain')
 
 
 def recover_benb3_with_fresh_cert_with_no_recovery_token():
     return _make_api_call(
         path='recover',
-        rawHostname='benb3',
+        rawHostname=host('benb3'),
         external_ip=True,
         key_number=4,
         accept_mime_type='text/plain')
@@ -397,7 +435,7 @@ def recover_benb3_with_fresh_cert_with_no_recovery_token():
 def recover_benb3_via_recovery_token_and_stale_cert(recoveryToken):
     return _make_api_call(
         path='recover',
-        rawHostname='benb3',
+        rawHostname=host('benb3'),
         external_ip=True,
         key_number=1,
         recoveryToken=recoveryToken,
@@ -408,7 +446,7 @@ def update_benb3_after_recovery(external_ip=True):
     return _make_api_call(
         path='update',
         external_ip=external_ip,
-        rawHostname='benb3',
+        rawHostname=host('benb3'),
         key_number=4,
         accept_mime_type='text/plain')
 
@@ -417,7 +455,7 @@ def reserve_benb4():
     return _make_api_call(
         path='reserve',
         provide_x_sandcats=False,
-        rawHostname='benb4',
+        rawHostname=host('benb4'),
         key_number=None)
 
 
@@ -431,6 +469,24 @@ def get_resolver():
     return resolver
 
 
+def reset_app_state_fast():
+    '''Reset sandcats in place, in well under a second.
+
+    This asks the running app to empty its MongoDB collections and
+    DNS records (see server/resetfortesting.js), then purges
+    PowerDNS's cache via its control socket. Nothing gets restarted.
+    The app only responds once it is ready for the next test.
+
+    It needs ALLOW_RESET_FOR_TESTING in the Meteor settings; "make
+    stage-allow-reset-for-testing" turns it on. Use reset_app_state()
+    for a from-scratch reset.'''
+    response = requests.post('http://127.0.0.1:3000/reset-for-testing', timeout=30)
+    assert response.status_code == 200, (
+        'Fast reset failed; is ALLOW_RESET_FOR_TESTING set? Try make '
+        'stage-allow-reset-for-testing. %s' % (response.content,))
+    subprocess.check_call(['sudo', 'pdns_control', 'purge'], stdout=open(os.devnull, 'w'))
+
+
 def reset_app_state():
     # To reset the Sandcats app, we must:
     # - Clear out Mongo, and
@@ -475,19 +531,82 @@ def reset_app_state():
     requests.get('http://localhost/', timeout=10)
 
 
-def wait_for_new_resolve_value(resolver, domain, rr_type, old_value):
-    SECONDS_TO_WAIT = 20
+# How long we wait for a DNS change to become visible, and how we poll
+# for it: starting after a few milliseconds, then backing off
+# exponentially up to DNS_WAIT_MAX_DELAY_SECONDS between queries.
+DNS_WAIT_TIMEOUT_SECONDS = 20
+DNS_WAIT_FIRST_DELAY_SECONDS = 0.005
+DNS_WAIT_MAX_DELAY_SECONDS = 1.0
+
+# Every wait_for_dns() call appends a dict here describing how long the
+# change took to show up in DNS, so that we can report real propagation
+# latency; see print_propagation_timings().
+PROPAGATION_TIMINGS = []
+
+
+def get_soa_serial(resolver):
+    return resolver.query(BASE_DOMAIN, 'SOA')[0].serial
+
+
+def wait_for_dns(description, predicate, resolver=None, soa_serial=None):
+    '''Call predicate() with exponential backoff until it returns True.
+
+    If soa_serial is provided, only call predicate() once the zone's
+    SOA serial has moved past it, since until then PowerDNS cannot have
+    the change we are waiting for.
+
+    Returns True if predicate() returned True within
+    DNS_WAIT_TIMEOUT_SECONDS, else False. Either way, records the
+    outcome in PROPAGATION_TIMINGS.'''
+    start = time.time()
+    deadline = start + DNS_WAIT_TIMEOUT_SECONDS
+    delay = DNS_WAIT_FIRST_DELAY_SECONDS
+    queries = 0
+    succeeded = False
+
+    while True:
+        serial_advanced = True
+        if soa_serial is not None:
+            queries += 1
+            serial_advanced = get_soa_serial(resolver) > soa_serial
+        if serial_advanced:
+            queries += 1
+            if predicate():
+                succeeded = True
+                break
+        if time.time() + delay > deadline:
+            break
+        time.sleep(delay)
+        delay = min(delay * 2, DNS_WAIT_MAX_DELAY_SECONDS)
+
+    PROPAGATION_TIMINGS.append({
+        'description': description,
+        'seconds': time.time() - start,
+        'queries': queries,
+        'succeeded': succeeded,
+    })
+    return succeeded
+
 
-    for i in range(SECONDS_TO_WAIT + 1):
+def print_propagation_timings():
+    if not PROPAGATION_TIMINGS:
+        return
+    print
+    print 'DNS propagation:'
+    for timing in PROPAGATION_TIMINGS:
+        print '  %-50s %7.3f s in %3d queries%s' % (
+            timing['description'], timing['seconds'], timing['queries'],
+            '' if timing['succeeded'] else ' (TIMED OUT)')
+
+
+def wait_for_new_resolve_value(resolver, domain, rr_type, old_value, soa_serial=None):
+    def value_changed():
         dns_response = resolver.query(domain, rr_type)
         # Yay, it didn't crash, so there is a response!
-        if str(dns_response.rrset) == old_value:
-            print '.',
-            time.sleep(1)
-        else:
-            # If the values are different, we can stop
-            # looping/sleeping.
-            break
+        return str(dns_response.rrset) != old_value
+
+    wait_for_dns('%s %s changed' % (domain, rr_type), value_changed,
+                 resolver=resolver, soa_serial=soa_serial)
 
     # Do one last query, and verify that it has some different value.
     dns_response = resolver.query(domain, rr_type)
@@ -495,19 +614,16 @@ def wait_for_new_resolve_value(resolver, domain, rr_type, old_value):
 
 
 def wait_for_nxdomain_cache_to_clear(resolver, domain, rr_type):
-    SECONDS_TO_WAIT = 20
-
-    for i in range(SECONDS_TO_WAIT + 1):
+    def resolves():
         try:
             resolver.query(domain, rr_type)
             # If we get this far, hooray, we are done waiting.
-            return
+            return True
         except dns.resolver.NXDOMAIN:
-            # Wait a sec, and let's retry.
-            print '.',
-            time.sleep(1)
+            return False
 
-    raise RuntimeError, "We waited a while but the NXDOMAIN did not go away."
+    if not wait_for_dns('%s %s appeared' % (domain, rr_type), resolves):
+        raise RuntimeError, "We waited a while but the NXDOMAIN did not go away."
 
 
 def assert_nxdomain(resolver, domain, rr_type):
@@ -557,11 +673,11 @@ def test_register():
     assert next_soa != initial_soa, next_soa
 
     # Make sure DNS is updated.
-    dns_response = resolver.query('benb.sandcatz.io', 'A')
-    assert str(dns_response.rrset) == 'benb.sandcatz.io. 60 IN A 127.0.0.1'
+    dns_response = resolver.query(fqdn('benb'), 'A')
+    assert str(dns_response.rrset) == '%s. 60 IN A 127.0.0.1' % (fqdn('benb'),)
 
-    dns_response = resolver.query('subdomain-test.benb.sandcatz.io', 'A')
-    assert str(dns_response.rrset) == 'subdomain-test.benb.sandcatz.io. 60 IN A 127.0.0.1'
+    dns_response = resolver.query('subdomain-test.' + fqdn('benb'), 'A')
+    assert str(dns_response.rrset) == 'subdomain-test.%s. 60 IN A 127.0.0.1' % (fqdn('benb'),)
 
     # Attempt to register a domain with no client certificate; get rejected.
     response = register_benb2_missing_fingerprint()
@@ -570,7 +686,7 @@ def test_register():
     assert (
         parsed_content['text'] ==
         'Your client is misconfigured. You need to provide a client certificate.')
-    assert_nxdomain(resolver, 'ben-b2.sandcatz.io', 'A')
+    assert_nxdomain(resolver, fqdn('ben-b2'), 'A')
 
     # Attempt to register ftp as a domain. This should fail, and if it
     # does successfully fail, then we can be reasonably confident that
@@ -603,7 +719,7 @@ def test_register():
         parsed_content['text'] ==
         'There is already a domain registered with this sandcats key. If you are re-installing, you can skip the Sandcats configuration process.'
     )
-    assert_nxdomain(resolver, 'ben-b2.sandcatz.io', 'A')
+    assert_nxdomain(resolver, fqdn('ben-b2'), 'A')
 
     # Attempt to register benb2 with a bad email address.
     response = register_benb2_invalid_email()
@@ -613,7 +729,7 @@ def test_register():
         parsed_content['text'] ==
         'Please enter a valid email address.'
     ), parsed_content['text']
-    assert_nxdomain(resolver, 'ben-b2.sandcatz.io', 'A')
+    assert_nxdomain(resolver, fqdn('ben-b2'), 'A')
 
     # Attempt to do a GET to /register. Get rejected since /register always
     # wants a POST.
@@ -623,7 +739,7 @@ def test_register():
     assert (
         parsed_content['text'] ==
         'Must POST.')
-    assert_nxdomain(resolver, 'ben-b2.sandcatz.io', 'A')
+    assert_nxdomain(resolver, fqdn('ben-b2'), 'A')
 
     # Attempt to do a POST without the X-Sand: cats header; refuse to
     # process the request.  This is an anti-cross-site-request forgery
@@ -635,7 +751,7 @@ def test_register():
     assert (
         parsed_content['text'] ==
         'Your client is misconfigured. You need X-Sand: cats')
-    assert_nxdomain(resolver, 'ben-b2.sandcatz.io', 'A')
+    assert_nxdomain(resolver, fqdn('ben-b2'), 'A')
 
     # Attempt to register a domain by providing an X-Forwarded-For
     # header that is set to a forged source address. The registration
@@ -644,8 +760,8 @@ def test_register():
     response = register_benb3_x_forwarded_for()
     assert response.status_code == 200, response.content
 
-    dns_response = resolver.query('benb3.sandcatz.io', 'A')
-    assert str(dns_response.rrset) == 'benb3.sandcatz.io. 60 IN A 127.0.0.1'
+    dns_response = resolver.query(fqdn('benb3'), 'A')
+    assert str(dns_response.rrset) == '%s. 60 IN A 127.0.0.1' % (fqdn('benb3'),)
 
     # Using the benb2 key, attempt to steal benb's DNS domain.
     response = register_benb1_with_benb2_key()
@@ -657,9 +773,9 @@ def test_register():
     assert response.status_code == 200, response.content
     assert response.headers['Content-Type'] == 'text/plain'
     assert response.content == 'Successfully registered!'
-    wait_for_nxdomain_cache_to_clear(resolver, 'ben-b2.sandcatz.io', 'A')
-    dns_response = resolver.query('ben-b2.sandcatz.io', 'A')
-    assert str(dns_response.rrset) == 'ben-b2.sandcatz.io. 60 IN A 127.0.0.1'
+    wait_for_nxdomain_cache_to_clear(resolver, fqdn('ben-b2'), 'A')
+    dns_response = resolver.query(fqdn('ben-b2'), 'A')
+    assert str(dns_response.rrset) == '%s. 60 IN A 127.0.0.1' % (fqdn('ben-b2'),)
 
 
 def test_reserve_domain():
@@ -674,11 +790,11 @@ def test_reserve_domain():
     assert response.status_code == 400, response.content
 
     # Expect error for a domain name that is already in use.
-    response = _make_api_call(path='reserve', key_number=None, rawHostname='benb3')
+    response = _make_api_call(path='reserve', key_number=None, rawHostname=host('benb3'))
     assert response.status_code == 400, response.content
 
     # Expect error for a domain name that is not in use, but forgot to submit email address.
-    response = _make_api_call(path='reserve', key_number=None, email=None, rawHostname='benb4')
+    response = _make_api_call(path='reserve', key_number=None, email=None, rawHostname=host('benb4'))
     assert response.status_code == 400, response.content
 
     # Expect success for an unreserved & unused domain.
@@ -692,7 +808,7 @@ def test_reserve_domain():
     assert cors_header == '*', cors_header
 
     # Expect error attempting to call /register on a reserved domain.
-    response = _make_api_call(path='register', rawHostname='benb4', key_number=5)
+    response = _make_api_call(path='register', rawHostname=host('benb4'), key_number=5)
     assert response.status_code == 400, response.content
 
     # Expect error for reserving the same domain again.
@@ -706,13 +822,13 @@ def test_reserve_domain():
     # Demonstrate that /recover returns status 400 for both the wrong token and the "right" token.
     response = _make_api_call(path='recover',
                               recoveryToken=('a' * 40),
-                              rawHostname='benb4',
+                              rawHostname=host('benb4'),
                               key_number=5)
     assert response.status_code == 400, response.content
 
     response = _make_api_call(path='recover',
                               recoveryToken=token,
-                              rawHostname='benb4',
+                              rawHostname=host('benb4'),
                               key_number=5)
     assert response.status_code == 400, response.content
 
@@ -720,13 +836,13 @@ def test_reserve_domain():
     # Demonstrate that /registerreserved returns 400 for wrong token and 200 for right token.
     response = _make_api_call(path='registerreserved',
                               domainReservationToken=('a' * 40),
-                              rawHostname='benb4',
+                              rawHostname=host('benb4'),
                               key_number=5)
     assert response.status_code == 400, response.content
 
     response = _make_api_call(path='registerreserved',
                               domainReservationToken=token,
-                              rawHostname='benb4',
+                              rawHostname=host('benb4'),
                               key_number=5)
     assert response.status_code == 200, response.content
 
@@ -807,9 +923,9 @@ def test_recovery():
     # Make sure DNS is updated.
     resolver = get_resolver()
     wait_for_new_resolve_value(resolver,
-                               'benb3.sandcatz.io',
+                               fqdn('benb3'),
                                'A',
-                               'benb3.sandcatz.io. 60 IN A 127.0.0.1')
+                               '%s. 60 IN A 127.0.0.1' % (fqdn('benb3'),))
     # Now, let's set benb3 back to 127.0.0.1, so the rest of the test
     # suite doesn't get surprised.
     response = update_benb3_after_recovery(external_ip=False)
@@ -823,14 +939,17 @@ def test_update():
     # Get a resolver that will query 127.0.0.1.
     resolver = get_resolver()
 
-    # Update the "benb" subdomain.
+    # Update the "benb" subdomain. The new A record can only show up
+    # once the SOA serial has moved past this one.
+    soa_serial = get_soa_serial(resolver)
     response = update_benb_good()
     assert response.status_code == 200, response.content
     # Make sure DNS is updated.
     wait_for_new_resolve_value(resolver,
-                               'benb.sandcatz.io',
+                               fqdn('benb'),
                                'A',
-                               'benb.sandcatz.io. 60 IN A 127.0.0.1')
+                               '%s. 60 IN A 127.0.0.1' % (fqdn('benb'),),
+                               soa_serial=soa_serial)
 
     # Use key 1 to update "benb2", which should be rejected due to
     # being unauthorized.
@@ -841,13 +960,15 @@ def test_update():
 
     # Test that we can do an update of benb2 even though for some
     # reason the client is giving us the rawHostname as all caps.
+    soa_serial = get_soa_serial(resolver)
     response = update_benb2_caps_basically_good()
     assert response.status_code == 200, response.content
     # Make sure DNS is updated.
     wait_for_new_resolve_value(resolver,
-                               'ben-b2.sandcatz.io',
+                               fqdn('ben-b2'),
                                'A',
-                               'ben-b2.sandcatz.io. 60 IN A 127.0.0.1')
+                               '%s. 60 IN A 127.0.0.1' % (fqdn('ben-b2'),),
+                               soa_serial=soa_serial)
 
 
 def test_udp_protocol():
@@ -860,7 +981,7 @@ def test_udp_protocol():
     # checks that it gets a response within one second.
     UDP_DEST_IP = '127.0.0.1'
     UDP_DEST_PORT = 8080
-    message = 'benb 0123456789abcdef'
+    message = host('benb') + ' 0123456789abcdef'
     try:
         client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         client.sendto(message, (UDP_DEST_IP, UDP_DEST_PORT))
@@ -874,7 +995,7 @@ def test_udp_protocol():
     # Now, make sure that benb3 would not be surprised by messages
     # from localhost. Use a slightly different constant so we know
     # we're not being somehow fooled by duplicate messages.
-    message = 'benb3 abcdef0123456789'
+    message = host('benb3') + ' abcdef0123456789'
     try:
         client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         client.sendto(message, (UDP_DEST_IP, UDP_DEST_PORT))
@@ -888,9 +1009,93 @@ def test_udp_protocol():
         client.close()
 
 
+def make_udp_ping_v2(pings):
+    """Build a version 2 UDP ping packet from (hostname, challenge)
+    pairs. See sandcats/lib/udppingprotocol.js."""
+    packet = struct.pack('BBB', 2, 0, len(pings))
+    for hostname, challenge in pings:
+        packet += hashlib.sha256(hostname).digest()[:8] + challenge
+    return packet
+
+
+def test_udp_protocol_v2():
+    # Like test_udp_protocol(), but with the binary format, and both
+    # pings in one packet: benb was moved to the other IP address, so
+    # we expect one reply carrying only its challenge, and not
+    # benb3's.
+    UDP_DEST_IP = '127.0.0.1'
+    UDP_DEST_PORT = 8080
+    message = make_udp_ping_v2([(host('benb'), 'v2-benb-01234567'),
+                                (host('benb3'), 'v2-benb3-0123456')])
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        client.sendto(message, (UDP_DEST_IP, UDP_DEST_PORT))
+        client.settimeout(1)
+        data = client.recv(1024)
+        assert data == struct.pack('BB', 2, 1) + 'v2-benb-01234567', repr(data)
+    except socket.timeout:
+        assert False, "Hit timeout without a reply. How sad."
+    finally:
+        client.close()
+
+    # With only benb3 in the packet, there is nothing to say.
+    message = make_udp_ping_v2([(host('benb3'), 'v2-benb3-abcdef0')])
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        client.sendto(message, (UDP_DEST_IP, UDP_DEST_PORT))
+        client.settimeout(1)
+        data = client.recv(1024)
+        assert False, "We were hoping for no response, but got " + repr(data)
+    except socket.timeout:
+        print "."
+    finally:
+        client.close()
+
+
+def mysql_records(name):
+    """Return the (type, content) of each PowerDNS record called name."""
+    output = subprocess.check_output([
+        'mysql', '-uroot', '--batch', '--skip-column-names', 'sandcats_pdns',
+        '-e', "SELECT type, content FROM records WHERE name = '%s'" % (name,)])
+    return sorted(tuple(line.split('\t')) for line in output.splitlines())
+
+
+def reconcile_dns(**options):
+    response = requests.post('http://127.0.0.1:3000/reconcile-dns', data=options, timeout=60)
+    assert response.status_code == 200, response.content
+    return response.json()
+
+
+def test_reconcile_dns():
+    # Lose benb3's A records, as if MySQL had lost them, and check that
+    # reconciling with MongoDB finds and restores them.
+    records = mysql_records(fqdn('benb3'))
+    assert records, 'Expected benb3 to have records to lose.'
+    subprocess.check_call([
+        'mysql', '-uroot', 'sandcats_pdns', '-e',
+        "DELETE FROM records WHERE name IN ('%s', '*.%s')" % (fqdn('benb3'), fqdn('benb3'))])
+
+    report = reconcile_dns(dryRun=1)
+    assert report['hostnamesMissing'] >= 1, report
+    assert report['hostnamesRepaired'] == 0, report
+    assert mysql_records(fqdn('benb3')) == []
+
+    report = reconcile_dns()
+    assert report['hostnamesRepaired'] >= 1, report
+    assert mysql_records(fqdn('benb3')) == records
+    assert mysql_records('*.' + fqdn('benb3')) == records
+
+    # Now there is nothing left to do for benb3.
+    report = reconcile_dns(dryRun=1)
+    assert host('benb3') not in report['examples']['missing'], report
+
+
 if __name__ == '__main__':
     if '--reset-app-state' in sys.argv:
-        reset_app_state()
+        if '--fast' in sys.argv:
+            reset_app_state_fast()
+        else:
+            reset_app_state()
         sys.exit(0)
 
     test_register()
@@ -898,3 +1103,6 @@ if __name__ == '__main__':
     test_update()
     test_reserve_domain()
     test_udp_protocol()
+    test_udp_protocol_v2()
+    test_reconcile_dns()
+    print_propagation_timings()
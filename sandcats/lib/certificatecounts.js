@@ -0,0 +1,89 @@
+// This file keeps CertificateDailyCounts up to date, and uses it to
+// count issued certificates quickly.
+//
+// Counting "every certificate issued up to date X" straight from
+// CertificateRequests gets slower as the history grows. Instead, we add
+// one to a per-day counter as each certificate arrives, and add up the
+// counters for the whole days before X. Only the day containing X
+// itself needs a real query, which is bounded by one day of
+// certificates.
+
+function utcDayString(date) {
+  return date.toISOString().split("T")[0];
+}
+
+function startOfUtcDay(date) {
+  return new Date(utcDayString(date) + "T00:00:00Z");
+}
+
+function dailyCountId(devOrProd, day) {
+  return devOrProd + "-" + day;
+}
+
+// Call this once per certificate we receive from GlobalSign.
+countCertificateIssued = function(devOrProd, receivedCertificateDate) {
+  var day = utcDayString(receivedCertificateDate);
+  CertificateDailyCounts.upsert(dailyCountId(devOrProd, day), {
+    $inc: {count: 1},
+    $setOnInsert: {devOrProd: devOrProd, day: day}
+  });
+};
+
+// How many certificates we received for devOrProd at or before
+// endDate.
+countCertificatesIssuedUpTo = function(devOrProd, endDate) {
+  var total = 0;
+  CertificateDailyCounts.find({
+    devOrProd: devOrProd,
+    day: {$lt: utcDayString(endDate)}
+  }, {fields: {count: 1}}).forEach(function(doc) {
+    total += doc.count;
+  });
+
+  total += CertificateRequests.find({
+    devOrProd: devOrProd, globalsignCertificateInfo: {$exists: true},
+    receivedCertificateDate: {$gte: startOfUtcDay(endDate), $lte: endDate}
+  }).count();
+  return total;
+};
+
+// How many certificates we received for devOrProd between startDate
+// and endDate, inclusive.
+countCertificatesIssuedBetween = function(devOrProd, startDate, endDate) {
+  return (countCertificatesIssuedUpTo(devOrProd, endDate) -
+          countCertificatesIssuedUpTo(devOrProd, new Date(startDate.getTime() - 1)));
+};
+
+// Recompute CertificateDailyCounts from CertificateRequests. This
+// reads every issued certificate once, but only keeps one counter per
+// day in memory. Returns the number of days counted.
+rebuildCertificateDailyCounts = function() {
+  var counts = {};
+  CertificateRequests.find({
+    globalsignCertificateInfo: {$exists: true},
+    receivedCertificateDate: {$exists: true}
+  }, {fields: {devOrProd: 1, receivedCertificateDate: 1}}).forEach(function(doc) {
+    var id = dailyCountId(doc.devOrProd, utcDayString(doc.receivedCertificateDate));
+    counts[id] = counts[id] || {
+      devOrProd: doc.devOrProd,
+      day: utcDayString(doc.receivedCertificateDate),
+      count: 0
+    };
+    counts[id].count += 1;
+  });
+
+  CertificateDailyCounts.remove({});
+  _.each(counts, function(doc, id) {
+    CertificateDailyCounts.upsert(id, {$set: doc});
+  });
+  return _.size(counts);
+};
+
+// Fill in CertificateDailyCounts the first time we run with it.
+ensureCertificateDailyCounts = function() {
+  if (CertificateDailyCounts.find().count() > 0) {
+    return;
+  }
+  var days = rebuildCertificateDailyCounts();
+  console.log("Backfilled certificate counts for", days, "days.");
+};
@@ -20,6 +20,7 @@ var recoveryTokenSchema = new SimpleSchema({
   }
 });
 
+// The indexes on these collections are declared in server/indexes.js.
 UserRegistrations = new Mongo.Collection("userRegistrations");
 UserRegistrations.attachSchema(new SimpleSchema({
   hostname: hostnameType,
@@ -34,6 +35,18 @@ UserRegistrations.attachSchema(new SimpleSchema({
     // FIXME: Somewhere we might want to make sure this is not a
     // "private IP"? Or not. Maybe we don't care.
   },
+  ipAddressChangedAt: {
+    // When ipAddress last changed, or when we registered the
+    // hostname. The longer ago this is, the longer the DNS TTL we
+    // publish; see server/dnsttl.js.
+    type: Date,
+    optional: true
+  },
+  dnsTtl: {
+    // The TTL, in seconds, of the A records we last published.
+    type: Number,
+    optional: true
+  },
   publicKeyId: {
     type: String,
     min: 40,
@@ -134,5 +147,62 @@ CertificateRequests.attachSchema(new SimpleSchema({
   receivedCertificateDate: {
     type: Date,
     optional: true
+  },
+  // globalsignCertificateInfo.StartDate and EndDate, parsed, so that we
+  // can count currently-valid certificates with an indexed query. They
+  // are missing if GlobalSign sent dates we could not parse.
+  certificateStartDate: {
+    type: Date,
+    optional: true
+  },
+  certificateEndDate: {
+    type: Date,
+    optional: true
+  },
+  // Set by migrateCertificateValidityDates() on certificates whose
+  // dates it could not parse, so that it doesn't try them again.
+  certificateValidityDatesUnparseable: {
+    type: Boolean,
+    optional: true
+  }
+}));
+
+// Events recorded by the "mongo" rate limiter store; see
+// ratelimiter.js. A TTL index on timestamp removes them once they are
+// too old to matter.
+RateLimitEvents = new Mongo.Collection("rateLimitEvents");
+RateLimitEvents.attachSchema(new SimpleSchema({
+  key: {
+    type: String
+  },
+  timestamp: {
+    type: Date
+  }
+}));
+
+// How many certificates we received from GlobalSign each day, per
+// devOrProd, so reports can add up totals without counting every
+// CertificateRequest ever. The _id is devOrProd + "-" + day; see
+// certificatecounts.js.
+CertificateDailyCounts = new Mongo.Collection("certificateDailyCounts");
+CertificateDailyCounts.attachSchema(new SimpleSchema({
+  devOrProd: {
+    type: String,
+    allowedValues: ["dev", "prod"]
+  },
+  day: {
+    // The UTC date, as YYYY-MM-DD, so that days sort as strings.
+    type: String,
+    min: 10,
+    max: 10
+  },
+  count: {
+    type: Number,
+    // countCertificateIssued() creates each counter with an upsert that
+    // only sets count through $inc, and simple-schema checks an upsert's
+    // required keys in $set and $setOnInsert alone. A defaultValue
+    // would not help, since it would $setOnInsert the same key that
+    // $inc touches, which MongoDB refuses.
+    optional: true
   }
 }));
@@ -12,17 +12,58 @@ function formatSoaRecord(primaryNameServer, adminEmailUsingDots, serialNumber,
 
 // Functions that communicate with the MySQL PowerDNS database.
 createWrappedQuery = function() {
-  var mysql = Meteor.npmRequire('mysql');
-  var connectionPool =
-      mysql.createPool({
-        connectionLimit: 5,
-        host: 'localhost',
-        user: Meteor.settings.POWERDNS_USER,
-        database: Meteor.settings.POWERDNS_DB,
-        password: Meteor.settings.POWERDNS_PASSWORD});
-
-  wrappedQuery = Meteor.wrapAsync(connectionPool.query, connectionPool);
-  return wrappedQuery;
+  // See mysqlpool.js for the health checks and metrics.
+  return makeMysqlPool({
+    connectionLimit: Meteor.settings.MYSQL_CONNECTION_LIMIT,
+    queueLimit: Meteor.settings.MYSQL_QUEUE_LIMIT,
+    validateIdleMilliseconds: Meteor.settings.MYSQL_VALIDATE_IDLE_MILLISECONDS,
+    host: 'localhost',
+    user: Meteor.settings.POWERDNS_USER,
+    database: Meteor.settings.POWERDNS_DB,
+    password: Meteor.settings.POWERDNS_PASSWORD});
+};
+
+// Run callback(transactionQuery) inside a MySQL transaction on one
+// connection from the pool. transactionQuery has the same interface as
+// mysqlQuery. If the callback throws, we roll back and re-throw.
+withMysqlTransaction = function(mysqlQuery, callback) {
+  var connection = mysqlQuery.getConnection();
+  var transactionQuery = mysqlQuery.connectionQuery(connection);
+  var failure = null;
+  try {
+    transactionQuery("START TRANSACTION");
+    var result = callback(transactionQuery);
+    transactionQuery("COMMIT");
+    return result;
+  } catch (e) {
+    failure = e;
+    try {
+      transactionQuery("ROLLBACK");
+    } catch (rollbackError) {
+      console.error("Failed to roll back transaction", rollbackError);
+    }
+    throw e;
+  } finally {
+    // If the connection died, this throws it away instead of
+    // returning it to the pool.
+    mysqlQuery.releaseConnection(connection, failure);
+  }
+};
+
+// Like globalsign.js's _clients, _domainIds caches data to avoid
+// unnecessary queries. The id of a row in the `domains` table never
+// changes, so we look it up once per domain. Don't access _domainIds
+// directly; access it via getDomainId().
+var _domainIds = {};
+getDomainId = function(mysqlQuery, domain) {
+  if (! _domainIds[domain]) {
+    var rows = mysqlQuery("SELECT `id` FROM `domains` WHERE `name` = ?", [domain]);
+    if (rows.length !== 1) {
+      throw new Error("Expected exactly one domain called " + domain + "; found " + rows.length);
+    }
+    _domainIds[domain] = rows[0].id;
+  }
+  return _domainIds[domain];
 };
 
 createDomainIfNeeded = function(mysqlQuery) {
@@ -61,43 +102,232 @@ deleteRecordIfExists = function (wrappedQuery, domain, bareHost) {
   }
 };
 
-publishOneUserRegistrationToDns = function(mysqlQuery, hostname, ipAddress) {
+publishOneUserRegistrationToDns = function(mysqlQuery, hostname, ipAddress, ttl) {
   // Given a hostname, and an IP address, we set up wildcard
-  // records accordingly in the PowerDNS database.
+  // records accordingly in the PowerDNS database, with a TTL of ttl
+  // seconds. See dnsttl.js for how we pick it.
   //
   // Note that PowerDNS will cache DNS queries for ~20 seconds
   // (configurable) before it actually queries the SQL database to
   // find out what the new value is. This is on top of any TTL in
   // the DNS record itself, as I understand it.
-  deleteRecordIfExists(mysqlQuery, Meteor.settings.BASE_DOMAIN, hostname);
+  //
+  // If DNS_PUBLISH_BATCH_MILLISECONDS is configured, we hand the
+  // change to DnsPublisher, which combines it with other pending
+  // changes into one transaction. Either way, this function returns
+  // once the change is committed.
+  if (Meteor.settings.DNS_PUBLISH_BATCH_MILLISECONDS) {
+    DnsPublisher.publishUserRegistration(hostname, ipAddress, ttl);
+    return;
+  }
 
-  // Create the DNS records in the table. We would do well to bump the
-  // SOA, too.
-  rawCreateRecord(mysqlQuery, Meteor.settings.BASE_DOMAIN, hostname + '.' + Meteor.settings.BASE_DOMAIN, 'A', ipAddress);
-  rawCreateRecord(mysqlQuery, Meteor.settings.BASE_DOMAIN, '*.' + hostname + '.' + Meteor.settings.BASE_DOMAIN, 'A', ipAddress);
-  bumpSoaRecord(mysqlQuery, Meteor.settings.BASE_DOMAIN);
+  withMysqlTransaction(mysqlQuery, function(transactionQuery) {
+    publishUserRegistrationsToDns(transactionQuery, [
+      {hostname: hostname, ipAddress: ipAddress, ttl: ttl}]);
+  });
 }
 
-function deleteSpecialHostRecords(wrappedQuery, domain, host) {
-  var result = wrappedQuery(
-    "DELETE from `records` WHERE (domain_id = (SELECT `id` from `domains` WHERE `name` = ?)) AND " +
-      "name = ?",
-    [domain, host]);
-  console.log("Successfully deleted record(s) for " + host + "." + "with status " + JSON.stringify(result) + ".");
-};
+// Maximum number of hostnames to put in one DELETE or INSERT
+// statement, so that we stay well clear of MySQL's max_allowed_packet.
+var MAX_HOSTNAMES_PER_STATEMENT = 500;
 
-publishAcmeChallengeToDns = function(mysqlQuery, hostname, value) {
-  // Push two TXT records to _acme-challenge.hostname.
+// Replace the A and wildcard A records for each {hostname, ipAddress,
+// ttl} in registrations. Returns nothing.
+//
+// Like deleteRecordIfExists(), this deletes *all* records for each
+// host, of any type or content.
+function writeUserRegistrationRecords(mysqlQuery, domain, domainId, registrations) {
+  for (var start = 0; start < registrations.length; start += MAX_HOSTNAMES_PER_STATEMENT) {
+    var chunk = registrations.slice(start, start + MAX_HOSTNAMES_PER_STATEMENT);
+    var names = [];
+    var rows = [];
+    chunk.forEach(function(registration) {
+      var bareHost = registration.hostname;
+      if (! bareHost || bareHost.match(/[.]/)) {
+        throw new Error("bareHost needs to be a string with no dot inside it.");
+      }
+      var host = bareHost + '.' + domain;
+      var wildcardHost = '*.' + host;
+      names.push(host, wildcardHost);
+      var ttl = registration.ttl || SHORT_DNS_TTL_SECONDS;
+      rows.push([domainId, host, 'A', registration.ipAddress, ttl]);
+      rows.push([domainId, wildcardHost, 'A', registration.ipAddress, ttl]);
+    });
 
-  var txtHost = '_acme-challenge.' + hostname + '.' + Meteor.settings.BASE_DOMAIN;
+    mysqlQuery(
+      "DELETE FROM `records` WHERE domain_id = ? AND name IN (?)",
+      [domainId, names]);
+    mysqlQuery(
+      "INSERT INTO `records` (domain_id, name, type, content, ttl) VALUES ?",
+      [rows]);
+  }
+}
 
-  if (value) {
-    rawCreateRecord(mysqlQuery, Meteor.settings.BASE_DOMAIN, txtHost, 'TXT', value);
-  } else {
-    deleteSpecialHostRecords(mysqlQuery, Meteor.settings.BASE_DOMAIN, txtHost);
+var ACME_CHALLENGE_PREFIX = '_acme-challenge.';
+// The same, as a LIKE pattern; "_" is a wildcard in LIKE, so we escape it.
+var ACME_CHALLENGE_LIKE_PATTERN = '\\_acme-challenge.%';
+
+// Apply changes to _acme-challenge TXT records. Each change is
+// {hostname, clearFirst, values}: if clearFirst, delete the
+// hostname's TXT records; then add a TXT record for each of values,
+// unless an identical one exists already. Returns {inserted,
+// duplicatesSkipped}.
+//
+// We store when we added each record in change_date, so that
+// expireStaleAcmeChallenges() can clean up after clients that never
+// clear their challenges.
+function writeAcmeChallengeRecords(mysqlQuery, domain, domainId, changes) {
+  var now = Math.floor(Date.now() / 1000);
+  var result = {inserted: 0, duplicatesSkipped: 0};
+
+  for (var start = 0; start < changes.length; start += MAX_HOSTNAMES_PER_STATEMENT) {
+    var chunk = changes.slice(start, start + MAX_HOSTNAMES_PER_STATEMENT);
+    var namesToClear = [];
+    var namesToAddTo = [];
+    var wanted = [];
+    chunk.forEach(function(change) {
+      var bareHost = change.hostname;
+      if (! bareHost || bareHost.match(/[.]/)) {
+        throw new Error("bareHost needs to be a string with no dot inside it.");
+      }
+      var txtHost = ACME_CHALLENGE_PREFIX + bareHost + '.' + domain;
+      if (change.clearFirst) {
+        namesToClear.push(txtHost);
+      }
+      if (change.values.length > 0) {
+        namesToAddTo.push(txtHost);
+      }
+      change.values.forEach(function(value) {
+        wanted.push([txtHost, value]);
+      });
+    });
+
+    if (namesToClear.length > 0) {
+      mysqlQuery(
+        "DELETE FROM `records` WHERE domain_id = ? AND type = 'TXT' AND name IN (?)",
+        [domainId, namesToClear]);
+    }
+    if (wanted.length === 0) {
+      continue;
+    }
+
+    // Skip challenges that are already published.
+    var existing = Object.create(null);
+    mysqlQuery(
+      "SELECT name, content FROM `records` WHERE domain_id = ? AND type = 'TXT' AND name IN (?)",
+      [domainId, namesToAddTo]).forEach(function(row) {
+        existing[row.name + '\n' + row.content] = true;
+      });
+    var rows = [];
+    wanted.forEach(function(nameAndValue) {
+      if (existing[nameAndValue[0] + '\n' + nameAndValue[1]]) {
+        result.duplicatesSkipped += 1;
+        return;
+      }
+      rows.push([domainId, nameAndValue[0], 'TXT', nameAndValue[1], now]);
+    });
+    if (rows.length > 0) {
+      mysqlQuery(
+        "INSERT INTO `records` (domain_id, name, type, content, change_date) VALUES ?",
+        [rows]);
+      result.inserted += rows.length;
+    }
   }
+  return result;
 }
 
+// Publish a batch of DNS changes, then bump the SOA once. Callers
+// should run this inside withMysqlTransaction() so that DNS never sees
+// a half-done batch.
+//
+// registrations is a list of {hostname, ipAddress, ttl}; see
+// writeUserRegistrationRecords(). acmeChallenges is a list of
+// {hostname, clearFirst, values}; see writeAcmeChallengeRecords().
+publishDnsBatch = function(mysqlQuery, registrations, acmeChallenges) {
+  var domain = Meteor.settings.BASE_DOMAIN;
+  var domainId = getDomainId(mysqlQuery, domain);
+
+  writeUserRegistrationRecords(mysqlQuery, domain, domainId, registrations);
+  var acmeResult = writeAcmeChallengeRecords(mysqlQuery, domain, domainId, acmeChallenges);
+
+  bumpSoaRecord(mysqlQuery, domain);
+  if (registrations.length > 0) {
+    console.log("Successfully published " + registrations.length + " hostname(s) to DNS.");
+  }
+  if (acmeChallenges.length > 0) {
+    console.log("Successfully published ACME challenge changes for " + acmeChallenges.length +
+                " hostname(s) to DNS; " + acmeResult.duplicatesSkipped +
+                " duplicate challenge(s) skipped.");
+  }
+  return acmeResult;
+};
+
+publishUserRegistrationsToDns = function(mysqlQuery, registrations) {
+  // Given a list of {hostname, ipAddress, ttl} objects, replace the A and
+  // wildcard A records for each hostname, then bump the SOA once.
+  return publishDnsBatch(mysqlQuery, registrations, []);
+};
+
+publishAcmeChallengeToDns = function(mysqlQuery, hostname, value) {
+  // Add a TXT record with value to _acme-challenge.hostname, or, if
+  // value is empty, remove all of them. Like
+  // publishOneUserRegistrationToDns(), this goes through DnsPublisher
+  // if batching is configured, and returns once the change is
+  // committed.
+  if (Meteor.settings.DNS_PUBLISH_BATCH_MILLISECONDS) {
+    DnsPublisher.publishAcmeChallenge(hostname, value);
+    return;
+  }
+
+  withMysqlTransaction(mysqlQuery, function(transactionQuery) {
+    publishDnsBatch(transactionQuery, [], [
+      {hostname: hostname, clearFirst: ! value, values: value ? [value] : []}]);
+  });
+};
+
+// By default, ACME challenges expire after an hour; Let's Encrypt
+// checks them within minutes.
+var DEFAULT_ACME_CHALLENGE_MAX_AGE_SECONDS = 60 * 60;
+var ACME_CHALLENGE_EXPIRY_INTERVAL_MILLISECONDS = 5 * 60 * 1000;
+
+// Call expireStaleAcmeChallenges() every few minutes.
+startExpiringStaleAcmeChallenges = function(mysqlQuery) {
+  var maxAgeSeconds = (Meteor.settings.ACME_CHALLENGE_MAX_AGE_SECONDS ||
+                       DEFAULT_ACME_CHALLENGE_MAX_AGE_SECONDS);
+  Meteor.setInterval(function() {
+    try {
+      expireStaleAcmeChallenges(mysqlQuery, maxAgeSeconds);
+    } catch (e) {
+      console.error("Failed to expire stale ACME challenges", e);
+    }
+  }, ACME_CHALLENGE_EXPIRY_INTERVAL_MILLISECONDS);
+};
+
+// Delete _acme-challenge TXT records older than maxAgeSeconds, since
+// clients don't always remove their challenges. Records from before
+// we set change_date get the current time, and so expire
+// maxAgeSeconds from now. Returns the number of records deleted.
+expireStaleAcmeChallenges = function(mysqlQuery, maxAgeSeconds) {
+  return withMysqlTransaction(mysqlQuery, function(transactionQuery) {
+    var domain = Meteor.settings.BASE_DOMAIN;
+    var domainId = getDomainId(transactionQuery, domain);
+    var now = Math.floor(Date.now() / 1000);
+    transactionQuery(
+      "UPDATE `records` SET change_date = ? WHERE domain_id = ? AND type = 'TXT' AND " +
+        "name LIKE ? AND change_date IS NULL",
+      [now, domainId, ACME_CHALLENGE_LIKE_PATTERN]);
+    var result = transactionQuery(
+      "DELETE FROM `records` WHERE domain_id = ? AND type = 'TXT' AND " +
+        "name LIKE ? AND change_date < ?",
+      [domainId, ACME_CHALLENGE_LIKE_PATTERN, now - maxAgeSeconds]);
+    if (result.affectedRows > 0) {
+      bumpSoaRecord(transactionQuery, domain);
+      console.log("Expired " + result.affectedRows + " stale ACME challenge record(s).");
+    }
+    return result.affectedRows;
+  });
+};
+
 // Private functions.
 
 // This function adds a DNS record to PowerDNS's MySQL data store.
@@ -139,46 +369,45 @@ function createDomain(mysqlQuery, domain) {
   rawCreateRecord(mysqlQuery, Meteor.settings.BASE_DOMAIN, Meteor.settings.BASE_DOMAIN, 'NS', Meteor.settings.NS2_HOSTNAME);
 }
 
-function bumpSoaRecord(mysqlQuery, domain) {
-  var currentSoaResult = wrappedQuery(
-    "SELECT id, content from `records` WHERE " +
-      "(domain_id = (SELECT `id` from `domains` WHERE `name` = ?)) AND " +
-      "type='SOA' AND " +
-      "name = ?",
-    [domain, domain]);
-  var currentSoa = currentSoaResult[0];
-
-  // We assume it splits up nicely into the data that
-  // formatSoaRecord() needs.
-  var splitted = currentSoa.content.split(' ');
-  var soaData = {
-    primaryNameServer: splitted[0],
-    adminEmailUsingDots: splitted[1],
-    serialNumber: splitted[2],
-    secondsBeforeRefresh: splitted[3],
-    secondsBeforeRefreshRetry: splitted[4],
-    secondsBeforeDiscardStaleCache: splitted[5],
-    negativeResultTtl: splitted[6]
-  };
-
-  soaData.serialNumber = Number(soaData.serialNumber) + 1;
-  var newSoaData = formatSoaRecord(
-    soaData.primaryNameServer,
-    soaData.adminEmailUsingDots,
-    soaData.serialNumber,
-    soaData.secondsBeforeRefresh,
-    soaData.secondsBeforeRefreshRetry,
-    soaData.secondsBeforeDiscardStaleCache,
-    soaData.negativeResultTtl);
+// The SOA record's content looks like the output of
+// formatSoaRecord(). These SQL fragments pick it apart inside MySQL,
+// so that we can advance the serial number (the third field) without
+// reading the row first.
+var SOA_FIELDS_BEFORE_SERIAL_SQL = "SUBSTRING_INDEX(content, ' ', 2)";
+var SOA_SERIAL_SQL = "CAST(SUBSTRING_INDEX(SUBSTRING_INDEX(content, ' ', 3), ' ', -1) AS UNSIGNED)";
+var SOA_FIELDS_AFTER_SERIAL_SQL = "SUBSTRING_INDEX(content, ' ', -4)";
+
+bumpSoaRecord = function(mysqlQuery, domain) {
+  // Advance the SOA serial number with one UPDATE, so that concurrent
+  // callers never race on a read-modify-write. MySQL's row lock
+  // orders the UPDATEs for us.
+  //
+  // DNS_SOA_SERIAL_MODE picks how the serial number advances:
+  //
+  // - "increment" (the default) adds one.
+  //
+  // - "timestamp" uses the current UNIX time, or one more than the
+  //   current serial if that is larger, so the serial still always
+  //   increases.
+  var newSerialSql;
+  var parameters = [];
+  if (Meteor.settings.DNS_SOA_SERIAL_MODE === 'timestamp') {
+    newSerialSql = "GREATEST(" + SOA_SERIAL_SQL + " + 1, ?)";
+    parameters.push(Math.floor(Date.now() / 1000));
+  } else {
+    newSerialSql = SOA_SERIAL_SQL + " + 1";
+  }
+  parameters.push(getDomainId(mysqlQuery, domain), domain);
 
   // Do an UPDATE and make sure it updated 1 row.
-  var queryResult = wrappedQuery(
+  var queryResult = mysqlQuery(
     "UPDATE `records` " +
-      "SET content=? WHERE " +
-      "id=? ",
-    [newSoaData, currentSoa.id]);
-  if (queryResult.changedRows != 1) {
+      "SET content = CONCAT_WS(' ', " + SOA_FIELDS_BEFORE_SERIAL_SQL + ", " +
+      newSerialSql + ", " + SOA_FIELDS_AFTER_SERIAL_SQL + ") " +
+      "WHERE domain_id = ? AND type = 'SOA' AND name = ?",
+    parameters);
+  if (queryResult.affectedRows != 1) {
     throw new Error("SOA updating failed, leaving us totally confused.");
   }
-  console.log("Updated SOA to " + newSoaData);
-}
+  console.log("Bumped SOA serial for " + domain);
+};
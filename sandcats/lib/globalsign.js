@@ -4,6 +4,26 @@ var globalsignWsdls = {
   'prod': 'https://system.globalsign.com/kb/ws/v1/ManagedSSLService?wsdl'
 };
 
+// By default we re-fetch our MSSL domain info once a day. See
+// getMyDomainInfo().
+var DEFAULT_DOMAIN_INFO_TTL_SECONDS = 24 * 60 * 60;
+
+// Prefer a local copy of the WSDL, if configured, so that creating a
+// client doesn't need a round-trip to GlobalSign.
+function getWsdl(devOrProd) {
+  var wsdlKey = {'dev': 'GLOBALSIGN_DEV_WSDL',
+                 'prod': 'GLOBALSIGN_PROD_WSDL'}[devOrProd];
+  return Meteor.settings[wsdlKey] || globalsignWsdls[devOrProd];
+}
+
+// Optionally send requests somewhere other than the endpoint the WSDL
+// names, e.g. a local stand-in for GlobalSign.
+function getEndpoint(devOrProd) {
+  var endpointKey = {'dev': 'GLOBALSIGN_DEV_ENDPOINT',
+                     'prod': 'GLOBALSIGN_PROD_ENDPOINT'}[devOrProd];
+  return Meteor.settings[endpointKey];
+}
+
 // We use _clients to cache working SOAP client to the various
 // GlobalSign API endpoints we need.
 //
@@ -49,7 +69,11 @@ function getClient(devOrProd) {
   }
 
   if (! _clients[devOrProd]) {
-    _clients[devOrProd] = Meteor.wrapAsync(soap.createClient)(globalsignWsdls[devOrProd]);
+    var client = Meteor.wrapAsync(soap.createClient)(getWsdl(devOrProd));
+    if (getEndpoint(devOrProd)) {
+      client.setEndpoint(getEndpoint(devOrProd));
+    }
+    _clients[devOrProd] = client;
   }
   return _clients[devOrProd];
 }
@@ -98,14 +122,46 @@ getMsslDomainInfo = function(domain, devOrProd) {
 // data from the GlobalSign prod API as well as from the GlobalSign
 // dev API. Don't access _myDomainInfo directly; access it via
 // getMyDomainInfo().
+//
+// The domain info almost never changes, so each entry is a
+// refreshing cache (see refreshingcache.js): we fetch it again in the
+// background once it is half a TTL old, and keep using the old value
+// if GlobalSign is unreachable.
 var _myDomainInfo = {};
 getMyDomainInfo = function(devOrProd) {
   if (! _myDomainInfo[devOrProd]) {
-    _myDomainInfo[devOrProd] = getMsslDomainInfo(Meteor.settings.GLOBALSIGN_DOMAIN, devOrProd);
+    var ttlSeconds = (Meteor.settings.GLOBALSIGN_DOMAIN_INFO_TTL_SECONDS ||
+                      DEFAULT_DOMAIN_INFO_TTL_SECONDS);
+    _myDomainInfo[devOrProd] = makeRefreshingCache({
+      name: 'GlobalSign ' + devOrProd + ' domain info',
+      ttlMilliseconds: ttlSeconds * 1000,
+      fetch: function() {
+        return getMsslDomainInfo(Meteor.settings.GLOBALSIGN_DOMAIN, devOrProd);
+      }
+    });
   }
-  return _myDomainInfo[devOrProd];
+  return _myDomainInfo[devOrProd].get();
 }
 
+// Create the SOAP clients and fetch our domain info for every
+// GlobalSign API we have credentials for, so the first certificate
+// request doesn't have to. Failures are logged, not thrown; we try
+// again when a request needs them.
+warmUpGlobalsign = function() {
+  ['dev', 'prod'].forEach(function(devOrProd) {
+    if (! (Meteor.settings.GLOBALSIGN_DOMAIN && getUsername(devOrProd) &&
+           getPassword(devOrProd))) {
+      return;
+    }
+    try {
+      getMyDomainInfo(devOrProd);
+      console.log("GlobalSign", devOrProd, "client is ready.");
+    } catch (e) {
+      console.error("Could not warm up the GlobalSign", devOrProd, "client:", e);
+    }
+  });
+};
+
 // This function generates the list of arguments we provide to PVOrder
 // by GlobalSign.
 
@@ -211,6 +267,44 @@ logIssueCertificateStart = function(devOrProd, orderRequestParameter,
   return logEntryId;
 }
 
+// Parse the StartDate and EndDate that GlobalSign sent us into
+// certificateStartDate and certificateEndDate. Returns {} if either
+// can't be parsed.
+certificateValidityDates = function(certificateInfo) {
+  var startDate = new Date(certificateInfo.StartDate);
+  var endDate = new Date(certificateInfo.EndDate);
+  if (isNaN(startDate.getTime()) || isNaN(endDate.getTime())) {
+    return {};
+  }
+  return {certificateStartDate: startDate, certificateEndDate: endDate};
+};
+
+// Fill in certificateStartDate and certificateEndDate on certificates
+// logged before we stored them. Returns the number of documents
+// updated. Certificates whose dates don't parse are marked, so that
+// we only read them once rather than on every startup.
+migrateCertificateValidityDates = function() {
+  var updated = 0;
+  CertificateRequests.find({
+    globalsignCertificateInfo: {$exists: true},
+    certificateEndDate: {$exists: false},
+    certificateValidityDatesUnparseable: {$exists: false}
+  }, {fields: {globalsignCertificateInfo: 1}}).forEach(function(doc) {
+    var dates = certificateValidityDates(doc.globalsignCertificateInfo);
+    if (dates.certificateEndDate) {
+      CertificateRequests.update({_id: doc._id}, {$set: dates});
+      updated += 1;
+    } else {
+      CertificateRequests.update({_id: doc._id},
+                                 {$set: {certificateValidityDatesUnparseable: true}});
+    }
+  });
+  if (updated > 0) {
+    console.log("Stored validity dates for", updated, "certificates.");
+  }
+  return updated;
+};
+
 logIssueCertificateSuccess = function(globalsignResponse, logEntryId) {
   try {
     var certificateInfo = globalsignResponse.Response.PVOrderDetail.CertificateInfo;
@@ -231,15 +325,21 @@ logIssueCertificateSuccess = function(globalsignResponse, logEntryId) {
       SerialNumber: certificateInfo.SerialNumber,
       SubjectName: certificateInfo.SubjectName
     };
-    var numAffected = CertificateRequests.update({'_id': logEntryId}, {$set: {
+    var receivedCertificateDate = new Date();
+    var modifier = _.extend({
       globalsignCertificateInfo: certificateInfo,
-      receivedCertificateDate: new Date()
-    }});
+      receivedCertificateDate: receivedCertificateDate
+    }, certificateValidityDates(certificateInfo));
+    var numAffected = CertificateRequests.update({'_id': logEntryId}, {$set: modifier});
     if (numAffected != 1) {
       throw new Error("logIssueCertificateSuccess changed " + numAffected +
                       " documents when it meant to change 1. ID was: ",
                       logEntryId);
     }
+    // Keep the daily totals for the usage reports up to date.
+    var devOrProd = CertificateRequests.findOne(
+      {'_id': logEntryId}, {fields: {devOrProd: 1}}).devOrProd;
+    countCertificateIssued(devOrProd, receivedCertificateDate);
   } catch (e) {
     console.error("While attempting to log", certificateInfo,
                   "ran into exception", e);
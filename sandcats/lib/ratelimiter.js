@@ -0,0 +1,167 @@
+// This file contains a sliding-window rate limiter: "allow at most N
+// events per key in any W-second window".
+//
+// We use it to limit how often we send recovery tokens for a hostname
+// (see okToSendRecoveryToken in validation.js). There are two stores:
+//
+// - "memory" (the default) keeps the events in this process. Every
+//   event sits in one time-ordered queue, so expiring old events is
+//   cheap: we pop them off the front of the queue until the front is
+//   inside the window. A key whose events have all expired takes up
+//   no memory at all. To bound memory even under a flood of distinct
+//   keys, we also drop the oldest events once there are more than
+//   maxEvents of them. That makes the limiter forget a little early,
+//   which errs on the side of letting people recover their domains.
+//
+// - "mongo" keeps the events in the RateLimitEvents collection, so the
+//   limit holds across several Meteor processes. MongoDB's TTL index
+//   removes expired events for us.
+//
+// Both stores have the same interface:
+//
+//   limiter.tryAcquire(key)   // true (and counts the event) if allowed
+//   limiter.reset()           // forget every event
+//   limiter.getStats()
+
+var DEFAULT_MAX_EVENTS = 100000;
+
+// When this many entries at the front of the queue have expired, we
+// slice them off, so the queue array does not grow forever.
+var QUEUE_COMPACT_THRESHOLD = 1024;
+
+makeMemoryRateLimiter = function(options) {
+  var windowMilliseconds = options.windowSeconds * 1000;
+  var maxEventsPerWindow = options.maxEventsPerWindow;
+  var maxEvents = options.maxEvents || DEFAULT_MAX_EVENTS;
+  // For the unit tests.
+  var now = options.now || function() { return Date.now(); };
+
+  var limiter = {};
+
+  // Map from key to an array of event times, oldest first.
+  var eventTimesByKey;
+  // Every event, oldest first, as {key, time}. Entries before
+  // queueStart have been expired.
+  var queue;
+  var queueStart;
+  var stats;
+
+  limiter.reset = function() {
+    eventTimesByKey = Object.create(null);
+    queue = [];
+    queueStart = 0;
+    stats = {allowed: 0, refused: 0, expired: 0, evictedForMemory: 0};
+  };
+  limiter.reset();
+
+  function dropOldestEvent() {
+    var event = queue[queueStart];
+    queueStart += 1;
+    // Since events are recorded in time order, the oldest event in
+    // the queue is also the oldest event for its key.
+    var times = eventTimesByKey[event.key];
+    times.shift();
+    if (times.length === 0) {
+      delete eventTimesByKey[event.key];
+    }
+    if (queueStart >= QUEUE_COMPACT_THRESHOLD) {
+      queue = queue.slice(queueStart);
+      queueStart = 0;
+    }
+  }
+
+  function expire(currentTime) {
+    var cutoff = currentTime - windowMilliseconds;
+    while (queueStart < queue.length && queue[queueStart].time < cutoff) {
+      dropOldestEvent();
+      stats.expired += 1;
+    }
+  }
+
+  limiter.tryAcquire = function(key) {
+    var currentTime = now();
+    expire(currentTime);
+
+    var times = eventTimesByKey[key];
+    if (times && times.length >= maxEventsPerWindow) {
+      stats.refused += 1;
+      return false;
+    }
+
+    if (! times) {
+      times = eventTimesByKey[key] = [];
+    }
+    times.push(currentTime);
+    queue.push({key: key, time: currentTime});
+    stats.allowed += 1;
+
+    while (queue.length - queueStart > maxEvents) {
+      dropOldestEvent();
+      stats.evictedForMemory += 1;
+    }
+    return true;
+  };
+
+  limiter.getStats = function() {
+    var result = _.clone(stats);
+    result.store = 'memory';
+    result.events = queue.length - queueStart;
+    result.keys = Object.keys(eventTimesByKey).length;
+    return result;
+  };
+
+  return limiter;
+};
+
+makeMongoRateLimiter = function(options) {
+  var windowMilliseconds = options.windowSeconds * 1000;
+  var maxEventsPerWindow = options.maxEventsPerWindow;
+  var now = options.now || function() { return Date.now(); };
+  var collection = options.collection || RateLimitEvents;
+  var stats = {allowed: 0, refused: 0};
+
+  // Let MongoDB delete events once they are out of every window.
+  collection._ensureIndex({timestamp: 1}, {expireAfterSeconds: options.windowSeconds});
+  collection._ensureIndex({key: 1, timestamp: 1});
+
+  var limiter = {};
+
+  limiter.tryAcquire = function(key) {
+    var currentTime = now();
+    // Record the event first, then count. If several processes race,
+    // each sees the others' events, so together they never allow more
+    // than maxEventsPerWindow; at worst they all refuse.
+    var eventId = collection.insert({key: key, timestamp: new Date(currentTime)});
+    var count = collection.find({
+      key: key,
+      timestamp: {$gte: new Date(currentTime - windowMilliseconds)}
+    }).count();
+    if (count > maxEventsPerWindow) {
+      collection.remove(eventId);
+      stats.refused += 1;
+      return false;
+    }
+    stats.allowed += 1;
+    return true;
+  };
+
+  limiter.reset = function() {
+    collection.remove({});
+  };
+
+  limiter.getStats = function() {
+    var result = _.clone(stats);
+    result.store = 'mongo';
+    return result;
+  };
+
+  return limiter;
+};
+
+// Create a rate limiter using the store named by RATE_LIMIT_STORE.
+makeRateLimiter = function(options) {
+  if (Meteor.isServer && Meteor.settings.RATE_LIMIT_STORE === 'mongo') {
+    return makeMongoRateLimiter(options);
+  }
+  return makeMemoryRateLimiter(options);
+};
@@ -0,0 +1,101 @@
+// This file contains a cache for one value that is slow to fetch and
+// rarely changes, such as our GlobalSign MSSL domain info.
+//
+// - cache.get() returns the cached value while it is younger than
+//   ttlMilliseconds. Once it is older than refreshAfterMilliseconds,
+//   get() still returns it right away, but also starts a refresh in
+//   the background, so callers rarely wait for a fetch.
+//
+// - If the value has expired, get() fetches it and waits. If that
+//   fetch fails and we have an old value, we log the error and return
+//   the old value, since a stale answer beats no answer here.
+//
+// fetch() runs in a fiber and returns the new value or throws.
+
+makeRefreshingCache = function(options) {
+  var fetch = options.fetch;
+  var ttlMilliseconds = options.ttlMilliseconds;
+  var refreshAfterMilliseconds = (options.refreshAfterMilliseconds ||
+                                  ttlMilliseconds / 2);
+  var name = options.name || 'cache';
+  // For the unit tests.
+  var now = options.now || function() { return Date.now(); };
+  var defer = options.defer || function(f) { Meteor.defer(f); };
+
+  var cache = {};
+  var value;
+  var fetchedAt = null;
+  var refreshing = false;
+  var stats = {hits: 0, fetches: 0, backgroundRefreshes: 0, fetchFailures: 0,
+               staleReturns: 0};
+
+  function fetchAndStore() {
+    stats.fetches += 1;
+    var newValue = fetch();
+    value = newValue;
+    fetchedAt = now();
+    return newValue;
+  }
+
+  function startBackgroundRefresh() {
+    if (refreshing) {
+      return;
+    }
+    refreshing = true;
+    stats.backgroundRefreshes += 1;
+    defer(function() {
+      try {
+        fetchAndStore();
+      } catch (e) {
+        stats.fetchFailures += 1;
+        console.error("Background refresh of", name, "failed:", e);
+      } finally {
+        refreshing = false;
+      }
+    });
+  }
+
+  cache.get = function() {
+    if (fetchedAt !== null) {
+      var age = now() - fetchedAt;
+      if (age < ttlMilliseconds) {
+        stats.hits += 1;
+        if (age >= refreshAfterMilliseconds) {
+          startBackgroundRefresh();
+        }
+        return value;
+      }
+    }
+
+    try {
+      return fetchAndStore();
+    } catch (e) {
+      stats.fetchFailures += 1;
+      if (fetchedAt === null) {
+        throw e;
+      }
+      stats.staleReturns += 1;
+      console.error("Could not refresh", name + "; using a value from",
+                    new Date(fetchedAt), "instead. Error:", e);
+      return value;
+    }
+  };
+
+  // Fetch now, whatever the age of the cached value.
+  cache.refresh = function() {
+    return fetchAndStore();
+  };
+
+  cache.invalidate = function() {
+    value = undefined;
+    fetchedAt = null;
+  };
+
+  cache.getStats = function() {
+    var result = _.clone(stats);
+    result.ageMilliseconds = (fetchedAt === null) ? null : now() - fetchedAt;
+    return result;
+  };
+
+  return cache;
+};
@@ -0,0 +1,96 @@
+// This file lets one HTTP API request look up a UserRegistration once
+// and share it, rather than asking MongoDB again in each Mesosphere
+// rule and then again in the write path.
+//
+// Inside RegistrationLookups.withRequestScope(fn), the find functions
+// below remember what they found (including "nothing"), keyed by
+// hostname and by public key fingerprint. A registration found by one
+// key is remembered under the other one too, so e.g. /update reads
+// MongoDB once for its hostname and key.
+//
+// When a request creates or changes a registration, it tells us with
+// recordInsert() or recordUpdate(), so later lookups in that request
+// see the new values without reading them back.
+//
+// Outside a request scope (e.g., in the UDP ping code or the tests),
+// the find functions simply call UserRegistrations.findOne().
+//
+// The memo only lives as long as one request, so it can't go stale in
+// any way the old back-to-back findOne() calls couldn't.
+
+RegistrationLookups = {};
+
+var currentLookups = new Meteor.EnvironmentVariable();
+
+function makeLookups() {
+  // Maps from key to registration, or to null if there is none.
+  return {byHostname: {}, byPublicKeyId: {}};
+}
+
+function remember(lookups, registration) {
+  lookups.byHostname[registration.hostname] = registration;
+  lookups.byPublicKeyId[registration.publicKeyId] = registration;
+}
+
+function find(memoName, field, value) {
+  var lookups = currentLookups.get();
+  var selector = {};
+  selector[field] = value;
+  if (! lookups) {
+    return UserRegistrations.findOne(selector);
+  }
+
+  var memo = lookups[memoName];
+  if (_.has(memo, value)) {
+    return memo[value] || undefined;
+  }
+  var registration = UserRegistrations.findOne(selector);
+  if (registration) {
+    remember(lookups, registration);
+  } else {
+    memo[value] = null;
+  }
+  return registration;
+}
+
+// Run fn() with a fresh set of remembered lookups, and return its
+// result.
+RegistrationLookups.withRequestScope = function(fn) {
+  return currentLookups.withValue(makeLookups(), fn);
+};
+
+RegistrationLookups.findByHostname = function(hostname) {
+  return find('byHostname', 'hostname', hostname);
+};
+
+RegistrationLookups.findByPublicKeyId = function(publicKeyId) {
+  return find('byPublicKeyId', 'publicKeyId', publicKeyId);
+};
+
+// Note that the caller inserted registration into MongoDB.
+RegistrationLookups.recordInsert = function(registration) {
+  var lookups = currentLookups.get();
+  if (lookups) {
+    remember(lookups, registration);
+  }
+  return registration;
+};
+
+// Note that the caller updated registration in MongoDB by setting the
+// fields in changes. Returns the registration as it now is.
+RegistrationLookups.recordUpdate = function(registration, changes) {
+  var updated = _.extend({}, registration, changes);
+  var lookups = currentLookups.get();
+  if (lookups) {
+    // If the update moved the registration to a new hostname or key,
+    // nothing has the old one any more.
+    if (registration.hostname !== updated.hostname) {
+      lookups.byHostname[registration.hostname] = null;
+    }
+    if (registration.publicKeyId !== updated.publicKeyId) {
+      lookups.byPublicKeyId[registration.publicKeyId] = null;
+    }
+    remember(lookups, updated);
+  }
+  return updated;
+};
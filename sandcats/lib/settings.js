@@ -44,11 +44,117 @@ var settingsSchema = new SimpleSchema({
     type: String
   },
 
+  // How many MySQL connections to PowerDNS we may open at once.
+  // Defaults to 5.
+  MYSQL_CONNECTION_LIMIT: {
+    type: Number,
+    optional: true
+  },
+
+  // How many queries may wait for a MySQL connection before new ones
+  // fail right away. Defaults to 0, meaning no limit.
+  MYSQL_QUEUE_LIMIT: {
+    type: Number,
+    optional: true
+  },
+
+  // Ping a MySQL connection before using it if it has been idle for
+  // this many milliseconds, and replace it if the ping fails. Defaults
+  // to 30000. See mysqlpool.js.
+  MYSQL_VALIDATE_IDLE_MILLISECONDS: {
+    type: Number,
+    optional: true
+  },
+
   // Port number for UDP-based ping system.
   UDP_PING_PORT: {
     type: Number
   },
 
+  // If set, we combine DNS changes from many /register and /update
+  // calls into one MySQL transaction, at most this many milliseconds
+  // after the first change arrives. If unset, each call gets its own
+  // transaction. See dnspublisher.js.
+  DNS_PUBLISH_BATCH_MILLISECONDS: {
+    type: Number,
+    optional: true
+  },
+
+  // How long an _acme-challenge TXT record may live, in seconds,
+  // before we delete it, in case the client never does. Defaults to
+  // 3600. See expireStaleAcmeChallenges().
+  ACME_CHALLENGE_MAX_AGE_SECONDS: {
+    type: Number,
+    optional: true
+  },
+
+  // The longest TTL, in seconds, to publish for hostnames whose IP
+  // address hasn't changed in a while. Defaults to 3600; 60 turns
+  // adaptive TTLs off. See server/dnsttl.js.
+  DNS_MAX_TTL_SECONDS: {
+    type: Number,
+    optional: true
+  },
+
+  // How to advance the SOA serial number when DNS changes: either
+  // "increment" (the default), or "timestamp" to use the UNIX time.
+  // Either way, MySQL advances it atomically; see bumpSoaRecord().
+  DNS_SOA_SERIAL_MODE: {
+    type: String,
+    allowedValues: ["increment", "timestamp"],
+    optional: true
+  },
+
+  // If set, the standalone UDP ping workers in udp-ping-workers/
+  // answer UDP pings, and this process feeds them hostname data on
+  // this TCP port on 127.0.0.1 instead of binding UDP_PING_PORT. See
+  // udppingfeed.js.
+  UDP_PING_WORKERS_FEED_PORT: {
+    type: Number,
+    optional: true
+  },
+
+  // How the UDP ping system decides if a hostname matches an IP
+  // address: "memory" (the default), "mongo", or "dns". See
+  // udppinglookup.js.
+  UDP_PING_LOOKUP_BACKEND: {
+    type: String,
+    allowedValues: ["memory", "mongo", "dns"],
+    optional: true
+  },
+
+  // For the "dns" UDP ping lookup backend, the IP address of the
+  // PowerDNS server to ask. Defaults to 127.0.0.1.
+  UDP_PING_DNS_SERVER: {
+    type: String,
+    optional: true
+  },
+
+  // For the "dns" UDP ping lookup backend, how many DNS queries may be
+  // outstanding at once before we start dropping pings. Defaults to
+  // 1000.
+  UDP_PING_DNS_MAX_IN_FLIGHT: {
+    type: Number,
+    optional: true
+  },
+
+  // Where rate limiters keep their state: "memory" (the default), or
+  // "mongo" to share limits across several Meteor processes. See
+  // ratelimiter.js.
+  RATE_LIMIT_STORE: {
+    type: String,
+    allowedValues: ["memory", "mongo"],
+    optional: true
+  },
+
+  // If true, POSTing to /reset-for-testing on the Meteor port from
+  // localhost erases all registrations and DNS records. Only for
+  // development machines; see resetfortesting.js.
+  ALLOW_RESET_FOR_TESTING: {
+    type: Boolean,
+    optional: true
+  },
+
   // In production, the URL of the root. Auto-detected in dev,
   // therefore optional here.
   ROOT_URL: {
@@ -78,6 +184,43 @@ var settingsSchema = new SimpleSchema({
     optional: true
   },
 
+  // Optionally, the path to a local copy of the GlobalSign WSDL, so
+  // that we don't download it at startup. "make
+  // action-fetch-globalsign-wsdls" fetches copies. Defaults to
+  // GlobalSign's URL.
+  //
+  // This setting occurs in both DEV_ and PROD_ form.
+  GLOBALSIGN_DEV_WSDL: {
+    type: String,
+    optional: true
+  },
+
+  GLOBALSIGN_PROD_WSDL: {
+    type: String,
+    optional: true
+  },
+
+  // Optionally, a URL to send GlobalSign API calls to instead of the
+  // one in the WSDL; for example, a local stand-in for testing.
+  //
+  // This setting occurs in both DEV_ and PROD_ form.
+  GLOBALSIGN_DEV_ENDPOINT: {
+    type: String,
+    optional: true
+  },
+
+  GLOBALSIGN_PROD_ENDPOINT: {
+    type: String,
+    optional: true
+  },
+
+  // How long to trust our cached GlobalSign MSSL domain info, in
+  // seconds. Defaults to one day. See getMyDomainInfo().
+  GLOBALSIGN_DOMAIN_INFO_TTL_SECONDS: {
+    type: Number,
+    optional: true
+  },
+
   // API calls to GlobalSign are with regard to a particular domain
   // name. This setting configures which domain to use. It's separate
   // from BASE_DOMAIN because the DNS domain we use for testing is
@@ -0,0 +1,166 @@
+// This file describes the wire format of UDP pings; see udppings.js
+// for the protocol as a whole.
+//
+// It is shared by the Meteor app and by the standalone UDP ping
+// workers in ../udp-ping-workers/, so it must not depend on Meteor or
+// on any npm modules.
+//
+// There are two formats, and servers accept both on the same port:
+//
+// - Version 1 is the ASCII string "<hostname> <16-byte challenge>".
+//   The reply is the 16-byte challenge.
+//
+// - Version 2 is binary, and can carry several pings in one packet:
+//
+//     1 byte   version, always 0x02
+//     1 byte   flags; none are defined yet, and servers ignore them
+//     1 byte   N, the number of pings, 1 to UDP_PING_V2_MAX_PINGS
+//     N times:
+//       8 bytes   hostname hash: the first 8 bytes of SHA-256(hostname)
+//       16 bytes  challenge, any bytes
+//
+//   The reply is one packet: 0x02, then the count M of challenges that
+//   follow, then the M 16-byte challenges of the pings whose hostname
+//   is NOT registered to the sender's IP address. If M would be 0, we
+//   send nothing. Replies are never bigger than the request.
+//
+//   Everything has a fixed length, so we can parse a version 2 packet
+//   without splitting or decoding it, and build the reply by copying
+//   bytes out of the request.
+//
+// A version 1 packet can't start with 0x02, since hostnames are
+// printable ASCII, so the first byte tells the formats apart.
+
+UDP_PING_CHALLENGE_LENGTH = 16;
+
+UDP_PING_V2_VERSION = 0x02;
+UDP_PING_V2_HEADER_LENGTH = 3;
+UDP_PING_V2_HOSTNAME_HASH_LENGTH = 8;
+UDP_PING_V2_ENTRY_LENGTH = UDP_PING_V2_HOSTNAME_HASH_LENGTH + UDP_PING_CHALLENGE_LENGTH;
+UDP_PING_V2_REPLY_HEADER_LENGTH = 2;
+// Bounds the work one packet can cause, and keeps packets well under
+// a typical MTU.
+UDP_PING_V2_MAX_PINGS = 32;
+
+// Given a Buffer containing a UDP ping, return one of:
+//
+// - {version: 1, hostname, challenge} for a version 1 ping,
+//
+// - {version: 2, count} for a version 2 packet of count pings; use
+//   udpPingV2HostnameHash() to read them,
+//
+// - or null if the packet is malformed.
+parseUdpPingMessage = function(message) {
+  if (message.length > 0 && message[0] === UDP_PING_V2_VERSION) {
+    if (message.length < UDP_PING_V2_HEADER_LENGTH) {
+      return null;
+    }
+    var count = message[2];
+    if (count < 1 || count > UDP_PING_V2_MAX_PINGS ||
+        message.length !== UDP_PING_V2_HEADER_LENGTH + count * UDP_PING_V2_ENTRY_LENGTH) {
+      return null;
+    }
+    return {version: 2, count: count};
+  }
+
+  var splitted = message.toString('ascii').split(" ");
+  var hostname = splitted[0];
+  var challenge = splitted[1];
+  if (! hostname || ! challenge || challenge.length != UDP_PING_CHALLENGE_LENGTH) {
+    return null;
+  }
+  return {version: 1, hostname: hostname, challenge: challenge};
+};
+
+// Return the hostname hash of ping number i (from 0) in a version 2
+// packet, as a hex string, for looking up in a map built with
+// hashUdpPingHostname().
+udpPingV2HostnameHash = function(message, i) {
+  var start = UDP_PING_V2_HEADER_LENGTH + i * UDP_PING_V2_ENTRY_LENGTH;
+  return message.toString('hex', start, start + UDP_PING_V2_HOSTNAME_HASH_LENGTH);
+};
+
+// Build the reply to a version 2 packet, given the numbers of the
+// pings whose hostname did not match. Returns null if there is
+// nothing to send.
+buildUdpPingV2Reply = function(message, mismatchedPings) {
+  if (mismatchedPings.length === 0) {
+    return null;
+  }
+  var reply = new Buffer(UDP_PING_V2_REPLY_HEADER_LENGTH +
+                         mismatchedPings.length * UDP_PING_CHALLENGE_LENGTH);
+  reply[0] = UDP_PING_V2_VERSION;
+  reply[1] = mismatchedPings.length;
+  for (var j = 0; j < mismatchedPings.length; j++) {
+    var challengeStart = (UDP_PING_V2_HEADER_LENGTH +
+                          mismatchedPings[j] * UDP_PING_V2_ENTRY_LENGTH +
+                          UDP_PING_V2_HOSTNAME_HASH_LENGTH);
+    message.copy(reply, UDP_PING_V2_REPLY_HEADER_LENGTH + j * UDP_PING_CHALLENGE_LENGTH,
+                 challengeStart, challengeStart + UDP_PING_CHALLENGE_LENGTH);
+  }
+  return reply;
+};
+
+// Return the hash a version 2 ping uses for hostname, as a hex string.
+// This needs node's crypto module, so only call it on the server.
+hashUdpPingHostname = function(hostname) {
+  var crypto = (typeof Npm !== 'undefined') ? Npm.require('crypto') : require('crypto');
+  return crypto.createHash('sha256').update(hostname, 'utf8').digest('hex').slice(
+    0, 2 * UDP_PING_V2_HOSTNAME_HASH_LENGTH);
+};
+
+// A map from hostname hash to the hostnames with that hash, for
+// answering version 2 pings. With 64-bit hashes, two hostnames
+// sharing one is very unlikely, but we handle it: a ping then matches
+// if any of them matches.
+makeUdpPingHostnameHashMap = function() {
+  var map = {};
+  var hostnamesByHash = Object.create(null);
+
+  map.add = function(hostname) {
+    var hash = hashUdpPingHostname(hostname);
+    var hostnames = hostnamesByHash[hash];
+    if (! hostnames) {
+      hostnamesByHash[hash] = [hostname];
+    } else if (hostnames.indexOf(hostname) === -1) {
+      hostnames.push(hostname);
+    }
+  };
+
+  map.remove = function(hostname) {
+    var hash = hashUdpPingHostname(hostname);
+    var hostnames = hostnamesByHash[hash];
+    if (! hostnames) {
+      return;
+    }
+    var position = hostnames.indexOf(hostname);
+    if (position !== -1) {
+      hostnames.splice(position, 1);
+    }
+    if (hostnames.length === 0) {
+      delete hostnamesByHash[hash];
+    }
+  };
+
+  // Return the list of hostnames with this hash; empty if none.
+  map.get = function(hash) {
+    return hostnamesByHash[hash] || [];
+  };
+
+  return map;
+};
+
+// When loaded by node directly (rather than by Meteor), export the
+// functions above.
+if (typeof module !== 'undefined' && module.exports) {
+  module.exports = {
+    UDP_PING_CHALLENGE_LENGTH: UDP_PING_CHALLENGE_LENGTH,
+    UDP_PING_V2_VERSION: UDP_PING_V2_VERSION,
+    UDP_PING_V2_MAX_PINGS: UDP_PING_V2_MAX_PINGS,
+    parseUdpPingMessage: parseUdpPingMessage,
+    udpPingV2HostnameHash: udpPingV2HostnameHash,
+    buildUdpPingV2Reply: buildUdpPingV2Reply,
+    hashUdpPingHostname: hashUdpPingHostname,
+    makeUdpPingHostnameHashMap: makeUdpPingHostnameHashMap
+  };
+}
@@ -8,7 +8,7 @@ Mesosphere.registerRule('keyFingerprintUnique', function (fieldValue, ruleValue)
   }
 
   // Make sure there is no one else registered with this fingerprint.
-  if (UserRegistrations.findOne({publicKeyId: fieldValue})) {
+  if (RegistrationLookups.findByPublicKeyId(fieldValue)) {
     return false;
   }
 
@@ -46,7 +46,7 @@ Mesosphere.registerRule('extraHyphenRegexes', function (fieldValue, ruleValue) {
 Mesosphere.registerAggregate('domainExistsSoCanBeRecovered', function(fields, formFieldsObject) {
   // Sending a recovery token only makes sense if the hostname
   // actually exists.
-  var userRegistration = UserRegistrations.findOne({'hostname': formFieldsObject.rawHostname});
+  var userRegistration = RegistrationLookups.findByHostname(formFieldsObject.rawHostname);
 
   // Take that userRegistration and "cast it to a boolean", Javascript style.
   return !! userRegistration;
@@ -86,7 +86,7 @@ function commonNameMatchesHostname(csr, rawHostname) {
   return false;
 }
 
-function hostnameIsWithinReasonableCertificateIssuanceLimits(hostname) {
+hostnameIsWithinReasonableCertificateIssuanceLimits = function(hostname) {
   // Return if it makes sense for this hostname to ask for another certificate.
   //
   // Definition of "makes sense":
@@ -98,23 +98,16 @@ function hostnameIsWithinReasonableCertificateIssuanceLimits(hostname) {
   // A currently-valid certificate is one where now >= StartDate
   // and EndDate >= now.
   //
-  // We only look for CertificateRequests objects that have a
-  // globalsignCertificateInfo attribute, since that's how we know
-  // they're properly issued.
-  var matches = CertificateRequests.find({
-    'hostname': hostname,
-    globalsignCertificateInfo: {$exists: true}
-  });
-  var currentlyValidCertificateCount = 0;
+  // We only look at CertificateRequests objects with a
+  // certificateStartDate and certificateEndDate, which we set once the
+  // certificate is properly issued. Since we only care whether there
+  // are at least 6, we stop looking after 6.
   var now = new Date();
-  matches.forEach(function(doc) {
-    var startDate = new Date(doc.globalsignCertificateInfo.StartDate);
-    var endDate = new Date(doc.globalsignCertificateInfo.EndDate);
-    if ((now >= startDate)  &&
-        (endDate >= now)) {
-      currentlyValidCertificateCount += 1;
-    }
-  });
+  var currentlyValidCertificateCount = CertificateRequests.find({
+    hostname: hostname,
+    certificateEndDate: {$gte: now},
+    certificateStartDate: {$lte: now}
+  }, {fields: {_id: 1}, limit: 6}).fetch().length;
 
   console.log("Found", currentlyValidCertificateCount, "certs for", hostname);
 
@@ -124,7 +117,7 @@ function hostnameIsWithinReasonableCertificateIssuanceLimits(hostname) {
   }
 
   return true;
-}
+};
 
 Mesosphere.registerAggregate('getCertificateIsAuthorized', function(fields, formFieldsObject) {
   var csr = formFieldsObject.certificateSigningRequest;
@@ -172,7 +165,7 @@ Mesosphere.registerAggregate('recoveryIsAuthorized', function(fields, formFields
   //
   // - The recoveryToken we are given is the same as the one in the
   //   recoveryData.
-  var userRegistration = UserRegistrations.findOne({'hostname': formFieldsObject.rawHostname});
+  var userRegistration = RegistrationLookups.findByHostname(formFieldsObject.rawHostname);
 
   if (! userRegistration) {
     return false;
@@ -195,8 +188,10 @@ Mesosphere.registerAggregate('recoveryIsAuthorized', function(fields, formFields
 });
 
 function _hostnameAndPubkeyMatch(pubkey, hostname) {
-  if (UserRegistrations.findOne({publicKeyId: pubkey,
-                                 hostname: hostname})) {
+  // Look up by hostname, which is what the other rules on these forms
+  // use, so the request can reuse the registration we find.
+  var userRegistration = RegistrationLookups.findByHostname(hostname);
+  if (userRegistration && userRegistration.publicKeyId === pubkey) {
     // This means we have a match. Hooray!
     return true;
   }
@@ -216,72 +211,39 @@ Mesosphere.registerAggregate('hostnameAndPubkeyMatch', function(fields, formFiel
 var RECOVERY_TIME_PERIOD_IN_SECONDS = 15 * 60;
 function makeOkToSendRecoveryToken() {
   // The purpose of this function is to ensure that we don't send
-  // recovery tokens to users too frequently.
+  // recovery tokens to users too frequently: at most
+  // MAX_SENDS_PER_TIME_PERIOD per hostname in any
+  // RECOVERY_TIME_PERIOD_IN_SECONDS window.
   //
-  // To achieve that, we make a closure that contains information
-  // about recent times we sent recovery tokens. If the server stops
-  // and starts, yeah, we'll lose this info, but the
-  // RECOVERY_TIME_PERIOD_IN_MINUTES is a pretty short window, and we restart
-  // the server pretty infrequently, so I'm not super worried about
-  // that.
-  var recoveryTokenSendTimesByHostname = {};
-
+  // The rate limiter forgets old sends on its own, and with
+  // RATE_LIMIT_STORE set to "mongo", it holds across several Meteor
+  // processes. See ratelimiter.js.
   var MAX_SENDS_PER_TIME_PERIOD = 2;
 
-  // TODO: Make this use a heap. We could then have a garbage
-  // collection strategy involving a heap (sorted by date of
-  // insertion) and keeping a linear list of the hosts where password
-  // resets were sent.
-  //
-  // For now, let's just do no garbage collection on this at all, and
-  // assume that server restarts will save us.
-
-  return function(fields, formFieldsObject) {
-    var hostname = formFieldsObject.rawHostname;
-
-    // We need the current time (in UNIX epoch seconds) in a few
-    // places.
-    var now = Math.floor(new Date().getTime() / 1000);
+  var limiter = makeRateLimiter({
+    windowSeconds: RECOVERY_TIME_PERIOD_IN_SECONDS,
+    maxEventsPerWindow: MAX_SENDS_PER_TIME_PERIOD
+  });
 
-    // If no one has requested a reset on this ever, then let's add a
-    // note indicating when the reset was done, and say it's OK.
-    if (! recoveryTokenSendTimesByHostname[hostname]) {
-      recoveryTokenSendTimesByHostname[hostname] = [now];
-      return true;
-    }
+  var okToSend = function(fields, formFieldsObject) {
+    return limiter.tryAcquire(formFieldsObject.rawHostname);
+  };
 
-    // If someone has ever requested this domain, loop through the
-    // list of requests and count the number that occurred in the past
-    // RECOVERY_TIME_PERIOD_IN_SECONDS. If it's greater than that,
-    // refuse to send.
-    var relevantTimes = recoveryTokenSendTimesByHostname[hostname];
-
-    // This value starts at 1 because we have not yet pushed this
-    // request into the array. We will push it into the array if
-    // we would return true.
-    var numberOfRecentRecoveryTokenRequests = 1;
-
-    for (var i = 0 ; i < relevantTimes.length; i++) {
-      var difference = now - relevantTimes[i];
-      if (difference <= RECOVERY_TIME_PERIOD_IN_SECONDS) {
-        numberOfRecentRecoveryTokenRequests += 1;
-      }
-    }
+  // Forget every recovery token we have sent. The integration tests
+  // use this via resetAppStateForTesting().
+  okToSend.reset = function() {
+    limiter.reset();
+  };
 
-    // If numberOfRecentRecoveryTokenRequests is greater than
-    // MAX_SENDS_PER_TIME_PERIOD, then scrupulously refuse to send.
-    if (numberOfRecentRecoveryTokenRequests > MAX_SENDS_PER_TIME_PERIOD) {
-      return false;
-    }
+  okToSend.getStats = function() {
+    return limiter.getStats();
+  };
 
-    // Well, things seem OK then. Let's add ourselves to the array so
-    // that we count this request next time.
-    recoveryTokenSendTimesByHostname[hostname].push(now);
-    return true;
-  }
+  return okToSend;
 };
 
-Mesosphere.registerAggregate('okToSendRecoveryToken', makeOkToSendRecoveryToken());
+okToSendRecoveryToken = makeOkToSendRecoveryToken();
+Mesosphere.registerAggregate('okToSendRecoveryToken', okToSendRecoveryToken);
 
 Mesosphere.registerRule('ipAddressNotOverused', function (fieldValue, ruleValue) {
   var MAX_IP_REGISTRATIONS = 20;
@@ -324,7 +286,7 @@ Mesosphere.registerRule('hostnameUnused', function (fieldValue, ruleValue) {
   }
 
   // If Mongo says the hostname is used, then block this registration.
-  if (UserRegistrations.findOne({hostname: fieldValue})) {
+  if (RegistrationLookups.findByHostname(fieldValue)) {
     return false;
   }
 
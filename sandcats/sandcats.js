@@ -9,12 +9,48 @@ if (Meteor.isServer) {
       return;
     }
 
+    // Make sure our hot queries have indexes, and complain if not.
+    ensureMongoIndexes();
+    checkHotQueryIndexes();
+
+    // Backfill the daily certificate counts used by the usage reports,
+    // and the parsed validity dates used by the issuance limit.
+    ensureCertificateDailyCounts();
+    migrateCertificateValidityDates();
+    // Likewise, start tracking IP address changes for the adaptive
+    // DNS TTLs.
+    migrateDnsTtlFields();
+
+    // Get the GlobalSign clients ready without delaying startup.
+    Meteor.defer(warmUpGlobalsign);
+
     // Create our DNS zone for PowerDNS, if necessary.
     mysqlQuery = createWrappedQuery();
     createDomainIfNeeded(mysqlQuery);
+    startExpiringStaleAcmeChallenges(mysqlQuery);
+    startLengtheningStableDnsTtls(mysqlQuery);
 
-    // Bind handlers for UDP-based client ping system.
-    startListeningForUdpPings();
+    // Bind handlers for UDP-based client ping system. This also loads
+    // the in-memory hostname index, if that's the lookup backend.
+    //
+    // If standalone UDP ping workers answer the pings instead, feed
+    // them the hostname index rather than binding the UDP port here.
+    if (Meteor.settings.UDP_PING_WORKERS_FEED_PORT) {
+      startUdpPingWorkersFeed();
+    } else {
+      startListeningForUdpPings();
+    }
+  });
+}
+
+// Run handler for an HTTP API route, measuring it (see
+// requestmetrics.js) and sharing UserRegistration lookups across it
+// (see registrationlookups.js).
+function handleApiRequest(routeName, route, handler) {
+  RequestMetrics.timeRoute(routeName, route, function(request, response) {
+    RegistrationLookups.withRequestScope(function() {
+      handler(request, response);
+    });
   });
 }
 
@@ -38,7 +74,7 @@ Router.map(function() {
     path: '/register',
     where: 'server',
     action: function() {
-      doRegister(this.request, this.response);
+      handleApiRequest('register', this, doRegister);
     }
   });
 
@@ -46,7 +82,7 @@ Router.map(function() {
     path: '/reserve',
     where: 'server',
     action: function() {
-      doReserve(this.request, this.response);
+      handleApiRequest('reserve', this, doReserve);
     }
   });
 
@@ -54,7 +90,7 @@ Router.map(function() {
     path: '/registerreserved',
     where: 'server',
     action: function() {
-      doRegisterReserved(this.request, this.response);
+      handleApiRequest('registerreserved', this, doRegisterReserved);
     }
   });
 
@@ -62,7 +98,7 @@ Router.map(function() {
     path: '/sendrecoverytoken',
     where: 'server',
     action: function() {
-      doSendRecoveryToken(this.request, this.response);
+      handleApiRequest('sendrecoverytoken', this, doSendRecoveryToken);
     }
   });
 
@@ -70,7 +106,7 @@ Router.map(function() {
     path: '/recover',
     where: 'server',
     action: function() {
-      doRecover(this.request, this.response);
+      handleApiRequest('recover', this, doRecover);
     }
   });
 
@@ -78,7 +114,7 @@ Router.map(function() {
     path: '/update',
     where: 'server',
     action: function() {
-      doUpdate(this.request, this.response);
+      handleApiRequest('update', this, doUpdate);
     }
   });
 
@@ -86,7 +122,7 @@ Router.map(function() {
     path: '/acme-challenge',
     where: 'server',
     action: function() {
-      doAcmeChallenge(this.request, this.response);
+      handleApiRequest('acme-challenge', this, doAcmeChallenge);
     }
   });
 
@@ -94,7 +130,33 @@ Router.map(function() {
     path: '/getcertificate',
     where: 'server',
     action: function() {
-      doGetCertificate(this.request, this.response);
+      handleApiRequest('getcertificate', this, doGetCertificate);
+    }
+  });
+
+  // Request latency and other stats, as JSON; see requestmetrics.js.
+  this.route('metrics', {
+    path: '/metrics',
+    where: 'server',
+    action: function() {
+      doMetrics(this.request, this.response);
+    }
+  });
+
+  // Make PowerDNS's A records match MongoDB; see reconciledns.js.
+  this.route('reconcile-dns', {
+    path: '/reconcile-dns',
+    where: 'server',
+    action: function() {
+      doReconcileDns(this.request, this.response);
+    }
+  });
+
+  this.route('reset-for-testing', {
+    path: '/reset-for-testing',
+    where: 'server',
+    action: function() {
+      doResetForTesting(this.request, this.response);
     }
   });
 
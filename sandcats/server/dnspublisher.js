@@ -0,0 +1,175 @@
+// This file contains DnsPublisher, which batches DNS changes into
+// one MySQL transaction every DNS_PUBLISH_BATCH_MILLISECONDS.
+//
+// Without batching, every /update does its own DELETEs, INSERTs, and
+// SOA bump. When thousands of Sandstorm servers change IP address at
+// once (e.g., after an ISP outage), those round-trips, and contention
+// on the one SOA row, add up.
+//
+// With batching:
+//
+// - publishOneUserRegistrationToDns() calls
+//   DnsPublisher.publishUserRegistration(), which records the change
+//   and blocks the calling fiber.
+//
+// - Within a few hundred milliseconds, a timer takes every pending
+//   change and publishes them in one transaction, with one SOA bump.
+//   If the same hostname was updated twice in that window, only the
+//   latest IP address gets written.
+//
+// - ACME challenge TXT changes from /acme-challenge go in the same
+//   batch. Repeated identical challenges for a hostname are written
+//   once, and a "clear" followed by new challenges becomes one DELETE
+//   and one INSERT.
+//
+// - Once the transaction commits (or fails), every waiting fiber
+//   resumes; failures are re-thrown in each of them, so HTTP
+//   responses still reflect what happened.
+var Future = Npm.require('fibers/future');
+
+DnsPublisher = {};
+
+// Map from hostname to {ipAddress, ttl, futures}. We use
+// Object.create(null) so that any hostname is a safe key.
+var pendingRegistrations = Object.create(null);
+// Map from hostname to {clearFirst, values, futures}, for ACME
+// challenges.
+var pendingAcmeChallenges = Object.create(null);
+var flushScheduled = false;
+var flushInProgress = false;
+
+DnsPublisher.stats = {
+  batches: 0,
+  hostnamesPublished: 0,
+  requestsCoalesced: 0,
+  acmeChallengeChanges: 0,
+  acmeRequestsCoalesced: 0,
+  acmeDuplicatesSkipped: 0,
+  failedBatches: 0
+};
+
+function scheduleFlush() {
+  if (flushScheduled) {
+    return;
+  }
+  flushScheduled = true;
+  Meteor.setTimeout(flush, Meteor.settings.DNS_PUBLISH_BATCH_MILLISECONDS);
+}
+
+function flush() {
+  flushScheduled = false;
+
+  // Only one batch at a time may be in flight. If one is, try again
+  // once it has had a chance to finish.
+  if (flushInProgress) {
+    scheduleFlush();
+    return;
+  }
+
+  var batch = pendingRegistrations;
+  pendingRegistrations = Object.create(null);
+  var acmeBatch = pendingAcmeChallenges;
+  pendingAcmeChallenges = Object.create(null);
+  var hostnames = Object.keys(batch);
+  var acmeHostnames = Object.keys(acmeBatch);
+  if (hostnames.length === 0 && acmeHostnames.length === 0) {
+    return;
+  }
+
+  var registrations = hostnames.map(function(hostname) {
+    return {hostname: hostname, ipAddress: batch[hostname].ipAddress,
+            ttl: batch[hostname].ttl};
+  });
+  var acmeChallenges = acmeHostnames.map(function(hostname) {
+    return {hostname: hostname,
+            clearFirst: acmeBatch[hostname].clearFirst,
+            values: acmeBatch[hostname].values};
+  });
+
+  var error = null;
+  flushInProgress = true;
+  try {
+    var acmeResult = withMysqlTransaction(mysqlQuery, function(transactionQuery) {
+      return publishDnsBatch(transactionQuery, registrations, acmeChallenges);
+    });
+    DnsPublisher.stats.batches += 1;
+    DnsPublisher.stats.hostnamesPublished += hostnames.length;
+    DnsPublisher.stats.acmeChallengeChanges += acmeHostnames.length;
+    DnsPublisher.stats.acmeDuplicatesSkipped += acmeResult.duplicatesSkipped;
+  } catch (e) {
+    console.error("Failed to publish a batch of " + hostnames.length + " hostname(s) and " +
+                  acmeHostnames.length + " ACME challenge change(s) to DNS", e);
+    DnsPublisher.stats.failedBatches += 1;
+    error = e;
+  } finally {
+    flushInProgress = false;
+  }
+
+  var futures = [];
+  hostnames.forEach(function(hostname) {
+    futures.push.apply(futures, batch[hostname].futures);
+  });
+  acmeHostnames.forEach(function(hostname) {
+    futures.push.apply(futures, acmeBatch[hostname].futures);
+  });
+  futures.forEach(function(future) {
+    if (error) {
+      future.throw(error);
+    } else {
+      future.return();
+    }
+  });
+}
+
+// Queue the A and wildcard A records for hostname, and wait until
+// they have been committed to MySQL. Must be called from a fiber.
+DnsPublisher.publishUserRegistration = function(hostname, ipAddress, ttl) {
+  var future = new Future();
+
+  var pending = pendingRegistrations[hostname];
+  if (pending) {
+    DnsPublisher.stats.requestsCoalesced += 1;
+  } else {
+    pending = pendingRegistrations[hostname] = {futures: []};
+  }
+  pending.ipAddress = ipAddress;
+  pending.ttl = ttl;
+  pending.futures.push(future);
+
+  scheduleFlush();
+  RequestMetrics.time('mysql', function() {
+    future.wait();
+  });
+};
+
+// Queue a change to hostname's _acme-challenge TXT records: add a
+// record with value, or, if value is empty, remove them all. Waits
+// until the change has been committed to MySQL. Must be called from a
+// fiber.
+DnsPublisher.publishAcmeChallenge = function(hostname, value) {
+  var future = new Future();
+
+  var pending = pendingAcmeChallenges[hostname];
+  if (pending) {
+    DnsPublisher.stats.acmeRequestsCoalesced += 1;
+  } else {
+    pending = pendingAcmeChallenges[hostname] = {clearFirst: false, values: [], futures: []};
+  }
+  if (value) {
+    if (pending.values.indexOf(value) === -1) {
+      pending.values.push(value);
+    } else {
+      DnsPublisher.stats.acmeDuplicatesSkipped += 1;
+    }
+  } else {
+    // Clearing discards anything queued before it.
+    pending.clearFirst = true;
+    pending.values = [];
+  }
+  pending.futures.push(future);
+
+  scheduleFlush();
+  RequestMetrics.time('mysql', function() {
+    future.wait();
+  });
+};
@@ -0,0 +1,158 @@
+// This file picks the TTL we publish for each hostname's A records.
+//
+// Most Sandstorm servers keep the same IP address for months, so a
+// one-minute TTL makes resolvers ask PowerDNS again and again for an
+// answer that never changes. Instead, we publish a TTL that grows with
+// how long the hostname's IP address has been stable:
+//
+// - When a hostname is registered, or /update changes its IP address,
+//   we store ipAddressChangedAt on its UserRegistration and publish
+//   SHORT_DNS_TTL_SECONDS, so that a host that is moving around
+//   propagates quickly.
+//
+// - Every hour, lengthenStableDnsTtls() finds hostnames that have
+//   been stable long enough for a longer TTL (see DNS_TTL_TIERS), and
+//   raises the TTL on their records in place.
+//
+// The catch is that when a long-stable host does move, resolvers may
+// keep the old address for up to the old TTL. DNS_MAX_TTL_SECONDS
+// caps how long that can be; setting it to 60 turns this off.
+//
+// UserRegistration.dnsTtl records the TTL we last published, so the
+// hourly job only touches hostnames whose TTL should change.
+
+SHORT_DNS_TTL_SECONDS = 60;
+
+var DAY_IN_SECONDS = 24 * 60 * 60;
+
+// After a hostname's IP address has been stable for stableSeconds, we
+// publish ttlSeconds. Sorted by stableSeconds.
+var DNS_TTL_TIERS = [
+  {stableSeconds: 0, ttlSeconds: SHORT_DNS_TTL_SECONDS},
+  {stableSeconds: DAY_IN_SECONDS, ttlSeconds: 5 * 60},
+  {stableSeconds: 7 * DAY_IN_SECONDS, ttlSeconds: 15 * 60},
+  {stableSeconds: 30 * DAY_IN_SECONDS, ttlSeconds: 60 * 60}
+];
+
+var DEFAULT_MAX_TTL_SECONDS = 60 * 60;
+var LENGTHEN_TTLS_INTERVAL_MILLISECONDS = 60 * 60 * 1000;
+
+// Same as in dns.js, to keep statements a reasonable size.
+var MAX_HOSTNAMES_PER_STATEMENT = 500;
+
+function maxTtlSeconds() {
+  return Meteor.settings.DNS_MAX_TTL_SECONDS || DEFAULT_MAX_TTL_SECONDS;
+}
+
+// Return the TTL to publish for a hostname whose IP address last
+// changed at ipAddressChangedAt, as of now (both Dates).
+adaptiveDnsTtl = function(ipAddressChangedAt, now) {
+  var stableSeconds = (now - ipAddressChangedAt) / 1000;
+  var ttlSeconds = SHORT_DNS_TTL_SECONDS;
+  DNS_TTL_TIERS.forEach(function(tier) {
+    if (stableSeconds >= tier.stableSeconds) {
+      ttlSeconds = tier.ttlSeconds;
+    }
+  });
+  return Math.max(SHORT_DNS_TTL_SECONDS, Math.min(ttlSeconds, maxTtlSeconds()));
+};
+
+// Give UserRegistrations from before we tracked IP address changes an
+// ipAddressChangedAt of now, so that their TTLs grow from here.
+migrateDnsTtlFields = function() {
+  var updated = UserRegistrations.update({
+    ipAddressChangedAt: {$exists: false}
+  }, {$set: {
+    ipAddressChangedAt: new Date(),
+    dnsTtl: SHORT_DNS_TTL_SECONDS
+  }}, {multi: true});
+  if (updated > 0) {
+    console.log("Started tracking IP address changes for", updated, "hostnames.");
+  }
+  return updated;
+};
+
+// Raise the TTL on the A and wildcard A records of every hostname that
+// has been stable long enough for a longer one. Returns the number of
+// hostnames changed.
+lengthenStableDnsTtls = function(mysqlQuery, now) {
+  var changed = 0;
+  var domain = Meteor.settings.BASE_DOMAIN;
+
+  // Longest first, so that a hostname goes straight to its final TTL
+  // rather than climbing through every tier.
+  DNS_TTL_TIERS.slice().reverse().forEach(function(tier) {
+    var ttlSeconds = Math.min(tier.ttlSeconds, maxTtlSeconds());
+    if (ttlSeconds <= SHORT_DNS_TTL_SECONDS) {
+      return;
+    }
+    var stableSince = new Date(now.getTime() - tier.stableSeconds * 1000);
+
+    function lengthenChunk(chunk) {
+      var names = [];
+      var namesAndContents = [];
+      chunk.forEach(function(registration) {
+        var host = registration.hostname + '.' + domain;
+        names.push(host, '*.' + host);
+        namesAndContents.push([host, registration.ipAddress],
+                              ['*.' + host, registration.ipAddress]);
+      });
+
+      withMysqlTransaction(mysqlQuery, function(transactionQuery) {
+        // MySQL 5.5 can't use an index for a row constructor IN, so
+        // "name IN" is what keeps this on the (name, type) index,
+        // rather than scanning (and locking) every row in the table.
+        //
+        // Matching on content too means that if a hostname moved since
+        // we read it, we leave its new, short-TTL records alone.
+        transactionQuery(
+          "UPDATE `records` SET ttl = ? WHERE domain_id = ? AND type = 'A' AND " +
+            "name IN (?) AND (name, content) IN (?)",
+          [ttlSeconds, getDomainId(transactionQuery, domain), names, namesAndContents]);
+        bumpSoaRecord(transactionQuery, domain);
+      });
+
+      // Likewise, a hostname that moved since we read it has a new
+      // ipAddressChangedAt, and keeps its short TTL.
+      changed += UserRegistrations.update({
+        _id: {$in: _.pluck(chunk, '_id')},
+        ipAddressChangedAt: {$lte: stableSince}
+      }, {$set: {dnsTtl: ttlSeconds}}, {multi: true});
+    }
+
+    // The first run after migrateDnsTtlFields() finds the whole fleet,
+    // so handle one chunk at a time as the cursor streams it, rather
+    // than fetch() them all. A hostname we have updated no longer
+    // matches dnsTtl < ttlSeconds, so the cursor won't return it again.
+    var chunk = [];
+    UserRegistrations.find({
+      dnsTtl: {$lt: ttlSeconds},
+      ipAddressChangedAt: {$lte: stableSince}
+    }, {fields: {hostname: 1, ipAddress: 1}}).forEach(function(registration) {
+      chunk.push(registration);
+      if (chunk.length >= MAX_HOSTNAMES_PER_STATEMENT) {
+        lengthenChunk(chunk);
+        chunk = [];
+      }
+    });
+    if (chunk.length > 0) {
+      lengthenChunk(chunk);
+    }
+  });
+
+  if (changed > 0) {
+    console.log("Lengthened the DNS TTL of", changed, "stable hostnames.");
+  }
+  return changed;
+};
+
+// Call lengthenStableDnsTtls() every hour.
+startLengtheningStableDnsTtls = function(mysqlQuery) {
+  Meteor.setInterval(function() {
+    try {
+      lengthenStableDnsTtls(mysqlQuery, new Date());
+    } catch (e) {
+      console.error("Failed to lengthen DNS TTLs", e);
+    }
+  }, LENGTHEN_TTLS_INTERVAL_MILLISECONDS);
+};
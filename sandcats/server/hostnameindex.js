@@ -0,0 +1,231 @@
+// This file contains an in-memory index from hostname to IP address.
+//
+// The UDP ping responder (see udppings.js) needs to answer "is this
+// hostname registered to this IP address?" for every packet it
+// receives. Asking MongoDB every time is our biggest source of Mongo
+// load, so instead we keep a copy of the (hostname, ipAddress) pairs
+// in memory.
+//
+// The index loads every UserRegistration when it starts, and stays
+// current by observing the UserRegistrations collection. Meteor uses
+// the MongoDB oplog for this if MONGO_OPLOG_URL is configured, and
+// falls back to polling otherwise.
+//
+// To give us a sense of how well this is working, the index keeps
+// some counters:
+//
+// - hits: lookups where the hostname is on file with this IP address.
+//
+// - misses: lookups where the hostname is unknown, or is on file with
+//   some other IP address.
+//
+// - fallbacks: lookups that happened before the initial load
+//   finished, and therefore went to MongoDB.
+//
+// - staleness: once in a while (see VERIFY_ONE_IN_N_LOOKUPS) we
+//   double-check a lookup against MongoDB. If the two disagree, we
+//   count that in staleSamples. We also report how long it has been
+//   since the observer last told us about a change.
+
+// Check roughly one in this many lookups against MongoDB.
+var VERIFY_ONE_IN_N_LOOKUPS = 1000;
+
+makeHostnameIpIndex = function(collection) {
+  var index = {};
+
+  // We use Object.create(null) so that hostnames like "constructor"
+  // do not collide with properties of Object.prototype.
+  var ipAddressByHostname = Object.create(null);
+  var hostnameById = Object.create(null);
+  // For version 2 UDP pings, which name hostnames by hash; see
+  // udppingprotocol.js.
+  var hostnamesByHash = makeUdpPingHostnameHashMap();
+
+  var observeHandle = null;
+  var lookupsSinceLastVerify = 0;
+  var changeListeners = [];
+
+  index.ready = false;
+  index.stats = {
+    size: 0,
+    lookups: 0,
+    hits: 0,
+    misses: 0,
+    fallbacks: 0,
+    verifiedSamples: 0,
+    staleSamples: 0,
+    changesApplied: 0,
+    lastChangeTimestamp: null,
+    initialLoadMilliseconds: null
+  };
+
+  function noteChange() {
+    index.stats.changesApplied += 1;
+    index.stats.lastChangeTimestamp = Date.now();
+  }
+
+  // Tell anyone listening (e.g., udppingfeed.js) that hostname now has
+  // ipAddress, or null if it was removed.
+  function notifyListeners(hostname, ipAddress) {
+    changeListeners.forEach(function(listener) {
+      listener(hostname, ipAddress);
+    });
+  }
+
+  function forgetId(id) {
+    var hostname = hostnameById[id];
+    if (hostname === undefined) {
+      return;
+    }
+    delete hostnameById[id];
+    if (hostname in ipAddressByHostname) {
+      delete ipAddressByHostname[hostname];
+      hostnamesByHash.remove(hostname);
+      index.stats.size -= 1;
+      notifyListeners(hostname, null);
+    }
+  }
+
+  function remember(id, hostname, ipAddress) {
+    if (hostnameById[id] !== hostname) {
+      forgetId(id);
+    }
+    hostnameById[id] = hostname;
+    if (! (hostname in ipAddressByHostname)) {
+      hostnamesByHash.add(hostname);
+      index.stats.size += 1;
+    }
+    ipAddressByHostname[hostname] = ipAddress;
+    notifyListeners(hostname, ipAddress);
+  }
+
+  // These are the callbacks we give to observeChanges(). They are
+  // exposed so that the unit tests can drive the index without
+  // waiting on MongoDB.
+  index.observeCallbacks = {
+    added: function(id, fields) {
+      remember(id, fields.hostname, fields.ipAddress);
+      noteChange();
+    },
+    changed: function(id, fields) {
+      var hostname = ('hostname' in fields) ? fields.hostname : hostnameById[id];
+      var ipAddress = ('ipAddress' in fields) ? fields.ipAddress : ipAddressByHostname[hostnameById[id]];
+      remember(id, hostname, ipAddress);
+      noteChange();
+    },
+    removed: function(id) {
+      forgetId(id);
+      noteChange();
+    }
+  };
+
+  // Load the index, and keep it up to date. Note that
+  // observeChanges() blocks until all the initial "added" callbacks
+  // have run, so once this returns, the index is ready for use.
+  index.start = function() {
+    if (observeHandle) {
+      console.log("You seem to have started the hostname index twice. Bailing out.");
+      return;
+    }
+    var startTime = Date.now();
+    observeHandle = collection.find({}, {
+      fields: {hostname: 1, ipAddress: 1}
+    }).observeChanges(index.observeCallbacks);
+    index.ready = true;
+    index.stats.initialLoadMilliseconds = Date.now() - startTime;
+    console.log("Loaded " + index.stats.size + " hostnames into the in-memory index in " +
+                index.stats.initialLoadMilliseconds + " ms.");
+  };
+
+  index.stop = function() {
+    if (observeHandle) {
+      observeHandle.stop();
+      observeHandle = null;
+    }
+    index.ready = false;
+  };
+
+  // Call callback(hostname, ipAddress) for every entry in the index.
+  index.forEach = function(callback) {
+    for (var hostname in ipAddressByHostname) {
+      callback(hostname, ipAddressByHostname[hostname]);
+    }
+  };
+
+  // Call listener(hostname, ipAddress) whenever an entry changes;
+  // ipAddress is null when a hostname goes away. Returns a function
+  // that stops listening.
+  index.onChange = function(listener) {
+    changeListeners.push(listener);
+    return function() {
+      changeListeners = _.without(changeListeners, listener);
+    };
+  };
+
+  // Return the hostnames whose version 2 UDP ping hash is hash; see
+  // hashUdpPingHostname(). Usually there is at most one.
+  index.getHostnamesForHash = function(hash) {
+    return hostnamesByHash.get(hash);
+  };
+
+  index.getIpAddress = function(hostname) {
+    if (hostname in ipAddressByHostname) {
+      return ipAddressByHostname[hostname];
+    }
+    return null;
+  };
+
+  function verifyAgainstMongo(hostname, ipAddress, answer) {
+    var mongoAnswer = !! collection.findOne({ipAddress: ipAddress, hostname: hostname});
+    index.stats.verifiedSamples += 1;
+    if (mongoAnswer !== answer) {
+      index.stats.staleSamples += 1;
+      console.log("Hostname index disagreed with MongoDB about " + hostname +
+                  " at " + ipAddress + "; index said " + answer + ".");
+    }
+  }
+
+  // Return true if the hostname is registered with this IP address.
+  //
+  // If the index has not finished loading, we ask MongoDB instead, so
+  // this must be called from within a fiber.
+  index.hostnameHasIpAddress = function(hostname, ipAddress) {
+    index.stats.lookups += 1;
+
+    if (! index.ready) {
+      index.stats.fallbacks += 1;
+      return !! collection.findOne({ipAddress: ipAddress, hostname: hostname});
+    }
+
+    var answer = (index.getIpAddress(hostname) === ipAddress);
+    if (answer) {
+      index.stats.hits += 1;
+    } else {
+      index.stats.misses += 1;
+    }
+
+    lookupsSinceLastVerify += 1;
+    if (lookupsSinceLastVerify >= VERIFY_ONE_IN_N_LOOKUPS) {
+      lookupsSinceLastVerify = 0;
+      Meteor.defer(function() {
+        verifyAgainstMongo(hostname, ipAddress, answer);
+      });
+    }
+
+    return answer;
+  };
+
+  // Return a copy of the counters, plus how stale the index might be.
+  index.getStats = function() {
+    var stats = _.clone(index.stats);
+    stats.ready = index.ready;
+    stats.millisecondsSinceLastChange = (
+      stats.lastChangeTimestamp ? (Date.now() - stats.lastChangeTimestamp) : null);
+    return stats;
+  };
+
+  return index;
+};
+
+// The one index the server uses.
+HostnameIpIndex = makeHostnameIpIndex(UserRegistrations);
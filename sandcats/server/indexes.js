@@ -0,0 +1,87 @@
+// This file declares the MongoDB indexes our queries rely on, and
+// checks that MongoDB really uses them.
+//
+// ensureMongoIndexes() runs at startup. The unique indexes back up the
+// Mesosphere rules (hostnameUnused, keyFingerprintUnique, and the
+// domain reservation checks), so that two simultaneous /register
+// calls can't both get the same hostname or key.
+//
+// checkHotQueryIndexes() asks MongoDB to explain each query on our hot
+// paths, and complains loudly if any of them would scan a whole
+// collection. It runs at startup too, and you can call it from
+// "meteor shell" after changing a query.
+
+var MONGO_INDEXES = [
+  {collection: UserRegistrations, fields: {hostname: 1}, options: {unique: true}},
+  {collection: UserRegistrations, fields: {publicKeyId: 1}, options: {unique: true}},
+  {collection: UserRegistrations, fields: {dnsTtl: 1, ipAddressChangedAt: 1}},
+  {collection: DomainReservations, fields: {hostname: 1}, options: {unique: true}},
+  {collection: CertificateRequests, fields: {hostname: 1, certificateEndDate: 1}},
+  {collection: CertificateRequests, fields: {devOrProd: 1, receivedCertificateDate: 1}},
+  {collection: CertificateRequests, fields: {devOrProd: 1, requestCreationDate: 1}},
+  {collection: CertificateDailyCounts, fields: {devOrProd: 1, day: 1}}
+];
+
+// The queries on our hot paths, with example values. Each should be
+// answered from an index.
+var HOT_QUERIES = [
+  {collection: UserRegistrations, selector: {hostname: 'example'}},
+  {collection: UserRegistrations, selector: {publicKeyId: '0123456789012345678901234567890123456789'}},
+  {collection: UserRegistrations, selector: {
+    publicKeyId: '0123456789012345678901234567890123456789', hostname: 'example'}},
+  {collection: UserRegistrations, selector: {ipAddress: '127.0.0.1', hostname: 'example'}},
+  {collection: UserRegistrations, selector: {
+    dnsTtl: {$lt: 3600}, ipAddressChangedAt: {$lte: new Date()}}},
+  {collection: DomainReservations, selector: {hostname: 'example'}},
+  {collection: CertificateRequests, selector: {
+    hostname: 'example', certificateEndDate: {$gte: new Date()},
+    certificateStartDate: {$lte: new Date()}}},
+  {collection: CertificateRequests, selector: {
+    devOrProd: 'prod', globalsignCertificateInfo: {$exists: true},
+    receivedCertificateDate: {$gte: new Date(0), $lte: new Date()}}}
+];
+
+ensureMongoIndexes = function() {
+  MONGO_INDEXES.forEach(function(index) {
+    try {
+      index.collection._ensureIndex(index.fields, index.options || {});
+    } catch (e) {
+      // Most likely, existing data violates a unique index. Keep
+      // running, but make sure someone notices.
+      console.error("!!! Could not create index " + JSON.stringify(index.fields) +
+                    " on " + index.collection._name + ": " + e);
+    }
+  });
+};
+
+function rawMongoCollection(collection) {
+  return MongoInternals.defaultRemoteCollectionDriver().mongo.db.collection(collection._name);
+}
+
+// Return true if an explain() result describes a full collection scan.
+// MongoDB 2.x reports a "BasicCursor"; 3.x reports a COLLSCAN stage.
+function explainShowsCollectionScan(explanation) {
+  var text = JSON.stringify(explanation);
+  return (text.indexOf('"BasicCursor"') !== -1 ||
+          text.indexOf('"COLLSCAN"') !== -1);
+}
+
+// Explain every hot query. Returns a list of {collection, selector,
+// collectionScan}, and logs a warning for each collection scan.
+checkHotQueryIndexes = function() {
+  return HOT_QUERIES.map(function(query) {
+    var cursor = rawMongoCollection(query.collection).find(query.selector);
+    var explanation = Meteor.wrapAsync(cursor.explain, cursor)();
+    var collectionScan = explainShowsCollectionScan(explanation);
+    if (collectionScan) {
+      console.error("!!! Query " + JSON.stringify(query.selector) + " on " +
+                    query.collection._name + " scans the whole collection. " +
+                    "Add an index for it to indexes.js.");
+    }
+    return {
+      collection: query.collection._name,
+      selector: query.selector,
+      collectionScan: collectionScan
+    };
+  });
+};
@@ -0,0 +1,72 @@
+// Helpers for keeping simple in-process performance measurements.
+
+// Upper bounds, in milliseconds, of the buckets in a latency
+// histogram. The last bucket catches everything slower.
+var LATENCY_BUCKET_BOUNDS_MILLISECONDS = [
+  0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000];
+
+// Return the number of milliseconds elapsed since startTime, where
+// startTime came from process.hrtime().
+millisecondsSince = function(startTime) {
+  var elapsed = process.hrtime(startTime);
+  return (elapsed[0] * 1000) + (elapsed[1] / 1e6);
+};
+
+// Create a fixed-bucket latency histogram. It uses a constant amount
+// of memory no matter how many samples it records.
+makeLatencyHistogram = function() {
+  var histogram = {};
+  var counts = LATENCY_BUCKET_BOUNDS_MILLISECONDS.map(function() { return 0; });
+  var overflowCount = 0;
+  var totalCount = 0;
+  var totalMilliseconds = 0;
+  var maxMilliseconds = 0;
+
+  histogram.record = function(milliseconds) {
+    totalCount += 1;
+    totalMilliseconds += milliseconds;
+    maxMilliseconds = Math.max(maxMilliseconds, milliseconds);
+    for (var i = 0; i < LATENCY_BUCKET_BOUNDS_MILLISECONDS.length; i++) {
+      if (milliseconds <= LATENCY_BUCKET_BOUNDS_MILLISECONDS[i]) {
+        counts[i] += 1;
+        return;
+      }
+    }
+    overflowCount += 1;
+  };
+
+  // Estimate a percentile (0-100) as the upper bound of the bucket
+  // that contains it.
+  histogram.percentile = function(percentile) {
+    if (totalCount === 0) {
+      return null;
+    }
+    var wanted = Math.ceil(totalCount * percentile / 100);
+    var seen = 0;
+    for (var i = 0; i < counts.length; i++) {
+      seen += counts[i];
+      if (seen >= wanted) {
+        return LATENCY_BUCKET_BOUNDS_MILLISECONDS[i];
+      }
+    }
+    return maxMilliseconds;
+  };
+
+  histogram.snapshot = function() {
+    var buckets = {};
+    for (var i = 0; i < counts.length; i++) {
+      buckets['<=' + LATENCY_BUCKET_BOUNDS_MILLISECONDS[i]] = counts[i];
+    }
+    buckets['>' + LATENCY_BUCKET_BOUNDS_MILLISECONDS[counts.length - 1]] = overflowCount;
+    return {
+      count: totalCount,
+      meanMilliseconds: totalCount ? (totalMilliseconds / totalCount) : null,
+      maxMilliseconds: maxMilliseconds,
+      p50Milliseconds: histogram.percentile(50),
+      p99Milliseconds: histogram.percentile(99),
+      buckets: buckets
+    };
+  };
+
+  return histogram;
+};
@@ -0,0 +1,156 @@
+// This file wraps the node mysql connection pool that we use to talk
+// to the PowerDNS database.
+//
+// On top of the plain pool, it:
+//
+// - Pings a connection before handing it out, if the connection sat
+//   idle long enough that MySQL might have closed it (see MySQL's
+//   wait_timeout). If the ping fails, we throw the connection away and
+//   try another one, which the pool opens as needed. So a restarted
+//   MySQL server or a stale connection costs one ping rather than a
+//   failed /update.
+//
+// - Throws away any connection that had a fatal error, rather than
+//   returning it to the pool.
+//
+// - Keeps latency histograms of how long callers wait for a
+//   connection, and how long queries take.
+//
+// Time callers spend waiting on MySQL counts as "mysql" in the
+// per-route metrics; see requestmetrics.js.
+
+// How many times to look for a working connection before giving up.
+var MAX_CONNECTION_ATTEMPTS = 3;
+
+var DEFAULT_CONNECTION_LIMIT = 5;
+var DEFAULT_VALIDATE_IDLE_MILLISECONDS = 30 * 1000;
+
+makeMysqlPool = function(options) {
+  var mysql = Meteor.npmRequire('mysql');
+  var pool = mysql.createPool({
+    connectionLimit: options.connectionLimit || DEFAULT_CONNECTION_LIMIT,
+    // 0 means an unlimited queue, which is also the mysql default.
+    queueLimit: options.queueLimit || 0,
+    host: options.host,
+    user: options.user,
+    database: options.database,
+    password: options.password});
+  var validateIdleMilliseconds = (
+    options.validateIdleMilliseconds === undefined ?
+      DEFAULT_VALIDATE_IDLE_MILLISECONDS : options.validateIdleMilliseconds);
+
+  var waitHistogram = makeLatencyHistogram();
+  var queryHistogram = makeLatencyHistogram();
+  var stats = {validations: 0, validationFailures: 0, discardedConnections: 0};
+
+  function getValidConnection(attemptsLeft, callback) {
+    var startTime = process.hrtime();
+    pool.getConnection(function(err, connection) {
+      if (err) {
+        return callback(err);
+      }
+      waitHistogram.record(millisecondsSince(startTime));
+
+      // New connections have never been released, and don't need a ping.
+      var lastReleased = connection.sandcatsLastReleased;
+      if (! lastReleased || (Date.now() - lastReleased) < validateIdleMilliseconds) {
+        return callback(null, connection);
+      }
+
+      stats.validations += 1;
+      connection.ping(function(err) {
+        if (! err) {
+          return callback(null, connection);
+        }
+        stats.validationFailures += 1;
+        console.log("Discarding stale MySQL connection:", err.code || err);
+        connection.destroy();
+        if (attemptsLeft <= 1) {
+          return callback(err);
+        }
+        getValidConnection(attemptsLeft - 1, callback);
+      });
+    });
+  }
+
+  // Return a connection to the pool, or destroy it if err says it is
+  // no longer usable. The pool opens a new one when it needs to.
+  function releaseConnection(connection, err) {
+    if (err && err.fatal) {
+      stats.discardedConnections += 1;
+      connection.destroy();
+      return;
+    }
+    connection.sandcatsLastReleased = Date.now();
+    connection.release();
+  }
+
+  function timedQuery(connection, sql, values, callback) {
+    var startTime = process.hrtime();
+    connection.query(sql, values, function(err, result) {
+      queryHistogram.record(millisecondsSince(startTime));
+      callback(err, result);
+    });
+  }
+
+  function query(sql, values, callback) {
+    if (typeof values === 'function') {
+      callback = values;
+      values = undefined;
+    }
+    getValidConnection(MAX_CONNECTION_ATTEMPTS, function(err, connection) {
+      if (err) {
+        return callback(err);
+      }
+      timedQuery(connection, sql, values, function(err, result) {
+        releaseConnection(connection, err);
+        callback(err, result);
+      });
+    });
+  }
+
+  // Run fn, a call that blocks on MySQL, counting the time as mysql.
+  function timed(fn) {
+    return function(/* arguments */) {
+      var args = arguments;
+      return RequestMetrics.time('mysql', function() {
+        return fn.apply(null, args);
+      });
+    };
+  }
+
+  // The result works like the old wrapped pool.query: call it from a
+  // fiber, and it returns the rows or throws.
+  var wrappedQuery = timed(Meteor.wrapAsync(query));
+
+  // For transactions: check out one connection, run queries on it via
+  // wrappedQuery.connectionQuery(connection), and hand it back with
+  // wrappedQuery.releaseConnection(connection, errorIfAny).
+  wrappedQuery.getConnection = timed(Meteor.wrapAsync(function(callback) {
+    getValidConnection(MAX_CONNECTION_ATTEMPTS, callback);
+  }));
+  wrappedQuery.connectionQuery = function(connection) {
+    return timed(Meteor.wrapAsync(function(sql, values, callback) {
+      if (typeof values === 'function') {
+        callback = values;
+        values = undefined;
+      }
+      timedQuery(connection, sql, values, callback);
+    }));
+  };
+  wrappedQuery.releaseConnection = releaseConnection;
+
+  wrappedQuery.getStats = function() {
+    var result = _.clone(stats);
+    // These are internals of the mysql module's Pool.
+    result.openConnections = pool._allConnections.length;
+    result.freeConnections = pool._freeConnections.length;
+    result.queuedRequests = pool._connectionQueue.length;
+    result.connectionWait = waitHistogram.snapshot();
+    result.queryLatency = queryHistogram.snapshot();
+    return result;
+  };
+
+  wrappedQuery.pool = pool;
+  return wrappedQuery;
+};
@@ -0,0 +1,239 @@
+// This file compares UserRegistrations, which is where the truth
+// lives, with the A records in PowerDNS's MySQL database, and fixes
+// any differences.
+//
+// That is how we rebuild the zone after losing the MySQL database, and
+// how we find drift between MongoDB and DNS, without one
+// publishOneUserRegistrationToDns() call (and SOA bump) per hostname.
+//
+// reconcileDns() walks UserRegistrations in hostname order,
+// chunkSize at a time. For each chunk, it reads the A records of
+// those hostnames with one SELECT, and then rewrites the ones that are
+// missing or wrong with publishUserRegistrationsToDns(), i.e.,
+// multi-row DELETEs and INSERTs and one SOA bump per chunk. Chunks that
+// are already right cost one MongoDB query and one SELECT.
+//
+// Then it walks the A records, looking for hostnames that MongoDB
+// doesn't know about ("orphans"). It only deletes those if asked to.
+//
+// With dryRun, it changes nothing, and only reports what it would do.
+//
+// POST to /reconcile-dns directly on the Meteor port (not via nginx)
+// to run it; see doReconcileDns() and "make action-reconcile-dns".
+//
+// Registrations that change while this runs are published by their
+// own requests as usual. In the worst case, we rewrite a hostname
+// with the value MongoDB had a moment ago, and the next run fixes it.
+
+var DEFAULT_CHUNK_SIZE = 1000;
+// How many hostnames to list in the report, per kind of problem.
+var MAX_EXAMPLES = 20;
+
+function expectedTtl(registration) {
+  return registration.dnsTtl || SHORT_DNS_TTL_SECONDS;
+}
+
+function addExample(list, hostname) {
+  if (list.length < MAX_EXAMPLES) {
+    list.push(hostname);
+  }
+}
+
+// Return "missing", "wrong", or null if the A records of
+// registration, i.e. the rows for its hostname and its wildcard, are
+// what we would publish.
+function diffRegistration(registration, rowsByName, domain) {
+  var host = registration.hostname + '.' + domain;
+  var names = [host, '*.' + host];
+  var missing = false;
+  for (var i = 0; i < names.length; i++) {
+    var rows = rowsByName[names[i]];
+    if (! rows) {
+      missing = true;
+      continue;
+    }
+    // A NULL ttl means PowerDNS's default-ttl, which is the short TTL.
+    if (rows.length !== 1 ||
+        rows[0].content !== registration.ipAddress ||
+        (rows[0].ttl || SHORT_DNS_TTL_SECONDS) !== expectedTtl(registration)) {
+      return 'wrong';
+    }
+  }
+  return missing ? 'missing' : null;
+}
+
+function reconcileRegistrations(mysqlQuery, domainId, options, report) {
+  var domain = Meteor.settings.BASE_DOMAIN;
+  var lastHostname = null;
+
+  while (true) {
+    // Page by hostname rather than holding one cursor open for the
+    // whole run.
+    var selector = lastHostname === null ? {} : {hostname: {$gt: lastHostname}};
+    var registrations = UserRegistrations.find(selector, {
+      sort: {hostname: 1},
+      limit: options.chunkSize,
+      fields: {hostname: 1, ipAddress: 1, dnsTtl: 1}
+    }).fetch();
+    if (registrations.length === 0) {
+      return;
+    }
+    lastHostname = registrations[registrations.length - 1].hostname;
+    report.chunks += 1;
+    report.registrationsChecked += registrations.length;
+
+    var names = [];
+    registrations.forEach(function(registration) {
+      var host = registration.hostname + '.' + domain;
+      names.push(host, '*.' + host);
+    });
+    var rowsByName = Object.create(null);
+    mysqlQuery(
+      "SELECT name, content, ttl FROM `records` WHERE domain_id = ? AND type = 'A' AND name IN (?)",
+      [domainId, names]).forEach(function(row) {
+        (rowsByName[row.name] = rowsByName[row.name] || []).push(row);
+      });
+
+    var toPublish = [];
+    registrations.forEach(function(registration) {
+      var difference = diffRegistration(registration, rowsByName, domain);
+      if (difference === 'missing') {
+        report.hostnamesMissing += 1;
+        addExample(report.examples.missing, registration.hostname);
+      } else if (difference === 'wrong') {
+        report.hostnamesWrong += 1;
+        addExample(report.examples.wrong, registration.hostname);
+      } else {
+        report.hostnamesInSync += 1;
+        return;
+      }
+      toPublish.push({hostname: registration.hostname,
+                      ipAddress: registration.ipAddress,
+                      ttl: expectedTtl(registration)});
+    });
+
+    if (toPublish.length > 0 && ! options.dryRun) {
+      withMysqlTransaction(mysqlQuery, function(transactionQuery) {
+        publishUserRegistrationsToDns(transactionQuery, toPublish);
+      });
+      report.hostnamesRepaired += toPublish.length;
+    }
+  }
+}
+
+// Return the hostname that an A record named name belongs to, or null
+// if it isn't one of ours, e.g. the apex of the zone.
+function hostnameFromRecordName(name, domain) {
+  var suffix = '.' + domain;
+  if (name.length <= suffix.length ||
+      name.slice(-suffix.length) !== suffix) {
+    return null;
+  }
+  var hostname = name.slice(0, -suffix.length);
+  if (hostname.indexOf('*.') === 0) {
+    hostname = hostname.slice(2);
+  }
+  return hostname.match(/[.]/) ? null : hostname;
+}
+
+function findOrphanRecords(mysqlQuery, domainId, options, report) {
+  var domain = Meteor.settings.BASE_DOMAIN;
+  var lastId = 0;
+
+  while (true) {
+    var rows = mysqlQuery(
+      "SELECT id, name FROM `records` WHERE domain_id = ? AND type = 'A' AND id > ? " +
+        "ORDER BY id LIMIT ?",
+      [domainId, lastId, options.chunkSize]);
+    if (rows.length === 0) {
+      return;
+    }
+    lastId = rows[rows.length - 1].id;
+
+    var hostnames = _.uniq(_.compact(rows.map(function(row) {
+      return hostnameFromRecordName(row.name, domain);
+    })));
+    var known = Object.create(null);
+    UserRegistrations.find({hostname: {$in: hostnames}},
+                           {fields: {hostname: 1}}).forEach(function(registration) {
+      known[registration.hostname] = true;
+    });
+
+    var orphanIds = [];
+    rows.forEach(function(row) {
+      var hostname = hostnameFromRecordName(row.name, domain);
+      if (hostname !== null && ! known[hostname]) {
+        orphanIds.push(row.id);
+        addExample(report.examples.orphans, row.name);
+      }
+    });
+    report.orphanRecords += orphanIds.length;
+
+    if (orphanIds.length > 0 && options.deleteOrphans && ! options.dryRun) {
+      withMysqlTransaction(mysqlQuery, function(transactionQuery) {
+        transactionQuery("DELETE FROM `records` WHERE id IN (?)", [orphanIds]);
+        bumpSoaRecord(transactionQuery, domain);
+      });
+      report.orphanRecordsDeleted += orphanIds.length;
+    }
+  }
+}
+
+// Make the A records in PowerDNS match UserRegistrations. Options:
+//
+// - dryRun: if true, only report differences.
+//
+// - chunkSize: how many hostnames (or records) to handle at a time.
+//
+// - deleteOrphans: if true, delete A records for hostnames that have
+//   no UserRegistration.
+//
+// Returns a report of what it found and did.
+reconcileDns = function(mysqlQuery, options) {
+  options = _.extend({dryRun: false, chunkSize: DEFAULT_CHUNK_SIZE, deleteOrphans: false},
+                     options);
+  var report = {
+    dryRun: !! options.dryRun,
+    chunks: 0,
+    registrationsChecked: 0,
+    hostnamesInSync: 0,
+    hostnamesMissing: 0,
+    hostnamesWrong: 0,
+    hostnamesRepaired: 0,
+    orphanRecords: 0,
+    orphanRecordsDeleted: 0,
+    examples: {missing: [], wrong: [], orphans: []}
+  };
+
+  var startTime = process.hrtime();
+  var domainId = getDomainId(mysqlQuery, Meteor.settings.BASE_DOMAIN);
+  reconcileRegistrations(mysqlQuery, domainId, options, report);
+  findOrphanRecords(mysqlQuery, domainId, options, report);
+  report.milliseconds = millisecondsSince(startTime);
+
+  console.log("Reconciled DNS with UserRegistrations" + (report.dryRun ? " (dry run)" : "") +
+              ": checked " + report.registrationsChecked + " hostname(s); " +
+              report.hostnamesMissing + " missing, " + report.hostnamesWrong + " wrong, " +
+              report.hostnamesRepaired + " repaired; " + report.orphanRecords +
+              " orphan record(s), " + report.orphanRecordsDeleted + " deleted; in " +
+              report.milliseconds.toFixed(1) + " ms.");
+  return report;
+};
+
+doReconcileDns = function(request, response) {
+  if (! requestIsFromLocalhostDirectly(request)) {
+    return finishResponse(403, {'text': 'Only available from localhost.'}, response);
+  }
+  if (request.method != 'POST') {
+    return finishResponse(403, {'text': 'Must POST.'}, response);
+  }
+
+  var body = request.body || {};
+  var chunkSize = parseInt(body.chunkSize, 10);
+  var report = reconcileDns(mysqlQuery, {
+    dryRun: !! body.dryRun && body.dryRun !== '0',
+    chunkSize: chunkSize > 0 ? chunkSize : DEFAULT_CHUNK_SIZE,
+    deleteOrphans: !! body.deleteOrphans && body.deleteOrphans !== '0'
+  });
+  return finishResponse(200, report, response);
+};
@@ -1,3 +1,7 @@
+// What we say when a registration changed between validating a
+// request and writing it, e.g. because of a concurrent /recover.
+var REGISTRATION_CHANGED_TEXT = 'Your registration changed while we were handling this request. Please try again.';
+
 finishResponse = function(status, jsonData, response, plainTextOnly) {
   if (plainTextOnly) {
     // If the client really really wants plain text, then we hope that
@@ -97,6 +101,26 @@ getClientIpFromRequest = function(request) {
   return clientIp || "";
 }
 
+// Like Email.send(), but counts the time as "email" in the request
+// metrics; see requestmetrics.js.
+function sendEmail(options) {
+  RequestMetrics.time('email', function() {
+    Email.send(options);
+  });
+}
+
+// Return true if the request came straight to Meteor from this
+// machine, rather than through nginx.
+requestIsFromLocalhostDirectly = function(request) {
+  // nginx always sets X-Real-IP, so a request without it did not come
+  // through nginx.
+  if (request.headers['x-real-ip']) {
+    return false;
+  }
+  var remoteAddress = request.connection.remoteAddress;
+  return _.contains(['127.0.0.1', '::1', '::ffff:127.0.0.1'], remoteAddress);
+};
+
 wantsPlainText = function(request) {
   // If the HTTP client can only handle a text/plain response, the
   // Sandcats code honors that by throwing away everything but the
@@ -122,7 +146,9 @@ doRegister = function(request, response) {
   var rawFormData = getFormDataFromRequest(request);
   var plainTextOnly = wantsPlainText(request);
 
-  var validatedFormData = Mesosphere.registerForm.validate(rawFormData);
+  var validatedFormData = RequestMetrics.time('validation', function() {
+    return Mesosphere.registerForm.validate(rawFormData);
+  });
   if (validatedFormData.errors) {
     return finishResponse(400,
                           responseFromFormFailure(validatedFormData),
@@ -166,7 +192,9 @@ doSendRecoveryToken = function(request, response) {
   var rawFormData = getFormDataFromRequest(request);
   var plainTextOnly = wantsPlainText(request);
 
-  var validatedFormData = Mesosphere.recoverytokenForm.validate(rawFormData);
+  var validatedFormData = RequestMetrics.time('validation', function() {
+    return Mesosphere.recoverytokenForm.validate(rawFormData);
+  });
   if (validatedFormData.errors) {
     return finishResponse(400,
                           responseFromFormFailure(validatedFormData),
@@ -186,10 +214,11 @@ doSendRecoveryToken = function(request, response) {
   if (validatedFormData.formData.okToSendRecoveryToken) {
     // Get the corresponding UserRegistration object, and then
     // give it a fresh recoveryData attribute.
-    var recoveryToken = addRecoveryData(validatedFormData.formData);
-
-    var userRegistration = UserRegistrations.findOne({
-      hostname: validatedFormData.formData.rawHostname});
+    var userRegistration = addRecoveryData(validatedFormData.formData);
+    if (! userRegistration) {
+      return finishResponse(409, {'text': REGISTRATION_CHANGED_TEXT}, response, plainTextOnly);
+    }
+    var recoveryToken = userRegistration.recoveryData.recoveryToken;
 
     SSR.compileTemplate('recoveryTokenEmail', Assets.getText('recoveryTokenEmail.txt'));
 
@@ -199,15 +228,16 @@ doSendRecoveryToken = function(request, response) {
     });
 
     // Send the user an email with this token.
-    Email.send({
+    sendEmail({
       from: Meteor.settings.EMAIL_FROM_ADDRESS,
       to: userRegistration.emailAddress,
       subject: "Recovering your domain name",
       text: emailBody,
       headers: {
-        // This header is used by the automated test suite, to avoid
+        // These headers are used by the automated test suite, to avoid
         // having to parse the body of the email.
         'X-Sandcats-recoveryToken': recoveryToken,
+        'X-Sandcats-hostname': userRegistration.hostname,
         // We set these headers to avoid email auto-replies from people
         // who are on vacation, etc.
         //
@@ -249,7 +279,9 @@ doRecover = function(request, response) {
   var rawFormData = getFormDataFromRequest(request);
   var plainTextOnly = wantsPlainText(request);
 
-  var validatedFormData = Mesosphere.recoverDomainForm.validate(rawFormData);
+  var validatedFormData = RequestMetrics.time('validation', function() {
+    return Mesosphere.recoverDomainForm.validate(rawFormData);
+  });
   if (validatedFormData.errors) {
     return finishResponse(400,
                           responseFromFormFailure(validatedFormData),
@@ -261,18 +293,28 @@ doRecover = function(request, response) {
     // OK. Let's update the domain to have this new key.
     console.log("Recovery authorized. Updating " + validatedFormData.formData.rawHostname);
 
-    UserRegistrations.update({
-      hostname: validatedFormData.formData.rawHostname
-    }, {$set: {
+    var changes = {
       // Actually update the domain to use the new key.
       publicKeyId: validatedFormData.formData.pubkey,
       // Throw away the recovery data, so it can't be used twice.
       recoveryData: null
-    }});
+    };
+    // Matching on the recovery token means that if two requests race
+    // to use it, only one of them wins.
+    var updated = UserRegistrations.update({
+      hostname: validatedFormData.formData.rawHostname,
+      'recoveryData.recoveryToken': validatedFormData.formData.recoveryToken
+    }, {$set: changes});
+    if (updated !== 1) {
+      console.log("Recovery of " + validatedFormData.formData.rawHostname +
+                  " matched no UserRegistration; it changed since validation.");
+      return finishResponse(409, {'text': REGISTRATION_CHANGED_TEXT}, response, plainTextOnly);
+    }
 
-    var userRegistration = UserRegistrations.findOne({
-      hostname: validatedFormData.formData.rawHostname
-    });
+    // recoveryIsAuthorized looked this registration up already.
+    var userRegistration = RegistrationLookups.recordUpdate(
+      RegistrationLookups.findByHostname(validatedFormData.formData.rawHostname),
+      changes);
 
     SSR.compileTemplate('recoverySuccessfulEmail', Assets.getText('recoverySuccessfulEmail.txt'));
 
@@ -281,12 +323,14 @@ doRecover = function(request, response) {
     });
 
     // Send the user an email saying that their domain was recovered.
-    Email.send({
+    sendEmail({
       from: Meteor.settings.EMAIL_FROM_ADDRESS,
       to: userRegistration.emailAddress,
       subject: "You successfully recovered your domain name",
       text: emailBody,
       headers: {
+        // This header is used by the automated test suite.
+        'X-Sandcats-hostname': userRegistration.hostname,
         // We set these headers to avoid email auto-replies from
         // people who are on vacation, etc.
         //
@@ -307,15 +351,21 @@ doRecover = function(request, response) {
 createUserRegistration = function(formData) {
   // To create a user registration, we mostly copy data from the form. We allow SimpleSchema to
   // validate it.
-  var userRegistrationId = UserRegistrations.insert({
+  var userRegistration = {
     hostname: formData.rawHostname,
     ipAddress: formData.ipAddress,
     publicKeyId: formData.pubkey,
-    emailAddress: formData.email
-  });
+    emailAddress: formData.email,
+    // New hostnames start with a short DNS TTL; see dnsttl.js.
+    ipAddressChangedAt: new Date(),
+    dnsTtl: SHORT_DNS_TTL_SECONDS
+  };
+  // insert() throws if the registration doesn't validate, so if we
+  // get past it, it stuck.
+  userRegistration._id = UserRegistrations.insert(userRegistration);
+  RegistrationLookups.recordInsert(userRegistration);
 
-  // Make sure it stuck, and log that it worked.
-  var userRegistration = UserRegistrations.findOne({_id: userRegistrationId});
+  // Log that it worked.
   console.log("Created UserRegistration with these details: %s",
               JSON.stringify(userRegistration));
 
@@ -323,7 +373,8 @@ createUserRegistration = function(formData) {
   publishOneUserRegistrationToDns(
     mysqlQuery,
     userRegistration.hostname,
-    userRegistration.ipAddress);
+    userRegistration.ipAddress,
+    userRegistration.dnsTtl);
   // TODO(someday): We could send a confirmation email if we wanted.
 }
 
@@ -347,13 +398,21 @@ function addRecoveryData(formData) {
   // Always just toss it onto the corresponding UserRegistration
   // record. (We will only send the recoveryToken to email address
   // on file.)
-  UserRegistrations.update({
+  var updated = UserRegistrations.update({
     hostname: formData.rawHostname
   }, {$set: {recoveryData: recoveryData}});
+  if (updated !== 1) {
+    console.log("Adding recovery data to " + formData.rawHostname +
+                " matched no UserRegistration; it changed since validation.");
+    return null;
+  }
 
-  // Return the recoveryToken so that the caller can place it in email
-  // headers, etc.
-  return recoveryData.recoveryToken;
+  // Return the updated registration, so that the caller can place the
+  // recoveryToken in email headers, etc. domainExistsSoCanBeRecovered
+  // looked it up already.
+  return RegistrationLookups.recordUpdate(
+    RegistrationLookups.findByHostname(formData.rawHostname),
+    {recoveryData: recoveryData});
 }
 
 function updateUserRegistration(formData) {
@@ -363,12 +422,38 @@ function updateUserRegistration(formData) {
   // do the lookup, and then update whatever hostname is
   // registered to the key fingerprint.
   //
-  // Finally, we publish this to DNS.
-  UserRegistrations.update({
-    publicKeyId: formData.pubkey
-  }, {$set: {ipAddress: formData.ipAddress}});
+  // Finally, we publish this to DNS, and return the updated
+  // registration, or null if it changed since we validated the request.
+  //
+  // hostnameAndPubkeyMatch looked this registration up already, so
+  // this doesn't read MongoDB again.
+  var oldUserRegistration = RegistrationLookups.findByPublicKeyId(formData.pubkey);
+
+  // If the IP address changed, drop back to a short DNS TTL so the
+  // change propagates quickly. If not, publish the TTL the hostname's
+  // stability has earned. See dnsttl.js.
+  var changes = {ipAddress: formData.ipAddress};
+  if (oldUserRegistration.ipAddress !== formData.ipAddress ||
+      ! oldUserRegistration.ipAddressChangedAt) {
+    changes.ipAddressChangedAt = new Date();
+    changes.dnsTtl = SHORT_DNS_TTL_SECONDS;
+  } else {
+    changes.dnsTtl = adaptiveDnsTtl(oldUserRegistration.ipAddressChangedAt, new Date());
+  }
 
-  var userRegistration = UserRegistrations.findOne({publicKeyId: formData.pubkey});
+  // If a /recover moved this key (or hostname) since we validated
+  // the request, this matches nothing, and we must not publish our
+  // stale copy to DNS.
+  var updated = UserRegistrations.update({
+    publicKeyId: formData.pubkey,
+    hostname: oldUserRegistration.hostname
+  }, {$set: changes});
+  if (updated !== 1) {
+    console.log("Update for " + oldUserRegistration.hostname +
+                " matched no UserRegistration; it changed since validation.");
+    return null;
+  }
+  var userRegistration = RegistrationLookups.recordUpdate(oldUserRegistration, changes);
 
   console.log("Update UserRegistration with these details: %s",
               JSON.stringify(userRegistration));
@@ -376,7 +461,9 @@ function updateUserRegistration(formData) {
   publishOneUserRegistrationToDns(
     mysqlQuery,
     userRegistration.hostname,
-    userRegistration.ipAddress);
+    userRegistration.ipAddress,
+    userRegistration.dnsTtl);
+  return userRegistration;
 }
 
 doUpdate = function(request, response) {
@@ -392,7 +479,9 @@ doUpdate = function(request, response) {
 
   var rawFormData = getFormDataFromRequest(request);
 
-  var validatedFormData = Mesosphere.updateForm.validate(rawFormData);
+  var validatedFormData = RequestMetrics.time('validation', function() {
+    return Mesosphere.updateForm.validate(rawFormData);
+  });
   if (validatedFormData.errors) {
     return finishResponse(400,
                           responseFromFormFailure(validatedFormData),
@@ -401,7 +490,9 @@ doUpdate = function(request, response) {
   }
 
   if (validatedFormData.formData.updateIsAuthorized) {
-    updateUserRegistration(validatedFormData.formData);
+    if (! updateUserRegistration(validatedFormData.formData)) {
+      return finishResponse(409, {'text': REGISTRATION_CHANGED_TEXT}, response, plainTextOnly);
+    }
     return finishResponse(200, {'text': 'Update successful.'}, response, plainTextOnly);
   } else {
     return finishResponse(403, {'error': 'Not authorized.'}, response, plainTextOnly);
@@ -429,7 +520,9 @@ doAcmeChallenge = function(request, response) {
   var plainTextOnly = false;
 
   var rawFormData = getFormDataFromRequest(request);
-  var validatedFormData = Mesosphere.acmeChallenge.validate(rawFormData);
+  var validatedFormData = RequestMetrics.time('validation', function() {
+    return Mesosphere.acmeChallenge.validate(rawFormData);
+  });
 
   if (validatedFormData.errors) {
     return finishResponse(400,
@@ -463,7 +556,9 @@ doGetCertificate = function(request, response) {
   var plainTextOnly = false;
 
   var rawFormData = getFormDataFromRequest(request);
-  var validatedFormData = Mesosphere.getCertificate.validate(rawFormData);
+  var validatedFormData = RequestMetrics.time('validation', function() {
+    return Mesosphere.getCertificate.validate(rawFormData);
+  });
 
   // If there are any outright errors, respond with that.
   if (validatedFormData.errors) {
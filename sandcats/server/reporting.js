@@ -27,7 +27,8 @@ function pushHostnamesSinceTimestamp(start, end, devOrProd, reportLines) {
     devOrProd: devOrProd, globalsignCertificateInfo: {$exists: true},
     receivedCertificateDate: {$gte: start, $lte: end}
   }, {
-    fields: {'hostname': 1, 'requestCreationDate': 1}});
+    fields: {'hostname': 1, 'requestCreationDate': 1},
+    sort: {'requestCreationDate': 1}});
   return pushHostnamesFromQueryAsBulletedList(query, reportLines);
 }
 
@@ -75,16 +76,30 @@ function sendAnyUnsentReports(unsentBasePath, sentBasePath) {
   }
 }
 
+// Add "* YYYY-MM-DD hostname" lines for each request the query finds,
+// sorted by day and then hostname. The query must be sorted by
+// requestCreationDate; we stream it and only hold one day of
+// hostnames at a time.
 function pushHostnamesFromQueryAsBulletedList(query, reportLines) {
-  var hostnames = [];
-  query.forEach(function(doc) {
-    hostnames.push(doc.requestCreationDate.toISOString().split("T")[0] + " " + doc.hostname);
-  });
-  var sortedHostnames = hostnames.sort();
+  var currentDay = null;
+  var hostnamesForDay = [];
+
+  function flushDay() {
+    hostnamesForDay.sort().forEach(function(hostname) {
+      reportLines.push("* " + currentDay + " " + hostname);
+    });
+    hostnamesForDay = [];
+  }
 
-  sortedHostnames.map(function(s) {
-    reportLines.push("* " + s);
+  query.forEach(function(doc) {
+    var day = doc.requestCreationDate.toISOString().split("T")[0];
+    if (day !== currentDay) {
+      flushDay();
+      currentDay = day;
+    }
+    hostnamesForDay.push(doc.hostname);
   });
+  flushDay();
 }
 
 
@@ -107,10 +122,7 @@ Reporting.generateReport = function(startTimestamp, endTimestamp) {
     var line = "Total certificate-weeks issued so far against " + options[i] + ": ";
     // We store the intended use period in the database, but it's
     // always 7 days, so we don't have to bother querying it.
-    line += CertificateRequests.find({
-      devOrProd: options[i], globalsignCertificateInfo: {$exists: true},
-      receivedCertificateDate: {$lte: endDate}
-    }).count();
+    line += countCertificatesIssuedUpTo(options[i], endDate);
     reportLines.push(line);
   }
 
@@ -120,10 +132,7 @@ Reporting.generateReport = function(startTimestamp, endTimestamp) {
 
   for (var i = 0; i < options.length; i++) {
     var line = "In the time period " + options[i] + ", we issued: ";
-    line += CertificateRequests.find({
-      devOrProd: options[i], globalsignCertificateInfo: {$exists: true},
-      receivedCertificateDate: {$gte: startDate, $lte: endDate}
-    }).count();
+    line += countCertificatesIssuedBetween(options[i], startDate, endDate);
     reportLines.push(line);
   }
 
@@ -142,7 +151,8 @@ Reporting.generateReport = function(startTimestamp, endTimestamp) {
       devOrProd: options[i], globalsignCertificateInfo: {$exists: false},
       requestCreationDate: {$gte: startDate, $lte: endDate}
   }, {
-    fields: {'hostname': 1, 'requestCreationDate': 1}});
+    fields: {'hostname': 1, 'requestCreationDate': 1},
+    sort: {'requestCreationDate': 1}});
     pushHostnamesFromQueryAsBulletedList(query, reportLines);
   }
 
@@ -154,7 +164,8 @@ Reporting.generateReport = function(startTimestamp, endTimestamp) {
       globalsignErrors: {$exists: true},
       requestCreationDate: {$gte: startDate, $lte: endDate}
   }, {
-    fields: {'hostname': 1, 'requestCreationDate': 1}});
+    fields: {'hostname': 1, 'requestCreationDate': 1},
+    sort: {'requestCreationDate': 1}});
     pushHostnamesFromQueryAsBulletedList(query, reportLines);
   }
 
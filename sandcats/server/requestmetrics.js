@@ -0,0 +1,178 @@
+// This file measures where HTTP API requests spend their time.
+//
+// For each route, we keep latency histograms (see metrics.js) of:
+//
+// - total: the whole request,
+//
+// - validation, mongo, mysql, email: time spent in Mesosphere form
+//   validation, MongoDB, the PowerDNS MySQL database, and sending
+//   email,
+//
+// - other: whatever is left, i.e., our own code.
+//
+// The categories are exclusive: a Mongo query made while validating a
+// form counts as mongo, not validation, so the parts add up to the
+// total.
+//
+// Code marks time spent in a category with
+// RequestMetrics.time(category, fn). The request being measured is
+// tracked with a Meteor.EnvironmentVariable, so this works however
+// deep in the call stack we are, and does nothing outside a measured
+// request (e.g., in DnsPublisher's batch timer).
+//
+// GET /metrics, from localhost only, returns these histograms as JSON,
+// along with the UDP ping counters and other stats.
+
+RequestMetrics = {};
+
+var CATEGORIES = ['validation', 'mongo', 'mysql', 'email'];
+
+// Map from route name to {requests, histograms: {category: histogram}}.
+var routeMetrics = {};
+
+var currentRequest = new Meteor.EnvironmentVariable();
+
+function getRouteMetrics(routeName) {
+  if (! routeMetrics[routeName]) {
+    var histograms = {total: makeLatencyHistogram(), other: makeLatencyHistogram()};
+    CATEGORIES.forEach(function(category) {
+      histograms[category] = makeLatencyHistogram();
+    });
+    routeMetrics[routeName] = {requests: 0, errors: 0, histograms: histograms};
+  }
+  return routeMetrics[routeName];
+}
+
+// Run handler(route.request, route.response) for an iron:router
+// route, and record how long it took, and where.
+RequestMetrics.timeRoute = function(routeName, route, handler) {
+  var timing = {
+    millisecondsByCategory: {},
+    // The categories we are in, innermost last, each with the time we
+    // last started counting for it.
+    stack: []
+  };
+  CATEGORIES.forEach(function(category) {
+    timing.millisecondsByCategory[category] = 0;
+  });
+
+  var metrics = getRouteMetrics(routeName);
+  var startTime = process.hrtime();
+  try {
+    currentRequest.withValue(timing, function() {
+      handler(route.request, route.response);
+    });
+  } catch (e) {
+    metrics.errors += 1;
+    throw e;
+  } finally {
+    var totalMilliseconds = millisecondsSince(startTime);
+    var accountedMilliseconds = 0;
+    metrics.requests += 1;
+    metrics.histograms.total.record(totalMilliseconds);
+    CATEGORIES.forEach(function(category) {
+      var milliseconds = timing.millisecondsByCategory[category];
+      accountedMilliseconds += milliseconds;
+      metrics.histograms[category].record(milliseconds);
+    });
+    metrics.histograms.other.record(Math.max(0, totalMilliseconds - accountedMilliseconds));
+  }
+};
+
+// Run fn(), counting the time it takes as category, and return its
+// result.
+RequestMetrics.time = function(category, fn) {
+  var timing = currentRequest.get();
+  if (! timing) {
+    return fn();
+  }
+
+  // Stop the clock for the category we are inside of, if any.
+  var stack = timing.stack;
+  var now = process.hrtime();
+  if (stack.length > 0) {
+    var outer = stack[stack.length - 1];
+    timing.millisecondsByCategory[outer.category] += millisecondsSince(outer.startTime);
+  }
+  stack.push({category: category, startTime: now});
+  try {
+    return fn();
+  } finally {
+    var inner = stack.pop();
+    timing.millisecondsByCategory[inner.category] += millisecondsSince(inner.startTime);
+    if (stack.length > 0) {
+      stack[stack.length - 1].startTime = process.hrtime();
+    }
+  }
+};
+
+// Make the methods of a Mongo.Collection that talk to MongoDB count
+// as "mongo". For find(), that means the cursor methods that actually
+// run the query.
+function instrumentCollection(collection) {
+  ['findOne', 'insert', 'update', 'upsert', 'remove'].forEach(function(method) {
+    var original = collection[method];
+    collection[method] = function(/* arguments */) {
+      var args = arguments;
+      return RequestMetrics.time('mongo', function() {
+        return original.apply(collection, args);
+      });
+    };
+  });
+
+  var originalFind = collection.find;
+  collection.find = function(/* arguments */) {
+    var cursor = originalFind.apply(collection, arguments);
+    ['count', 'fetch', 'forEach', 'map'].forEach(function(method) {
+      var original = cursor[method];
+      cursor[method] = function(/* arguments */) {
+        var args = arguments;
+        return RequestMetrics.time('mongo', function() {
+          return original.apply(cursor, args);
+        });
+      };
+    });
+    return cursor;
+  };
+}
+
+[UserRegistrations, DomainReservations, CertificateRequests, RateLimitEvents,
+ CertificateDailyCounts].forEach(instrumentCollection);
+
+RequestMetrics.getStats = function() {
+  var routes = {};
+  _.each(routeMetrics, function(metrics, routeName) {
+    var histograms = {};
+    _.each(metrics.histograms, function(histogram, category) {
+      histograms[category] = histogram.snapshot();
+    });
+    routes[routeName] = {
+      requests: metrics.requests,
+      errors: metrics.errors,
+      milliseconds: histograms
+    };
+  });
+  return routes;
+};
+
+// Gather every stat we keep, for /metrics.
+function getAllStats() {
+  return {
+    generatedAt: new Date(),
+    routes: RequestMetrics.getStats(),
+    udpPings: getUdpPingStats(),
+    mysqlPool: (typeof mysqlQuery !== 'undefined' && mysqlQuery.getStats) ?
+      mysqlQuery.getStats() : null,
+    dnsPublisher: DnsPublisher.stats,
+    recoveryTokenRateLimiter: okToSendRecoveryToken.getStats()
+  };
+}
+
+doMetrics = function(request, response) {
+  // The stats aren't secret, exactly, but they aren't for the whole
+  // Internet either.
+  if (! requestIsFromLocalhostDirectly(request)) {
+    return finishResponse(403, {'text': 'Only available from localhost.'}, response);
+  }
+  return finishResponse(200, getAllStats(), response);
+};
@@ -142,7 +142,9 @@ doRegisterReserved = function(request, response) {
   var rawFormData = getFormDataFromRequest(request);
   var plainTextOnly = wantsPlainText(request);
 
-  var validatedFormData = Mesosphere.reservedDomainRegisterForm.validate(rawFormData);
+  var validatedFormData = RequestMetrics.time('validation', function() {
+    return Mesosphere.reservedDomainRegisterForm.validate(rawFormData);
+  });
   if (validatedFormData.errors) {
     return finishResponse(400,
                           responseFromFormFailure(validatedFormData),
@@ -223,7 +225,9 @@ doReserve = function(request, response) {
 
   var plainTextOnly = false;
   var rawFormData = getFormDataFromRequest(request);
-  var validatedFormData = Mesosphere.reserveForm.validate(rawFormData);
+  var validatedFormData = RequestMetrics.time('validation', function() {
+    return Mesosphere.reserveForm.validate(rawFormData);
+  });
   if (validatedFormData.errors) {
     return finishResponse(400,
                           responseFromFormFailure(validatedFormData),
@@ -0,0 +1,71 @@
+// This file contains a fast way for the integration tests to reset
+// sandcats to an empty state, without restarting anything.
+//
+// integration_tests.py used to drop the PowerDNS database and restart
+// sandcats, nginx, and PowerDNS, which takes tens of seconds. Instead,
+// if ALLOW_RESET_FOR_TESTING is set, POSTing to /reset-for-testing
+// directly on the Meteor port (not via nginx) will:
+//
+// - remove every UserRegistration and DomainReservation,
+//
+// - delete every DNS record except the ones at the apex of the zone
+//   (SOA, NS, and A), and bump the SOA serial,
+//
+// - forget in-memory state, like who recently asked for a recovery
+//   token,
+//
+// - wait for the in-memory hostname index to notice all of the above,
+//
+// and then reply with HTTP 200, so the caller knows the app is ready
+// for the next test. Purging PowerDNS's cache is up to the caller,
+// since that needs access to PowerDNS's control socket.
+
+// How long to wait for the hostname index to catch up with MongoDB.
+var INDEX_DRAIN_TIMEOUT_MILLISECONDS = 10 * 1000;
+var INDEX_DRAIN_POLL_MILLISECONDS = 10;
+
+function waitForHostnameIndexToEmpty() {
+  if (! HostnameIpIndex.ready) {
+    return;
+  }
+  var deadline = Date.now() + INDEX_DRAIN_TIMEOUT_MILLISECONDS;
+  while (HostnameIpIndex.getStats().size > 0) {
+    if (Date.now() > deadline) {
+      throw new Error("Hostname index still has " + HostnameIpIndex.getStats().size +
+                      " entries after reset.");
+    }
+    Meteor._sleepForMs(INDEX_DRAIN_POLL_MILLISECONDS);
+  }
+}
+
+resetAppStateForTesting = function() {
+  UserRegistrations.remove({});
+  DomainReservations.remove({});
+
+  withMysqlTransaction(mysqlQuery, function(transactionQuery) {
+    transactionQuery(
+      "DELETE FROM `records` WHERE domain_id = ? AND name != ?",
+      [getDomainId(transactionQuery, Meteor.settings.BASE_DOMAIN),
+       Meteor.settings.BASE_DOMAIN]);
+    bumpSoaRecord(transactionQuery, Meteor.settings.BASE_DOMAIN);
+  });
+
+  okToSendRecoveryToken.reset();
+  waitForHostnameIndexToEmpty();
+};
+
+doResetForTesting = function(request, response) {
+  if (! Meteor.settings.ALLOW_RESET_FOR_TESTING ||
+      ! requestIsFromLocalhostDirectly(request)) {
+    return finishResponse(404, {'text': 'Not found.'}, response);
+  }
+  if (request.method != 'POST') {
+    return finishResponse(403, {'text': 'Must POST.'}, response);
+  }
+
+  var startTime = process.hrtime();
+  resetAppStateForTesting();
+  var milliseconds = millisecondsSince(startTime);
+  console.log("Reset app state for testing in " + milliseconds.toFixed(1) + " ms.");
+  return finishResponse(200, {'success': true, 'milliseconds': milliseconds}, response);
+};
@@ -0,0 +1,61 @@
+// This file contains the feed that keeps the standalone UDP ping
+// workers (see ../udp-ping-workers/) up to date.
+//
+// If UDP_PING_WORKERS_FEED_PORT is configured, the Meteor process does
+// not answer UDP pings itself. Instead, it listens on that TCP port on
+// 127.0.0.1, and every worker that connects receives:
+//
+// - One line per hostname in HostnameIpIndex, of the form
+//   {"hostname": "benb", "ipAddress": "127.0.0.1"},
+//
+// - then the line {"snapshotComplete": true},
+//
+// - then one line per change, for as long as it stays connected. A
+//   change with "ipAddress": null means the hostname went away.
+//
+// The workers use this as a read-only copy of the index, so answering
+// pings never touches MongoDB or the Meteor process.
+
+var net = Npm.require('net');
+var feedServer = null;
+
+function writeLine(socket, data) {
+  socket.write(JSON.stringify(data) + '\n');
+}
+
+startUdpPingWorkersFeed = function() {
+  if (feedServer) {
+    console.log("You seem to have called startUdpPingWorkersFeed() twice. Bailing out.");
+    return;
+  }
+
+  HostnameIpIndex.start();
+
+  feedServer = net.createServer(function(socket) {
+    console.log("UDP ping worker connected to the hostname feed.");
+
+    // Both of these run synchronously, so no change can sneak in
+    // between the snapshot and the first change we send.
+    HostnameIpIndex.forEach(function(hostname, ipAddress) {
+      writeLine(socket, {hostname: hostname, ipAddress: ipAddress});
+    });
+    writeLine(socket, {snapshotComplete: true});
+
+    var stopListening = HostnameIpIndex.onChange(function(hostname, ipAddress) {
+      writeLine(socket, {hostname: hostname, ipAddress: ipAddress});
+    });
+
+    socket.on('error', function(e) {
+      console.log("Error on UDP ping worker feed connection", e);
+    });
+    socket.on('close', function() {
+      console.log("UDP ping worker disconnected from the hostname feed.");
+      stopListening();
+    });
+  });
+
+  feedServer.listen(Meteor.settings.UDP_PING_WORKERS_FEED_PORT, '127.0.0.1', function() {
+    console.log("Feeding UDP ping workers on 127.0.0.1:" +
+                Meteor.settings.UDP_PING_WORKERS_FEED_PORT);
+  });
+};
@@ -0,0 +1,269 @@
+// This file contains the ways the UDP ping responder (see
+// udppings.js) can answer "is this hostname registered to this IP
+// address?". UDP_PING_LOOKUP_BACKEND picks one:
+//
+// - "memory" (the default) asks HostnameIpIndex, our in-memory copy
+//   of UserRegistrations. See hostnameindex.js.
+//
+// - "mongo" asks MongoDB, once per packet.
+//
+// - "dns" asks PowerDNS for the hostname's A record, so that
+//   PowerDNS's packet cache takes the load. We send the queries
+//   ourselves over UDP, and keep at most UDP_PING_DNS_MAX_IN_FLIGHT
+//   of them outstanding; if PowerDNS falls behind, we drop pings
+//   rather than queue them without bound. The client will ping us
+//   again soon anyway.
+//
+// Every backend has the same interface:
+//
+//   lookup(hostname, ipAddress, callback)
+//
+// where callback receives true if the hostname is registered to that
+// IP address, false if it is not, and null if the backend could not
+// tell. Every backend records a latency histogram, so we can compare
+// them with real numbers; see getUdpPingStats().
+
+var dgram = Npm.require('dgram');
+
+var DNS_QUERY_TIMEOUT_MILLISECONDS = 1000;
+var DEFAULT_DNS_MAX_IN_FLIGHT = 1000;
+var DNS_TYPE_A = 1;
+var DNS_CLASS_IN = 1;
+
+// Hostnames we could have registered; see the hostname rules in
+// validation.js. Anything else isn't ours, and might not even make a
+// valid DNS name.
+var REGISTERED_HOSTNAME_REGEX = /^[0-9a-z-]{1,20}$/;
+
+function makeMemoryBackend() {
+  HostnameIpIndex.start();
+  return {
+    lookup: function(hostname, ipAddress, callback) {
+      callback(HostnameIpIndex.hostnameHasIpAddress(hostname, ipAddress));
+    },
+    getStats: function() {
+      return HostnameIpIndex.getStats();
+    }
+  };
+}
+
+function makeMongoBackend() {
+  return {
+    lookup: function(hostname, ipAddress, callback) {
+      // Like the memory backend's fallback, this needs a fiber, which
+      // udppings.js provides via Meteor.bindEnvironment().
+      callback(!! UserRegistrations.findOne({ipAddress: ipAddress, hostname: hostname}));
+    },
+    getStats: function() {
+      return {};
+    }
+  };
+}
+
+// Pure-function helpers for speaking just enough DNS to ask for an A
+// record.
+buildDnsAQuery = function(id, name) {
+  var labels = name.split('.');
+  var length = 12 + 1 + 4;
+  labels.forEach(function(label) {
+    length += 1 + label.length;
+  });
+
+  var packet = new Buffer(length);
+  packet.fill(0);
+  packet.writeUInt16BE(id, 0);
+  // Flags are all zero: a standard query, no recursion desired, since
+  // we ask the authoritative server directly.
+  packet.writeUInt16BE(1, 4);  // One question.
+  var offset = 12;
+  labels.forEach(function(label) {
+    packet[offset] = label.length;
+    packet.write(label, offset + 1, label.length, 'ascii');
+    offset += 1 + label.length;
+  });
+  packet[offset] = 0;  // The root label ends the name.
+  packet.writeUInt16BE(DNS_TYPE_A, offset + 1);
+  packet.writeUInt16BE(DNS_CLASS_IN, offset + 3);
+  return packet;
+};
+
+function skipDnsName(packet, offset) {
+  while (true) {
+    if (offset >= packet.length) {
+      throw new Error("DNS name runs past the end of the packet.");
+    }
+    var length = packet[offset];
+    if (length === 0) {
+      return offset + 1;
+    }
+    if ((length & 0xC0) === 0xC0) {
+      // A compression pointer ends the name.
+      return offset + 2;
+    }
+    offset += 1 + length;
+  }
+}
+
+// Return {id, addresses} for a DNS response packet, where addresses
+// lists the IPv4 addresses in its answer section. Throws if the
+// packet is malformed.
+parseDnsAResponse = function(packet) {
+  if (packet.length < 12) {
+    throw new Error("DNS response is too short.");
+  }
+  var id = packet.readUInt16BE(0);
+  var questionCount = packet.readUInt16BE(4);
+  var answerCount = packet.readUInt16BE(6);
+
+  var offset = 12;
+  for (var i = 0; i < questionCount; i++) {
+    offset = skipDnsName(packet, offset) + 4;
+  }
+
+  var addresses = [];
+  for (var i = 0; i < answerCount; i++) {
+    offset = skipDnsName(packet, offset);
+    if (offset + 10 > packet.length) {
+      throw new Error("DNS answer runs past the end of the packet.");
+    }
+    var type = packet.readUInt16BE(offset);
+    var dataLength = packet.readUInt16BE(offset + 8);
+    offset += 10;
+    if (offset + dataLength > packet.length) {
+      throw new Error("DNS answer data runs past the end of the packet.");
+    }
+    if (type === DNS_TYPE_A && dataLength === 4) {
+      addresses.push([packet[offset], packet[offset + 1],
+                      packet[offset + 2], packet[offset + 3]].join('.'));
+    }
+    offset += dataLength;
+  }
+
+  return {id: id, addresses: addresses};
+};
+
+function makeDnsBackend() {
+  var serverAddress = Meteor.settings.UDP_PING_DNS_SERVER || '127.0.0.1';
+  var maxInFlight = Meteor.settings.UDP_PING_DNS_MAX_IN_FLIGHT || DEFAULT_DNS_MAX_IN_FLIGHT;
+  var stats = {inFlight: 0, dropped: 0, timeouts: 0, malformedResponses: 0};
+
+  // Map from DNS query ID to {ipAddress, callback, timer}.
+  var pending = {};
+  var nextId = Math.floor(Math.random() * 65536);
+
+  var socket = dgram.createSocket('udp4');
+
+  function finish(id, matches) {
+    var query = pending[id];
+    if (! query) {
+      // Probably a late response to a query that timed out.
+      return;
+    }
+    delete pending[id];
+    stats.inFlight -= 1;
+    clearTimeout(query.timer);
+    query.callback(matches);
+  }
+
+  // Without this, a failed send would be an unhandled 'error' event,
+  // which takes down the whole process. The query just times out.
+  socket.on('error', function(e) {
+    console.error("Error on the UDP ping DNS lookup socket", e);
+  });
+
+  socket.on('message', function(packet) {
+    var response;
+    try {
+      response = parseDnsAResponse(packet);
+    } catch (e) {
+      stats.malformedResponses += 1;
+      return;
+    }
+    var query = pending[response.id];
+    if (query) {
+      finish(response.id, _.contains(response.addresses, query.ipAddress));
+    }
+  });
+
+  return {
+    lookup: function(hostname, ipAddress, callback) {
+      // e.g. "x.benb" would match the wildcard record of benb.
+      if (! REGISTERED_HOSTNAME_REGEX.test(hostname)) {
+        callback(false);
+        return;
+      }
+
+      if (stats.inFlight >= maxInFlight) {
+        stats.dropped += 1;
+        callback(null);
+        return;
+      }
+
+      // Find a query ID that is not in use. Since maxInFlight is
+      // well under 65536, this terminates quickly.
+      while (pending[nextId]) {
+        nextId = (nextId + 1) % 65536;
+      }
+      var id = nextId;
+      nextId = (nextId + 1) % 65536;
+
+      var query = buildDnsAQuery(id, hostname + '.' + Meteor.settings.BASE_DOMAIN);
+      pending[id] = {
+        ipAddress: ipAddress,
+        callback: callback,
+        timer: setTimeout(function() {
+          stats.timeouts += 1;
+          finish(id, null);
+        }, DNS_QUERY_TIMEOUT_MILLISECONDS)
+      };
+      stats.inFlight += 1;
+      socket.send(query, 0, query.length, 53, serverAddress);
+    },
+    getStats: function() {
+      return _.clone(stats);
+    }
+  };
+}
+
+var backendFactories = {
+  memory: makeMemoryBackend,
+  mongo: makeMongoBackend,
+  dns: makeDnsBackend
+};
+
+// Create the backend named by UDP_PING_LOOKUP_BACKEND, wrapped so that
+// it records how long each lookup takes, and how lookups turn out.
+makeUdpPingLookup = function() {
+  var name = Meteor.settings.UDP_PING_LOOKUP_BACKEND || 'memory';
+  var backend = backendFactories[name]();
+  var latency = makeLatencyHistogram();
+  var outcomes = {matched: 0, notMatched: 0, unknown: 0};
+
+  console.log("Answering UDP pings using the " + name + " lookup backend.");
+
+  return {
+    name: name,
+    lookup: function(hostname, ipAddress, callback) {
+      var startTime = process.hrtime();
+      backend.lookup(hostname, ipAddress, function(matches) {
+        latency.record(millisecondsSince(startTime));
+        if (matches === true) {
+          outcomes.matched += 1;
+        } else if (matches === false) {
+          outcomes.notMatched += 1;
+        } else {
+          outcomes.unknown += 1;
+        }
+        callback(matches);
+      });
+    },
+    getStats: function() {
+      return {
+        backend: name,
+        latency: latency.snapshot(),
+        outcomes: _.clone(outcomes),
+        backendStats: backend.getStats()
+      };
+    }
+  };
+};
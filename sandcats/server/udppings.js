@@ -24,12 +24,16 @@
 // to generate 16 random ASCII bytes for this, and to let them expire
 // every minute or so.
 //
-// This does mean we perform a MongoDB query for every UDP packet we
-// receive on this port, so we may want to think about making sure the
-// query is high-performance. A different thing we could do, if
-// performance of MongoDB is bad, is to do a DNS lookup for the
-// hostname instead. This would shunt the performance penalty to
-// PowerDNS and its cache, and it can probably deal.
+// We answer the "does this hostname match this IP" question using one
+// of several lookup backends; see udppinglookup.js. By default we use
+// HostnameIpIndex (see hostnameindex.js), an in-memory copy of
+// UserRegistrations, so that we do not perform a MongoDB query for
+// every UDP packet we receive on this port. Another backend does a
+// DNS lookup for the hostname instead. This shunts the performance
+// penalty to PowerDNS and its cache, and it can probably deal.
+//
+// If a backend cannot tell (e.g., PowerDNS is too slow), we do not
+// reply; the client will ping again soon.
 //
 // Note that if there is no hostname associated with the packet we
 // received, then we do still reply. Arguably this leaves us open to
@@ -42,12 +46,92 @@
 // - I believe that source address spoofing is tough on the 2015-era
 //   Internet. I could be wrong about this!
 //
+// Clients may also use the binary version 2 format (see
+// udppingprotocol.js), which names the hostname by a hash and can
+// carry many pings, answered by one reply. The in-memory index maps
+// hashes back to hostnames, so we load it whatever the lookup backend.
+//
 // If the inbound UDP packet is corrupted, then we might cause people
 // to send us an IP address update more often than is needed. I think
 // that's OK.
 
 var dgram = Meteor.npmRequire('dgram');
 var server = null;
+var lookup = null;
+
+var udpPingCounters = {
+  packetsReceived: 0,
+  malformedPackets: 0,
+  v2Packets: 0,
+  v2Pings: 0,
+  repliesSent: 0
+};
+
+// Return counters and lookup latency for the UDP ping system. This is
+// handy from the Meteor shell.
+getUdpPingStats = function() {
+  var stats = _.clone(udpPingCounters);
+  stats.lookup = lookup && lookup.getStats();
+  return stats;
+};
+
+// Log the stats once an hour, so we can compare lookup backends.
+var STATS_LOG_INTERVAL_MILLISECONDS = 60 * 60 * 1000;
+
+// Decide whether hostname is registered to ipAddress, according to
+// any of the hostnames with this hash. Calls callback with true,
+// false, or null if we can't tell, like lookup.lookup().
+function lookupHostnameHash(hash, ipAddress, callback) {
+  var hostnames = HostnameIpIndex.getHostnamesForHash(hash);
+  if (hostnames.length === 0) {
+    // Like an unknown hostname in a version 1 ping.
+    return callback(false);
+  }
+  var remaining = hostnames.length;
+  var sawMatch = false;
+  var sawUnknown = false;
+  hostnames.forEach(function(hostname) {
+    lookup.lookup(hostname, ipAddress, function(matches) {
+      if (matches === true) {
+        sawMatch = true;
+      } else if (matches === null) {
+        sawUnknown = true;
+      }
+      remaining -= 1;
+      if (remaining === 0) {
+        callback(sawMatch ? true : (sawUnknown ? null : false));
+      }
+    });
+  });
+}
+
+// Answer every ping in a version 2 packet with one reply, once all
+// their lookups are done.
+function answerV2Pings(message, count, remote) {
+  udpPingCounters.v2Packets += 1;
+  udpPingCounters.v2Pings += count;
+
+  var mismatchedPings = [];
+  var remaining = count;
+  for (var i = 0; i < count; i++) {
+    (function(pingNumber) {
+      lookupHostnameHash(udpPingV2HostnameHash(message, pingNumber), remote.address,
+                         function(matches) {
+        if (matches === false) {
+          mismatchedPings.push(pingNumber);
+        }
+        remaining -= 1;
+        if (remaining === 0) {
+          var reply = buildUdpPingV2Reply(message, mismatchedPings);
+          if (reply) {
+            server.send(reply, 0, reply.length, remote.port, remote.address);
+            udpPingCounters.repliesSent += 1;
+          }
+        }
+      });
+    })(i);
+  }
+}
 
 startListeningForUdpPings = function() {
   var EXCLAMATION_POINT = new Buffer("!");
@@ -57,6 +141,14 @@ startListeningForUdpPings = function() {
     return;
   }
   server = dgram.createSocket('udp4');
+  lookup = makeUdpPingLookup();
+  // The "memory" backend has already loaded the index.
+  if (! HostnameIpIndex.ready) {
+    HostnameIpIndex.start();
+  }
+  Meteor.setInterval(function() {
+    console.log("UDP ping stats: " + JSON.stringify(getUdpPingStats()));
+  }, STATS_LOG_INTERVAL_MILLISECONDS);
 
   server.on('listening', function() {
     var myAddress = server.address();
@@ -65,13 +157,19 @@ startListeningForUdpPings = function() {
   });
 
   var onMessage = Meteor.bindEnvironment(function(err, result) {
-    var message = result.message.asciiSlice();
-    var splitted = message.split(" ");
-    var hostname = splitted[0];
-    var challenge = splitted[1];
-    check(challenge, Match.Where(function(x) {
-      return (x.length == 16);
-    }));
+    udpPingCounters.packetsReceived += 1;
+
+    var ping = parseUdpPingMessage(result.message);
+    if (! ping) {
+      udpPingCounters.malformedPackets += 1;
+      return;
+    }
+    if (ping.version === 2) {
+      answerV2Pings(result.message, ping.count, result.remote);
+      return;
+    }
+    var hostname = ping.hostname;
+    var challenge = ping.challenge;
 
     var remote = result.remote;
 
@@ -79,13 +177,12 @@ startListeningForUdpPings = function() {
 
     // By default, we should reply to any message. Only if the IP
     // address and the hostname match should we not reply.
-    var weShouldReply = ! UserRegistrations.findOne({
-      ipAddress: remoteIp,
-      hostname: hostname});
-
-    if (weShouldReply) {
-      server.send(new Buffer(challenge), 0, 16, remote.port, remote.address);
-    }
+    lookup.lookup(hostname, remoteIp, function(matches) {
+      if (matches === false) {
+        server.send(new Buffer(challenge), 0, 16, remote.port, remote.address);
+        udpPingCounters.repliesSent += 1;
+      }
+    });
   });
 
   server.on('message', function(message, remote) {
@@ -0,0 +1,246 @@
+"""A long-lived SMTP server that captures sandcats' email for the tests.
+
+Point Meteor's MAIL_URL at smtp://localhost:2500 (make action-run-dev
+does this). This server accepts mail for any recipient, keeps every
+message in memory, and indexes them by recipient, by the
+X-Sandcats-hostname header, and by the X-Sandcats-recoveryToken header.
+
+Tests read the captured mail over HTTP on 127.0.0.1:2501:
+
+- GET /messages returns {"messages": [...]} in the order they arrived.
+  Each message has id, recipients, subject, hostname, recoveryToken,
+  and headers. Filter with any of these query parameters:
+
+    recipient=benb@benb.org
+    hostname=benb3
+    subject=Recovering your domain name
+    recoveryToken=...
+    after=ID          only messages with an id greater than ID
+    wait=SECONDS      if nothing matches yet, wait up to this long for
+                      a matching message to arrive
+
+- GET /health returns {"ok": true, "lastId": ID}. lastId is the id of
+  the newest message, which is useful as a later "after".
+
+- POST /clear forgets every message.
+
+Run it with:
+
+    python smtp_capture_server.py [--smtp-port 2500] [--http-port 2501]
+
+integration_tests.py starts it on demand if it is not running yet.
+"""
+
+import argparse
+import email.parser
+import json
+import time
+
+from zope.interface import implements
+
+from twisted.internet import defer, reactor
+from twisted.mail import smtp
+from twisted.web import resource, server
+
+
+class MessageStore(object):
+    '''Captured messages, their indexes, and anyone waiting for more.'''
+
+    def __init__(self):
+        self.clear()
+        # List of (matches, callback) for long-polling HTTP requests.
+        self.waiters = []
+
+    def clear(self):
+        self.messages = []
+        self.by_recipient = {}
+        self.by_hostname = {}
+        self.by_recovery_token = {}
+        self.last_id = getattr(self, 'last_id', 0)
+
+    def add(self, recipients, raw_message):
+        parsed = email.parser.Parser().parsestr(raw_message, headersonly=True)
+        self.last_id += 1
+        message = {
+            'id': self.last_id,
+            'received': time.time(),
+            'recipients': recipients,
+            'subject': parsed.get('Subject'),
+            'hostname': parsed.get('X-Sandcats-hostname'),
+            'recoveryToken': parsed.get('X-Sandcats-recoveryToken'),
+            'headers': dict(parsed.items()),
+        }
+        self.messages.append(message)
+        for recipient in recipients:
+            self.by_recipient.setdefault(recipient, []).append(message)
+        if message['hostname']:
+            self.by_hostname.setdefault(message['hostname'], []).append(message)
+        if message['recoveryToken']:
+            self.by_recovery_token.setdefault(message['recoveryToken'], []).append(message)
+
+        waiters, self.waiters = self.waiters, []
+        for matches, callback in waiters:
+            if matches(message):
+                callback()
+            else:
+                self.waiters.append((matches, callback))
+
+    def find(self, recipient=None, hostname=None, recovery_token=None, subject=None,
+             after=0):
+        # Start from the narrowest index we can.
+        if recovery_token is not None:
+            candidates = self.by_recovery_token.get(recovery_token, [])
+        elif hostname is not None:
+            candidates = self.by_hostname.get(hostname, [])
+        elif recipient is not None:
+            candidates = self.by_recipient.get(recipient, [])
+        else:
+            candidates = self.messages
+        return [m for m in candidates
+                if m['id'] > after and
+                (recipient is None or recipient in m['recipients']) and
+                (hostname is None or m['hostname'] == hostname) and
+                (recovery_token is None or m['recoveryToken'] == recovery_token) and
+                (subject is None or m['subject'] == subject)]
+
+    def wait_for(self, matches, callback, timeout):
+        '''Call callback() once a message that matches arrives, or after timeout.'''
+        state = {'done': False}
+
+        def fire():
+            if state['done']:
+                return
+            state['done'] = True
+            if timer.active():
+                timer.cancel()
+            self.waiters = [w for w in self.waiters if w[1] is not fire]
+            callback()
+
+        timer = reactor.callLater(timeout, fire)
+        self.waiters.append((matches, fire))
+
+
+STORE = MessageStore()
+
+
+class CapturedMessage(object):
+    implements(smtp.IMessage)
+
+    def __init__(self, recipients):
+        self.recipients = recipients
+        self.lines = []
+
+    def lineReceived(self, line):
+        self.lines.append(line)
+
+    def eomReceived(self):
+        STORE.add(self.recipients, '\n'.join(self.lines))
+        return defer.succeed(None)
+
+    def connectionLost(self):
+        self.lines = []
+
+
+class CaptureMessageDelivery(object):
+    implements(smtp.IMessageDelivery)
+
+    def receivedHeader(self, helo, origin, recipients):
+        return "Received: CaptureMessageDelivery"
+
+    def validateFrom(self, helo, origin):
+        return origin
+
+    def validateTo(self, user):
+        # Accept every recipient. One CapturedMessage per recipient is
+        # what twisted wants; each records which address it was for.
+        recipient = '%s@%s' % (user.dest.local, user.dest.domain)
+        return lambda: CapturedMessage([recipient])
+
+
+class CaptureSMTPFactory(smtp.SMTPFactory):
+    protocol = smtp.ESMTP
+
+    def buildProtocol(self, addr):
+        p = smtp.SMTPFactory.buildProtocol(self, addr)
+        p.delivery = CaptureMessageDelivery()
+        return p
+
+
+def _arg(request, name, convert=str):
+    values = request.args.get(name)
+    if not values:
+        return None
+    return convert(values[0])
+
+
+def _respond_json(request, data):
+    request.setHeader('Content-Type', 'application/json')
+    return json.dumps(data)
+
+
+class MessagesResource(resource.Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        query = dict(
+            recipient=_arg(request, 'recipient'),
+            hostname=_arg(request, 'hostname'),
+            recovery_token=_arg(request, 'recoveryToken'),
+            subject=_arg(request, 'subject'),
+            after=_arg(request, 'after', int) or 0)
+        found = STORE.find(**query)
+        wait = _arg(request, 'wait', float)
+        if found or not wait:
+            return _respond_json(request, {'messages': found})
+
+        def matches(message):
+            return bool(STORE.find(**dict(query, after=message['id'] - 1)))
+
+        def respond():
+            if request.finished or getattr(request, '_disconnected', False):
+                return
+            request.write(_respond_json(request, {'messages': STORE.find(**query)}))
+            request.finish()
+
+        STORE.wait_for(matches, respond, wait)
+        return server.NOT_DONE_YET
+
+
+class HealthResource(resource.Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        return _respond_json(request, {'ok': True, 'lastId': STORE.last_id})
+
+
+class ClearResource(resource.Resource):
+    isLeaf = True
+
+    def render_POST(self, request):
+        STORE.clear()
+        return _respond_json(request, {'ok': True})
+
+
+def make_site():
+    root = resource.Resource()
+    root.putChild('messages', MessagesResource())
+    root.putChild('health', HealthResource())
+    root.putChild('clear', ClearResource())
+    return server.Site(root)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Capture sandcats email for tests.')
+    parser.add_argument('--smtp-port', type=int, default=2500)
+    parser.add_argument('--http-port', type=int, default=2501)
+    args = parser.parse_args()
+
+    reactor.listenTCP(args.smtp_port, CaptureSMTPFactory(), interface='127.0.0.1')
+    reactor.listenTCP(args.http_port, make_site(), interface='127.0.0.1')
+    print 'Capturing SMTP on 127.0.0.1:%d; query API on 127.0.0.1:%d' % (
+        args.smtp_port, args.http_port)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+Jasmine.onTest(function () {
+  describe('adaptiveDnsTtl', function() {
+    'use strict';
+
+    var DAY = 24 * 60 * 60 * 1000;
+    var now = new Date('2015-09-30T00:00:00.000Z');
+
+    function daysAgo(days) {
+      return new Date(now.getTime() - days * DAY);
+    }
+
+    it('should publish a short TTL for hostnames that just moved', function() {
+      expect(adaptiveDnsTtl(now, now)).toBe(SHORT_DNS_TTL_SECONDS);
+      expect(adaptiveDnsTtl(daysAgo(0.5), now)).toBe(SHORT_DNS_TTL_SECONDS);
+    });
+
+    it('should lengthen the TTL as the IP address stays put', function() {
+      expect(adaptiveDnsTtl(daysAgo(1), now)).toBe(300);
+      expect(adaptiveDnsTtl(daysAgo(10), now)).toBe(900);
+      expect(adaptiveDnsTtl(daysAgo(365), now)).toBe(3600);
+    });
+
+    it('should respect DNS_MAX_TTL_SECONDS', function() {
+      var oldMax = Meteor.settings.DNS_MAX_TTL_SECONDS;
+      try {
+        Meteor.settings.DNS_MAX_TTL_SECONDS = 600;
+        expect(adaptiveDnsTtl(daysAgo(365), now)).toBe(600);
+        expect(adaptiveDnsTtl(daysAgo(1), now)).toBe(300);
+        Meteor.settings.DNS_MAX_TTL_SECONDS = 60;
+        expect(adaptiveDnsTtl(daysAgo(365), now)).toBe(SHORT_DNS_TTL_SECONDS);
+      } finally {
+        Meteor.settings.DNS_MAX_TTL_SECONDS = oldMax;
+      }
+    });
+  });
+});
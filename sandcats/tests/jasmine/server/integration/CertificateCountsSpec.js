@@ -0,0 +1,103 @@
+Jasmine.onTest(function () {
+  describe('CertificateDailyCounts', function() {
+    'use strict';
+
+    var hostnameCounter = 0;
+
+    beforeEach(function() {
+      CertificateDailyCounts.remove({});
+      CertificateRequests.remove({hostname: /^certcount/});
+    });
+
+    // Log a certificate as if GlobalSign had sent it at the given time.
+    function logCertificate(devOrProd, receivedCertificateDate) {
+      hostnameCounter += 1;
+      CertificateRequests.insert({
+        requestCreationDate: receivedCertificateDate,
+        devOrProd: devOrProd,
+        hostname: 'certcount' + hostnameCounter,
+        intendedUseDurationDays: 7,
+        globalsignValidityPeriod: {Months: 1, NotAfter: 'In a month'},
+        globalsignCertificateInfo: {
+          CertificateStatus: 4,
+          StartDate: 'Next Friday',
+          EndDate: 'In a month',
+          CommonName: 'certcount' + hostnameCounter,
+          SerialNumber: 'five',
+          SubjectName: 'certcount' + hostnameCounter
+        },
+        receivedCertificateDate: receivedCertificateDate
+      });
+      countCertificateIssued(devOrProd, receivedCertificateDate);
+    }
+
+    it('should count certificates per day and devOrProd', function() {
+      logCertificate('prod', new Date('2015-09-01T10:00:00Z'));
+      logCertificate('prod', new Date('2015-09-01T23:00:00Z'));
+      logCertificate('prod', new Date('2015-09-02T01:00:00Z'));
+      logCertificate('dev', new Date('2015-09-01T10:00:00Z'));
+
+      expect(CertificateDailyCounts.findOne('prod-2015-09-01').count).toBe(2);
+      expect(CertificateDailyCounts.findOne('prod-2015-09-02').count).toBe(1);
+      expect(CertificateDailyCounts.findOne('dev-2015-09-01').count).toBe(1);
+    });
+
+    it('should add up totals that end partway through a day', function() {
+      logCertificate('prod', new Date('2015-09-01T10:00:00Z'));
+      logCertificate('prod', new Date('2015-09-02T01:00:00Z'));
+      logCertificate('prod', new Date('2015-09-02T05:00:00Z'));
+
+      expect(countCertificatesIssuedUpTo('prod', new Date('2015-09-02T00:00:00Z'))).toBe(1);
+      expect(countCertificatesIssuedUpTo('prod', new Date('2015-09-02T02:00:00Z'))).toBe(2);
+      expect(countCertificatesIssuedUpTo('dev', new Date('2015-09-03T00:00:00Z'))).toBe(0);
+      expect(countCertificatesIssuedBetween(
+        'prod', new Date('2015-09-01T12:00:00Z'), new Date('2015-09-03T00:00:00Z'))).toBe(2);
+    });
+
+    it('should count a certificate when we log it from GlobalSign', function() {
+      hostnameCounter += 1;
+      var hostname = 'certcount' + hostnameCounter;
+      var logEntryId = CertificateRequests.insert({
+        requestCreationDate: new Date(),
+        devOrProd: 'prod',
+        hostname: hostname,
+        intendedUseDurationDays: 7,
+        globalsignValidityPeriod: {Months: 1, NotAfter: 'In a month'}
+      });
+
+      logIssueCertificateSuccess({
+        Response: {
+          PVOrderDetail: {
+            CertificateInfo: {
+              CertificateStatus: 4,
+              StartDate: 'Next Friday',
+              EndDate: 'In a month',
+              CommonName: hostname,
+              SerialNumber: 'five',
+              SubjectName: hostname
+            }
+          }
+        }
+      }, logEntryId);
+
+      var received = CertificateRequests.findOne(logEntryId).receivedCertificateDate;
+      var counter = CertificateDailyCounts.findOne(
+        'prod-' + received.toISOString().split('T')[0]);
+      expect(counter && counter.count).toBe(1);
+    });
+
+    it('should rebuild the same counts from CertificateRequests', function() {
+      logCertificate('prod', new Date('2015-09-01T10:00:00Z'));
+      logCertificate('prod', new Date('2015-09-01T11:00:00Z'));
+      logCertificate('dev', new Date('2015-09-02T10:00:00Z'));
+      // Other specs log certificates too, so only look at our days.
+      var ourDays = {day: {$in: ['2015-09-01', '2015-09-02']}};
+      var before = CertificateDailyCounts.find(ourDays, {sort: {_id: 1}}).fetch();
+      expect(before.length).toBe(2);
+
+      CertificateDailyCounts.remove({});
+      rebuildCertificateDailyCounts();
+      expect(CertificateDailyCounts.find(ourDays, {sort: {_id: 1}}).fetch()).toEqual(before);
+    });
+  });
+});
@@ -0,0 +1,131 @@
+Jasmine.onTest(function () {
+  describe('certificateValidityDates', function() {
+    'use strict';
+
+    it('should parse the dates GlobalSign sends', function() {
+      var dates = certificateValidityDates({
+        StartDate: '2015-09-01T00:00:00.000Z',
+        EndDate: '2015-09-08T00:00:00.000Z'
+      });
+      expect(dates.certificateStartDate.toISOString()).toBe('2015-09-01T00:00:00.000Z');
+      expect(dates.certificateEndDate.toISOString()).toBe('2015-09-08T00:00:00.000Z');
+    });
+
+    it('should store nothing if a date does not parse', function() {
+      expect(certificateValidityDates({
+        StartDate: 'Next Friday',
+        EndDate: '2015-09-08T00:00:00.000Z'
+      })).toEqual({});
+    });
+  });
+
+  describe('Certificate validity dates in CertificateRequests', function() {
+    'use strict';
+
+    var DAY_IN_MILLISECONDS = 24 * 60 * 60 * 1000;
+    var hostnameCounter = 0;
+
+    beforeEach(function() {
+      CertificateRequests.remove({hostname: /^certdates/});
+    });
+
+    // Store a certificate for hostname as GlobalSign would have sent
+    // it, valid from startDate to endDate. If withParsedDates is false,
+    // store it the way we did before we parsed the dates.
+    function storeCertificate(hostname, startDate, endDate, withParsedDates) {
+      var certificateInfo = {
+        CertificateStatus: 4,
+        StartDate: typeof startDate === 'string' ? startDate : startDate.toISOString(),
+        EndDate: endDate.toISOString(),
+        CommonName: hostname,
+        SerialNumber: 'five',
+        SubjectName: hostname
+      };
+      var doc = {
+        requestCreationDate: new Date(),
+        devOrProd: 'prod',
+        hostname: hostname,
+        intendedUseDurationDays: 7,
+        globalsignValidityPeriod: {Months: 1, NotAfter: 'In a month'},
+        globalsignCertificateInfo: certificateInfo,
+        receivedCertificateDate: new Date()
+      };
+      if (withParsedDates) {
+        _.extend(doc, certificateValidityDates(certificateInfo));
+      }
+      return CertificateRequests.insert(doc);
+    }
+
+    function freshHostname() {
+      hostnameCounter += 1;
+      return 'certdates' + hostnameCounter;
+    }
+
+    function storeValidCertificates(hostname, count) {
+      var now = new Date().getTime();
+      for (var i = 0; i < count; i++) {
+        storeCertificate(hostname, new Date(now - DAY_IN_MILLISECONDS),
+                         new Date(now + 6 * DAY_IN_MILLISECONDS), true);
+      }
+    }
+
+    it('should allow a certificate with 5 currently valid ones', function() {
+      var hostname = freshHostname();
+      storeValidCertificates(hostname, 5);
+      expect(hostnameIsWithinReasonableCertificateIssuanceLimits(hostname)).toBe(true);
+    });
+
+    it('should refuse a certificate with 6 currently valid ones', function() {
+      var hostname = freshHostname();
+      storeValidCertificates(hostname, 6);
+      expect(hostnameIsWithinReasonableCertificateIssuanceLimits(hostname)).toBe(false);
+    });
+
+    it('should not count expired or not yet valid certificates', function() {
+      var hostname = freshHostname();
+      var now = new Date().getTime();
+      storeValidCertificates(hostname, 5);
+      storeCertificate(hostname, new Date(now - 14 * DAY_IN_MILLISECONDS),
+                       new Date(now - 7 * DAY_IN_MILLISECONDS), true);
+      storeCertificate(hostname, new Date(now + DAY_IN_MILLISECONDS),
+                       new Date(now + 8 * DAY_IN_MILLISECONDS), true);
+      expect(hostnameIsWithinReasonableCertificateIssuanceLimits(hostname)).toBe(true);
+    });
+
+    it('should fill in the dates on old certificates', function() {
+      var hostname = freshHostname();
+      var now = new Date().getTime();
+      var startDate = new Date(now - DAY_IN_MILLISECONDS);
+      var endDate = new Date(now + 6 * DAY_IN_MILLISECONDS);
+      var id = storeCertificate(hostname, startDate, endDate, false);
+      expect(hostnameIsWithinReasonableCertificateIssuanceLimits(hostname)).toBe(true);
+
+      // Other specs store certificates too, so don't count on how many
+      // this updates.
+      expect(migrateCertificateValidityDates()).toBeGreaterThan(0);
+      var doc = CertificateRequests.findOne(id);
+      expect(doc.certificateStartDate.getTime()).toBe(startDate.getTime());
+      expect(doc.certificateEndDate.getTime()).toBe(endDate.getTime());
+
+      storeValidCertificates(hostname, 5);
+      expect(hostnameIsWithinReasonableCertificateIssuanceLimits(hostname)).toBe(false);
+    });
+
+    it('should only try old certificates with unparseable dates once', function() {
+      var hostname = freshHostname();
+      var id = storeCertificate(hostname, 'Next Friday',
+                                new Date(new Date().getTime() + DAY_IN_MILLISECONDS), false);
+
+      migrateCertificateValidityDates();
+      var doc = CertificateRequests.findOne(id);
+      expect(doc.certificateEndDate).toBeUndefined();
+      expect(doc.certificateValidityDatesUnparseable).toBe(true);
+
+      expect(CertificateRequests.find({
+        globalsignCertificateInfo: {$exists: true},
+        certificateEndDate: {$exists: false},
+        certificateValidityDatesUnparseable: {$exists: false}
+      }).count()).toBe(0);
+    });
+  });
+});
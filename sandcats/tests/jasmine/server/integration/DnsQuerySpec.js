@@ -0,0 +1,32 @@
+Jasmine.onTest(function () {
+  describe('DNS lookup backend helpers', function() {
+    'use strict';
+
+    it('should build a query for an A record', function() {
+      var query = buildDnsAQuery(0x1234, 'benb.sandcatz.io');
+      expect(query.toString('hex')).toBe(
+        '123400000001000000000000' +
+          '0462656e620873616e646361747a02696f00' +
+          '00010001');
+    });
+
+    it('should find the addresses in a response', function() {
+      var query = buildDnsAQuery(0x1234, 'benb.sandcatz.io');
+      // An answer that points back at the question's name.
+      var answer = new Buffer([0xc0, 0x0c, 0, 1, 0, 1, 0, 0, 0, 60, 0, 4, 127, 0, 0, 1]);
+      var response = Buffer.concat([query, answer]);
+      response.writeUInt16BE(1, 6);
+
+      var parsed = parseDnsAResponse(response);
+      expect(parsed.id).toBe(0x1234);
+      expect(parsed.addresses).toEqual(['127.0.0.1']);
+    });
+
+    it('should reject a truncated response', function() {
+      var query = buildDnsAQuery(1, 'benb.sandcatz.io');
+      var response = Buffer.concat([query, new Buffer([0xc0, 0x0c, 0, 1])]);
+      response.writeUInt16BE(1, 6);
+      expect(function() { parseDnsAResponse(response); }).toThrow();
+    });
+  });
+});
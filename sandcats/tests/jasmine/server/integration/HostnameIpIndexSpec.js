@@ -0,0 +1,53 @@
+Jasmine.onTest(function () {
+  describe('HostnameIpIndex', function() {
+    'use strict';
+
+    var index;
+
+    beforeEach(function() {
+      // Drive the index via its observe callbacks, so that we don't
+      // depend on the timing of MongoDB observers.
+      index = makeHostnameIpIndex(UserRegistrations);
+      index.ready = true;
+    });
+
+    it('should match a hostname to its IP address', function() {
+      index.observeCallbacks.added('id1', {hostname: 'benb', ipAddress: '127.0.0.1'});
+      expect(index.hostnameHasIpAddress('benb', '127.0.0.1')).toBe(true);
+      expect(index.hostnameHasIpAddress('benb', '128.151.2.1')).toBe(false);
+      expect(index.hostnameHasIpAddress('nobody', '127.0.0.1')).toBe(false);
+      expect(index.getStats().hits).toBe(1);
+      expect(index.getStats().misses).toBe(2);
+    });
+
+    it('should follow IP address changes and removals', function() {
+      index.observeCallbacks.added('id1', {hostname: 'benb', ipAddress: '127.0.0.1'});
+      index.observeCallbacks.changed('id1', {ipAddress: '128.151.2.1'});
+      expect(index.hostnameHasIpAddress('benb', '128.151.2.1')).toBe(true);
+      expect(index.hostnameHasIpAddress('benb', '127.0.0.1')).toBe(false);
+
+      index.observeCallbacks.removed('id1');
+      expect(index.getIpAddress('benb')).toBe(null);
+      expect(index.getStats().size).toBe(0);
+      expect(index.getStats().changesApplied).toBe(3);
+    });
+
+    it('should tell change listeners about updates and removals', function() {
+      var changes = [];
+      var stopListening = index.onChange(function(hostname, ipAddress) {
+        changes.push([hostname, ipAddress]);
+      });
+      index.observeCallbacks.added('id1', {hostname: 'benb', ipAddress: '127.0.0.1'});
+      index.observeCallbacks.changed('id1', {hostname: 'benb2'});
+      stopListening();
+      index.observeCallbacks.removed('id1');
+      expect(changes).toEqual([['benb', '127.0.0.1'],
+                               ['benb', null],
+                               ['benb2', '127.0.0.1']]);
+    });
+
+    it('should not confuse hostnames with Object properties', function() {
+      expect(index.getIpAddress('constructor')).toBe(null);
+    });
+  });
+});
@@ -0,0 +1,68 @@
+Jasmine.onTest(function () {
+  describe('RegistrationLookups', function() {
+    'use strict';
+
+    var publicKeyId = 'lookupspec0123456789abcdefghijklmnopqrst';
+
+    beforeEach(function() {
+      UserRegistrations.remove({hostname: 'lookupspec'});
+      UserRegistrations.insert({
+        hostname: 'lookupspec',
+        ipAddress: '127.0.0.1',
+        publicKeyId: publicKeyId,
+        emailAddress: 'lookupspec@example.com'
+      });
+    });
+
+    afterEach(function() {
+      UserRegistrations.remove({hostname: 'lookupspec'});
+    });
+
+    it('should read each registration once per request', function() {
+      RegistrationLookups.withRequestScope(function() {
+        var byHostname = RegistrationLookups.findByHostname('lookupspec');
+        expect(byHostname.publicKeyId).toBe(publicKeyId);
+
+        // From here on, the answers must come from the memo.
+        UserRegistrations.remove({hostname: 'lookupspec'});
+        expect(RegistrationLookups.findByHostname('lookupspec')).toBe(byHostname);
+        expect(RegistrationLookups.findByPublicKeyId(publicKeyId)).toBe(byHostname);
+      });
+    });
+
+    it('should remember that a registration does not exist', function() {
+      RegistrationLookups.withRequestScope(function() {
+        expect(RegistrationLookups.findByHostname('lookupspec2')).toBeUndefined();
+        UserRegistrations.insert({
+          hostname: 'lookupspec2',
+          ipAddress: '127.0.0.1',
+          publicKeyId: 'lookupspec2123456789abcdefghijklmnopqrst',
+          emailAddress: 'lookupspec@example.com'
+        });
+        expect(RegistrationLookups.findByHostname('lookupspec2')).toBeUndefined();
+      });
+      expect(RegistrationLookups.findByHostname('lookupspec2').hostname).toBe('lookupspec2');
+      UserRegistrations.remove({hostname: 'lookupspec2'});
+    });
+
+    it('should see updates recorded during the request', function() {
+      var newPublicKeyId = 'lookupspec9876543210abcdefghijklmnopqrst';
+      RegistrationLookups.withRequestScope(function() {
+        var registration = RegistrationLookups.findByHostname('lookupspec');
+        var updated = RegistrationLookups.recordUpdate(
+          registration, {publicKeyId: newPublicKeyId, ipAddress: '127.0.0.2'});
+        expect(updated.ipAddress).toBe('127.0.0.2');
+        expect(registration.ipAddress).toBe('127.0.0.1');
+        expect(RegistrationLookups.findByHostname('lookupspec')).toBe(updated);
+        expect(RegistrationLookups.findByPublicKeyId(newPublicKeyId)).toBe(updated);
+        expect(RegistrationLookups.findByPublicKeyId(publicKeyId)).toBeUndefined();
+      });
+    });
+
+    it('should read MongoDB every time outside a request', function() {
+      expect(RegistrationLookups.findByHostname('lookupspec').ipAddress).toBe('127.0.0.1');
+      UserRegistrations.remove({hostname: 'lookupspec'});
+      expect(RegistrationLookups.findByHostname('lookupspec')).toBeUndefined();
+    });
+  });
+});
@@ -0,0 +1,34 @@
+Jasmine.onTest(function () {
+  describe('RequestMetrics', function() {
+    'use strict';
+
+    var fakeRoute = {request: {}, response: {}};
+
+    it('should split request time into exclusive categories', function() {
+      RequestMetrics.timeRoute('metrics-spec', fakeRoute, function(request, response) {
+        expect(request).toBe(fakeRoute.request);
+        RequestMetrics.time('validation', function() {
+          Meteor._sleepForMs(20);
+          RequestMetrics.time('mongo', function() {
+            Meteor._sleepForMs(50);
+          });
+        });
+      });
+
+      var stats = RequestMetrics.getStats()['metrics-spec'];
+      expect(stats.requests).toBe(1);
+      var milliseconds = stats.milliseconds;
+      // The Mongo time inside validation counts only as mongo.
+      expect(milliseconds.mongo.maxMilliseconds).not.toBeLessThan(45);
+      expect(milliseconds.validation.maxMilliseconds).not.toBeLessThan(15);
+      expect(milliseconds.validation.maxMilliseconds).toBeLessThan(45);
+      expect(milliseconds.mysql.maxMilliseconds).toBe(0);
+      expect(milliseconds.total.maxMilliseconds).not.toBeLessThan(
+        milliseconds.mongo.maxMilliseconds + milliseconds.validation.maxMilliseconds);
+    });
+
+    it('should do nothing outside a measured request', function() {
+      expect(RequestMetrics.time('mongo', function() { return 42; })).toBe(42);
+    });
+  });
+});
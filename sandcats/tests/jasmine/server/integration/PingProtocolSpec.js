@@ -0,0 +1,59 @@
+Jasmine.onTest(function () {
+  describe('UDP ping protocol', function() {
+    'use strict';
+
+    function makeV2Ping(pings) {
+      var message = new Buffer(3 + 24 * pings.length);
+      message[0] = 2;
+      message[1] = 0;
+      message[2] = pings.length;
+      pings.forEach(function(ping, i) {
+        message.write(hashUdpPingHostname(ping.hostname), 3 + 24 * i, 8, 'hex');
+        message.write(ping.challenge, 3 + 24 * i + 8, 16, 'ascii');
+      });
+      return message;
+    }
+
+    it('should parse version 1 pings', function() {
+      var ping = parseUdpPingMessage(new Buffer('benb 0123456789abcdef'));
+      expect(ping).toEqual({version: 1, hostname: 'benb', challenge: '0123456789abcdef'});
+      expect(parseUdpPingMessage(new Buffer('benb 0123'))).toBe(null);
+    });
+
+    it('should parse version 2 pings without decoding them', function() {
+      var message = makeV2Ping([
+        {hostname: 'benb', challenge: '0123456789abcdef'},
+        {hostname: 'benb3', challenge: 'abcdef0123456789'}]);
+      expect(parseUdpPingMessage(message)).toEqual({version: 2, count: 2});
+      expect(udpPingV2HostnameHash(message, 1)).toBe(hashUdpPingHostname('benb3'));
+    });
+
+    it('should reject version 2 packets of the wrong length', function() {
+      var message = makeV2Ping([{hostname: 'benb', challenge: '0123456789abcdef'}]);
+      expect(parseUdpPingMessage(message.slice(0, message.length - 1))).toBe(null);
+      expect(parseUdpPingMessage(new Buffer([2, 0]))).toBe(null);
+      message[2] = 0;
+      expect(parseUdpPingMessage(message)).toBe(null);
+    });
+
+    it('should reply with only the mismatched challenges', function() {
+      var message = makeV2Ping([
+        {hostname: 'benb', challenge: '0123456789abcdef'},
+        {hostname: 'benb3', challenge: 'abcdef0123456789'}]);
+      var reply = buildUdpPingV2Reply(message, [1]);
+      expect(reply.length).toBe(18);
+      expect(reply[0]).toBe(2);
+      expect(reply[1]).toBe(1);
+      expect(reply.toString('ascii', 2)).toBe('abcdef0123456789');
+      expect(buildUdpPingV2Reply(message, [])).toBe(null);
+    });
+
+    it('should map hashes back to hostnames', function() {
+      var map = makeUdpPingHostnameHashMap();
+      map.add('benb');
+      expect(map.get(hashUdpPingHostname('benb'))).toEqual(['benb']);
+      map.remove('benb');
+      expect(map.get(hashUdpPingHostname('benb'))).toEqual([]);
+    });
+  });
+});
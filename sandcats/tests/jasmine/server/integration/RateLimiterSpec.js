@@ -0,0 +1,61 @@
+Jasmine.onTest(function () {
+  describe('makeMemoryRateLimiter', function() {
+    'use strict';
+
+    var currentTime;
+    var limiter;
+
+    beforeEach(function() {
+      currentTime = 1000000;
+      limiter = makeMemoryRateLimiter({
+        windowSeconds: 60,
+        maxEventsPerWindow: 2,
+        maxEvents: 5,
+        now: function() { return currentTime; }
+      });
+    });
+
+    it('should allow events up to the limit, per key', function() {
+      expect(limiter.tryAcquire('benb')).toBe(true);
+      expect(limiter.tryAcquire('benb')).toBe(true);
+      expect(limiter.tryAcquire('benb')).toBe(false);
+      expect(limiter.tryAcquire('benb3')).toBe(true);
+    });
+
+    it('should allow events again once old ones leave the window', function() {
+      limiter.tryAcquire('benb');
+      currentTime += 30 * 1000;
+      limiter.tryAcquire('benb');
+      expect(limiter.tryAcquire('benb')).toBe(false);
+
+      // The first event is now out of the window, but not the second.
+      currentTime += 31 * 1000;
+      expect(limiter.tryAcquire('benb')).toBe(true);
+      expect(limiter.tryAcquire('benb')).toBe(false);
+    });
+
+    it('should forget keys whose events have all expired', function() {
+      limiter.tryAcquire('benb');
+      limiter.tryAcquire('benb3');
+      currentTime += 61 * 1000;
+      limiter.tryAcquire('benb4');
+      expect(limiter.getStats().keys).toBe(1);
+      expect(limiter.getStats().events).toBe(1);
+    });
+
+    it('should drop the oldest events to stay under maxEvents', function() {
+      for (var i = 0; i < 7; i++) {
+        limiter.tryAcquire('host' + i);
+      }
+      expect(limiter.getStats().events).toBe(5);
+      expect(limiter.getStats().evictedForMemory).toBe(2);
+    });
+
+    it('should forget everything on reset', function() {
+      limiter.tryAcquire('benb');
+      limiter.tryAcquire('benb');
+      limiter.reset();
+      expect(limiter.tryAcquire('benb')).toBe(true);
+    });
+  });
+});
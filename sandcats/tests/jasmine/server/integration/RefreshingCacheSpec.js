@@ -0,0 +1,81 @@
+Jasmine.onTest(function () {
+  describe('makeRefreshingCache', function() {
+    'use strict';
+
+    var currentTime;
+    var fetchCount;
+    var fetchShouldFail;
+    var deferred;
+    var cache;
+
+    beforeEach(function() {
+      currentTime = 1000000;
+      fetchCount = 0;
+      fetchShouldFail = false;
+      deferred = [];
+      // Stands in for GetMSSLDomains.
+      cache = makeRefreshingCache({
+        name: 'test domain info',
+        ttlMilliseconds: 60 * 1000,
+        refreshAfterMilliseconds: 30 * 1000,
+        now: function() { return currentTime; },
+        defer: function(f) { deferred.push(f); },
+        fetch: function() {
+          fetchCount += 1;
+          if (fetchShouldFail) {
+            throw new Error("GlobalSign is down");
+          }
+          return {MSSLDomainID: 'domain' + fetchCount, MSSLProfileID: 'profile'};
+        }
+      });
+      console.error = jasmine.createSpy('error');
+    });
+
+    function runDeferred() {
+      var toRun = deferred;
+      deferred = [];
+      toRun.forEach(function(f) { f(); });
+    }
+
+    it('should fetch once and then serve from the cache', function() {
+      expect(cache.get().MSSLDomainID).toBe('domain1');
+      currentTime += 10 * 1000;
+      expect(cache.get().MSSLDomainID).toBe('domain1');
+      expect(fetchCount).toBe(1);
+      expect(deferred.length).toBe(0);
+    });
+
+    it('should refresh in the background once the value is getting old', function() {
+      cache.get();
+      currentTime += 40 * 1000;
+      // Still the old value, but a refresh is queued, only once.
+      expect(cache.get().MSSLDomainID).toBe('domain1');
+      expect(cache.get().MSSLDomainID).toBe('domain1');
+      expect(deferred.length).toBe(1);
+
+      runDeferred();
+      expect(cache.get().MSSLDomainID).toBe('domain2');
+      expect(cache.getStats().backgroundRefreshes).toBe(1);
+    });
+
+    it('should fetch again and wait once the value expires', function() {
+      cache.get();
+      currentTime += 61 * 1000;
+      expect(cache.get().MSSLDomainID).toBe('domain2');
+      expect(deferred.length).toBe(0);
+    });
+
+    it('should keep using an expired value if fetching fails', function() {
+      cache.get();
+      currentTime += 61 * 1000;
+      fetchShouldFail = true;
+      expect(cache.get().MSSLDomainID).toBe('domain1');
+      expect(cache.getStats().staleReturns).toBe(1);
+    });
+
+    it('should throw if the first fetch fails', function() {
+      fetchShouldFail = true;
+      expect(function() { cache.get(); }).toThrow();
+    });
+  });
+});
@@ -0,0 +1,50 @@
+// A Jasmine reporter that prints one line of JSON per finished spec,
+// plus one when the whole run is done. input-filter.py (in
+// meteor-testing-nonsense/) reads these lines to build a summary of
+// every failure and how long each spec took, and to know when it can
+// stop the test run.
+//
+// Each line starts with a marker, so the filter can find it among
+// everything else the server logs:
+//
+//   SANDCATS_SPEC_RESULT {"fullName": ..., "status": "passed", ...}
+//   SANDCATS_SPECS_DONE {"specs": 12, "failed": 0}
+
+Jasmine.onTest(function () {
+  var SPEC_RESULT_MARKER = 'SANDCATS_SPEC_RESULT ';
+  var SPECS_DONE_MARKER = 'SANDCATS_SPECS_DONE ';
+
+  var specStartTimes = {};
+  var specCount = 0;
+  var failedCount = 0;
+
+  jasmine.getEnv().addReporter({
+    specStarted: function(result) {
+      specStartTimes[result.id] = Date.now();
+    },
+
+    specDone: function(result) {
+      var startTime = specStartTimes[result.id];
+      delete specStartTimes[result.id];
+      specCount += 1;
+      if (result.status === 'failed') {
+        failedCount += 1;
+      }
+      console.log(SPEC_RESULT_MARKER + JSON.stringify({
+        fullName: result.fullName,
+        status: result.status,
+        durationMilliseconds: startTime ? (Date.now() - startTime) : null,
+        failedExpectations: _.map(result.failedExpectations, function(expectation) {
+          return {message: expectation.message, stack: expectation.stack};
+        })
+      }));
+    },
+
+    jasmineDone: function() {
+      console.log(SPECS_DONE_MARKER + JSON.stringify({
+        specs: specCount,
+        failed: failedCount
+      }));
+    }
+  });
+});
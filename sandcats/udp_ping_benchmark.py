@@ -0,0 +1,285 @@
+"""Load generator and latency benchmark for the UDP ping protocol.
+
+test_udp_protocol() in integration_tests.py checks that the protocol
+works, one datagram at a time. This script checks how fast it works:
+it simulates many Sandstorm servers pinging sandcats at once, and
+reports how many pings got a reply, how quickly, and how many were
+dropped.
+
+Each ping is the ASCII string "<hostname> <16-byte challenge>", and
+sandcats replies with the challenge if the hostname is NOT registered
+to the IP address the ping came from. By default we ping with made-up
+hostnames, so every ping should get a reply; a ping with no reply
+within --timeout seconds counts as dropped. If you pass
+--hostnames-file, make sure those hostnames are not registered to the
+IP address you are benchmarking from, or their (correct) silence will
+look like drops.
+
+With --protocol v2 we send the binary version 2 format instead (see
+sandcats/lib/udppingprotocol.js), --batch pings per packet, and
+sandcats answers each packet with one reply listing the challenges.
+
+We use a small pool of non-blocking sockets and select(), so one
+process can simulate tens of thousands of clients. Example:
+
+    python udp_ping_benchmark.py --clients 50000 --rate 5000 --duration 30
+"""
+
+import argparse
+import errno
+import hashlib
+import json
+import random
+import select
+import socket
+import struct
+import sys
+import time
+
+CHALLENGE_LENGTH = 16
+V2_VERSION = 2
+V2_REPLY_HEADER_LENGTH = 2
+V2_MAX_PINGS = 32
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the sandcats UDP ping responder.')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Address of the sandcats UDP ping port.')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='The UDP_PING_PORT of the sandcats instance.')
+    parser.add_argument('--clients', type=int, default=20000,
+                        help='How many distinct Sandstorm servers to simulate.')
+    parser.add_argument('--sockets', type=int, default=64,
+                        help='How many UDP sockets to spread the clients over.')
+    parser.add_argument('--rate', type=float, default=2000,
+                        help='Pings per second to send, across all clients.')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='How many seconds to send pings for.')
+    parser.add_argument('--timeout', type=float, default=1.0,
+                        help='Seconds to wait for a reply before counting a ping as dropped.')
+    parser.add_argument('--hostnames-file',
+                        help='File with one hostname per line to ping with, instead of '
+                        'made-up ones. Clients cycle through them.')
+    parser.add_argument('--protocol', choices=['v1', 'v2'], default='v1',
+                        help='Which UDP ping format to send.')
+    parser.add_argument('--batch', type=int, default=1,
+                        help='With --protocol v2, how many pings to send per packet.')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the results as JSON.')
+    args = parser.parse_args(argv)
+    if not 1 <= args.batch <= V2_MAX_PINGS:
+        parser.error('--batch must be between 1 and %d.' % (V2_MAX_PINGS,))
+    if args.batch > 1 and args.protocol != 'v2':
+        parser.error('--batch needs --protocol v2.')
+    return args
+
+
+def load_hostnames(args):
+    if args.hostnames_file:
+        with open(args.hostnames_file) as f:
+            hostnames = [line.strip() for line in f if line.strip()]
+        if not hostnames:
+            raise ValueError('No hostnames in %s' % (args.hostnames_file,))
+    else:
+        hostnames = ['udp-bench-%d' % (i,) for i in range(args.clients)]
+    return [hostnames[i % len(hostnames)] for i in range(args.clients)]
+
+
+def hostname_hash(hostname):
+    return hashlib.sha256(hostname).digest()[:8]
+
+
+def reply_challenges(data):
+    '''Return the challenges in a reply, in either format.'''
+    if data[:1] == chr(V2_VERSION):
+        count = ord(data[1])
+        return [data[V2_REPLY_HEADER_LENGTH + i * CHALLENGE_LENGTH:
+                     V2_REPLY_HEADER_LENGTH + (i + 1) * CHALLENGE_LENGTH]
+                for i in range(count)]
+    return [data[:CHALLENGE_LENGTH]]
+
+
+def make_sockets(count):
+    sockets = []
+    for _ in range(count):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(0)
+        sockets.append(sock)
+    return sockets
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = int(round((pct / 100.0) * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def run_benchmark(args):
+    client_hostnames = load_hostnames(args)
+    if args.protocol == 'v2':
+        client_hashes = [hostname_hash(hostname) for hostname in client_hostnames]
+    # Shuffle which client pings next, so that we don't hit hostnames
+    # in a tidy order that might flatter any cache.
+    client_order = range(len(client_hostnames))
+    random.shuffle(client_order)
+    sockets = make_sockets(args.sockets)
+    destination = (args.host, args.port)
+
+    # Map from challenge to the time its ping was sent.
+    outstanding = {}
+    # Challenges in the order they were sent, so that we can expire
+    # the oldest ones cheaply.
+    send_order = []
+    send_order_start = 0
+
+    latencies = []
+    counts = {
+        'sent': 0,
+        'replies': 0,
+        'dropped': 0,
+        'send_errors': 0,
+        'unexpected_replies': 0,
+        'packets_sent': 0,
+        'packets_received': 0,
+    }
+
+    start = time.time()
+    send_deadline = start + args.duration
+    sequence = 0
+
+    while True:
+        now = time.time()
+        if now >= send_deadline and not outstanding:
+            break
+        if now >= send_deadline + args.timeout:
+            break
+
+        # Send however many pings are due to keep up with --rate.
+        if now < send_deadline:
+            due = int((now - start) * args.rate) - sequence
+            while due > 0:
+                # A packet carries up to --batch pings, from the socket
+                # of its first client.
+                pings_in_packet = min(args.batch, due)
+                due -= pings_in_packet
+                client = client_order[sequence % len(client_order)]
+                sock = sockets[client % len(sockets)]
+                challenges = []
+                if args.protocol == 'v2':
+                    message = struct.pack('BBB', V2_VERSION, 0, pings_in_packet)
+                    for _ in range(pings_in_packet):
+                        client = client_order[sequence % len(client_order)]
+                        challenge = '%016x' % (sequence,)
+                        sequence += 1
+                        message += client_hashes[client] + challenge
+                        challenges.append(challenge)
+                else:
+                    challenge = '%016x' % (sequence,)
+                    sequence += 1
+                    message = '%s %s' % (client_hostnames[client], challenge)
+                    challenges.append(challenge)
+                try:
+                    sock.sendto(message, destination)
+                except socket.error as e:
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                        counts['send_errors'] += 1
+                        continue
+                    raise
+                sent_at = time.time()
+                for challenge in challenges:
+                    outstanding[challenge] = sent_at
+                    send_order.append(challenge)
+                counts['sent'] += len(challenges)
+                counts['packets_sent'] += 1
+
+        # Collect whatever replies have arrived.
+        readable, _, _ = select.select(sockets, [], [], 0.001)
+        for sock in readable:
+            while True:
+                try:
+                    data, _ = sock.recvfrom(1024)
+                except socket.error as e:
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
+                    raise
+                counts['packets_received'] += 1
+                for challenge in reply_challenges(data):
+                    sent_at = outstanding.pop(challenge, None)
+                    if sent_at is None:
+                        # A late reply to a ping we already counted as
+                        # dropped, or garbage.
+                        counts['unexpected_replies'] += 1
+                        continue
+                    latencies.append((time.time() - sent_at) * 1000)
+                    counts['replies'] += 1
+
+        # Expire pings that have waited too long.
+        expire_before = time.time() - args.timeout
+        while send_order_start < len(send_order):
+            challenge = send_order[send_order_start]
+            sent_at = outstanding.get(challenge)
+            if sent_at is not None and sent_at > expire_before:
+                break
+            if sent_at is not None:
+                del outstanding[challenge]
+                counts['dropped'] += 1
+            send_order_start += 1
+
+    counts['dropped'] += len(outstanding)
+    elapsed = time.time() - start
+    for sock in sockets:
+        sock.close()
+
+    latencies.sort()
+    return {
+        'clients': len(client_hostnames),
+        'sockets': len(sockets),
+        'protocol': args.protocol,
+        'batch': args.batch,
+        'packets_sent': counts['packets_sent'],
+        'packets_received': counts['packets_received'],
+        'target_rate': args.rate,
+        'elapsed_seconds': elapsed,
+        'sent': counts['sent'],
+        'replies': counts['replies'],
+        'dropped': counts['dropped'],
+        'send_errors': counts['send_errors'],
+        'unexpected_replies': counts['unexpected_replies'],
+        'sent_per_second': counts['sent'] / args.duration,
+        'replies_per_second': counts['replies'] / elapsed,
+        'drop_rate': (float(counts['dropped']) / counts['sent']) if counts['sent'] else None,
+        'p50_ms': percentile(latencies, 50),
+        'p99_ms': percentile(latencies, 99),
+        'max_ms': latencies[-1] if latencies else None,
+    }
+
+
+def print_results(results):
+    print 'Simulated %d clients over %d sockets, using protocol %s.' % (
+        results['clients'], results['sockets'], results['protocol'])
+    print 'Sent %d packets of up to %d pings; received %d packets.' % (
+        results['packets_sent'], results['batch'], results['packets_received'])
+    print 'Sent %d pings (%.1f/s; target %.1f/s); %d send errors.' % (
+        results['sent'], results['sent_per_second'], results['target_rate'],
+        results['send_errors'])
+    print 'Got %d replies (%.1f/s); %d dropped (drop rate %s).' % (
+        results['replies'], results['replies_per_second'], results['dropped'],
+        '%.4f' % (results['drop_rate'],) if results['drop_rate'] is not None else 'n/a')
+    if results['p50_ms'] is not None:
+        print 'Reply latency: p50 %.2f ms, p99 %.2f ms, max %.2f ms.' % (
+            results['p50_ms'], results['p99_ms'], results['max_ms'])
+    if results['unexpected_replies']:
+        print '%d replies arrived after their ping timed out.' % (
+            results['unexpected_replies'],)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    results = run_benchmark(args)
+    if args.json:
+        print json.dumps(results, indent=2, sort_keys=True)
+    else:
+        print_results(results)
@@ -0,0 +1,226 @@
+// Standalone UDP ping workers for Sandcats.
+//
+// Normally the Meteor process answers UDP pings itself (see
+// sandcats/server/udppings.js). That means every packet competes with
+// HTTP requests for the one Meteor process, and goes through a fiber.
+// This script instead runs several plain node processes that share
+// UDP_PING_PORT, so ping throughput scales with the number of cores.
+//
+// Usage:
+//
+//   node udp-ping-workers.js /etc/sandcats-meteor-settings.json [number-of-workers]
+//
+// The number of workers defaults to the number of CPUs.
+//
+// To use this, set UDP_PING_WORKERS_FEED_PORT in the Meteor settings
+// file. The Meteor process then stops binding UDP_PING_PORT, and
+// instead feeds its in-memory hostname index to every worker over
+// that TCP port (see sandcats/server/udppingfeed.js). Each worker
+// keeps its own read-only copy of the index.
+//
+// The node version we deploy does not support SO_REUSEPORT for UDP
+// sockets, so we use node's cluster module instead: the master binds
+// UDP_PING_PORT once and shares the socket with every worker, and the
+// kernel hands each datagram to whichever worker reads it first.
+
+var cluster = require('cluster');
+var dgram = require('dgram');
+var fs = require('fs');
+var net = require('net');
+var os = require('os');
+
+var protocol = require('../sandcats/lib/udppingprotocol.js');
+
+var RECONNECT_DELAY_MILLISECONDS = 1000;
+var RESTART_DELAY_MILLISECONDS = 1000;
+var STATS_LOG_INTERVAL_MILLISECONDS = 60 * 60 * 1000;
+
+function readSettings(path) {
+  var settings = JSON.parse(fs.readFileSync(path, 'utf-8'));
+  if (! settings.UDP_PING_PORT || ! settings.UDP_PING_WORKERS_FEED_PORT) {
+    throw new Error("The settings file needs UDP_PING_PORT and UDP_PING_WORKERS_FEED_PORT.");
+  }
+  return settings;
+}
+
+function runMaster(numberOfWorkers) {
+  console.log("Starting " + numberOfWorkers + " UDP ping workers.");
+  for (var i = 0; i < numberOfWorkers; i++) {
+    cluster.fork();
+  }
+
+  cluster.on('exit', function(worker, code, signal) {
+    console.log("UDP ping worker " + worker.process.pid + " exited with code " + code +
+                " and signal " + signal + ". Starting a new one.");
+    setTimeout(function() {
+      cluster.fork();
+    }, RESTART_DELAY_MILLISECONDS);
+  });
+}
+
+// A worker's read-only copy of the hostname index: IP address by
+// hostname, plus hostnames by hash for version 2 pings. We use
+// Object.create(null) so that any hostname is a safe key.
+function makeIndex() {
+  return {
+    ipAddressByHostname: Object.create(null),
+    hostnamesByHash: protocol.makeUdpPingHostnameHashMap()
+  };
+}
+
+function setIndexEntry(index, hostname, ipAddress) {
+  if (ipAddress === null) {
+    if (hostname in index.ipAddressByHostname) {
+      delete index.ipAddressByHostname[hostname];
+      index.hostnamesByHash.remove(hostname);
+    }
+    return;
+  }
+  if (! (hostname in index.ipAddressByHostname)) {
+    index.hostnamesByHash.add(hostname);
+  }
+  index.ipAddressByHostname[hostname] = ipAddress;
+}
+
+function runWorker(settings) {
+  // The hostname index we answer pings from.
+  var index = makeIndex();
+  // Until the first snapshot arrives, we can't tell if a hostname
+  // matches, so we don't reply at all; clients will ping again.
+  var ready = false;
+
+  var counters = {
+    packetsReceived: 0,
+    malformedPackets: 0,
+    v2Packets: 0,
+    v2Pings: 0,
+    repliesSent: 0,
+    unansweredBeforeReady: 0,
+    feedReconnects: 0
+  };
+
+  function connectToFeed() {
+    // While a (re)connection is receiving its snapshot, we keep
+    // answering from the previous copy of the index, then swap.
+    var incoming = makeIndex();
+    var snapshotComplete = false;
+    var buffered = '';
+
+    var socket = net.connect(settings.UDP_PING_WORKERS_FEED_PORT, '127.0.0.1');
+    socket.setEncoding('utf8');
+
+    socket.on('data', function(data) {
+      buffered += data;
+      var lines = buffered.split('\n');
+      buffered = lines.pop();
+      lines.forEach(function(line) {
+        var entry = JSON.parse(line);
+        if (entry.snapshotComplete) {
+          index = incoming;
+          incoming = null;
+          snapshotComplete = true;
+          ready = true;
+          console.log("UDP ping worker " + process.pid + " received the hostname snapshot.");
+          return;
+        }
+        setIndexEntry(snapshotComplete ? index : incoming, entry.hostname, entry.ipAddress);
+      });
+    });
+
+    socket.on('error', function(e) {
+      console.log("UDP ping worker " + process.pid + " feed error: " + e.message);
+    });
+
+    socket.on('close', function() {
+      counters.feedReconnects += 1;
+      setTimeout(connectToFeed, RECONNECT_DELAY_MILLISECONDS);
+    });
+  }
+
+  var server = dgram.createSocket('udp4');
+
+  // A version 2 ping matches if any hostname with its hash is
+  // registered to the sender. Everything here is synchronous, so we
+  // reply as soon as we have looked at every ping in the packet.
+  function answerV2Pings(message, count, remote) {
+    counters.v2Packets += 1;
+    counters.v2Pings += count;
+    var mismatchedPings = [];
+    for (var i = 0; i < count; i++) {
+      var hostnames = index.hostnamesByHash.get(protocol.udpPingV2HostnameHash(message, i));
+      var matches = false;
+      for (var j = 0; j < hostnames.length; j++) {
+        if (index.ipAddressByHostname[hostnames[j]] === remote.address) {
+          matches = true;
+          break;
+        }
+      }
+      if (! matches) {
+        mismatchedPings.push(i);
+      }
+    }
+    var reply = protocol.buildUdpPingV2Reply(message, mismatchedPings);
+    if (reply) {
+      server.send(reply, 0, reply.length, remote.port, remote.address);
+      counters.repliesSent += 1;
+    }
+  }
+
+  server.on('message', function(message, remote) {
+    counters.packetsReceived += 1;
+
+    var ping = protocol.parseUdpPingMessage(message);
+    if (! ping) {
+      counters.malformedPackets += 1;
+      return;
+    }
+
+    if (! ready) {
+      counters.unansweredBeforeReady += 1;
+      return;
+    }
+
+    if (ping.version === 2) {
+      answerV2Pings(message, ping.count, remote);
+      return;
+    }
+
+    // By default, we should reply to any message. Only if the IP
+    // address and the hostname match should we not reply.
+    if (index.ipAddressByHostname[ping.hostname] !== remote.address) {
+      server.send(new Buffer(ping.challenge), 0, protocol.UDP_PING_CHALLENGE_LENGTH,
+                  remote.port, remote.address);
+      counters.repliesSent += 1;
+    }
+  });
+
+  server.on('listening', function() {
+    var myAddress = server.address();
+    console.log("UDP ping worker " + process.pid + " listening on " +
+                myAddress.address + ":" + myAddress.port);
+  });
+
+  setInterval(function() {
+    console.log("UDP ping worker " + process.pid + " stats: " + JSON.stringify(counters));
+  }, STATS_LOG_INTERVAL_MILLISECONDS);
+
+  connectToFeed();
+  server.bind(settings.UDP_PING_PORT, '0.0.0.0');
+}
+
+function main() {
+  var settingsPath = process.argv[2];
+  if (! settingsPath) {
+    console.error("Usage: node udp-ping-workers.js SETTINGS_FILE [NUMBER_OF_WORKERS]");
+    process.exit(1);
+  }
+  var settings = readSettings(settingsPath);
+
+  if (cluster.isMaster) {
+    runMaster(Number(process.argv[3]) || os.cpus().length);
+  } else {
+    runWorker(settings);
+  }
+}
+
+main();